@@ -0,0 +1,264 @@
+# Global imports
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Local imports
+from server import MockFox, MockMyenergi
+
+def percentile(samples, percent):
+    """
+    Get a percentile of a list of samples.
+    :param samples: The samples.
+    :param percent: The percentile, from 0 to 100.
+    :return: The value at that percentile.
+    """
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def measure(name, func, count):
+    """
+    Call a function repeatedly and summarise its latency.
+    :param name: The benchmark name.
+    :param func: The function to call.
+    :param count: The number of calls.
+    :return: A dictionary of results.
+    """
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(count):
+        call_started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return summarise(name, latencies, elapsed)
+
+def summarise(name, latencies, elapsed):
+    return {
+        "benchmark": name,
+        "count": len(latencies),
+        "seconds": elapsed,
+        "per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+    }
+
+def run(options):
+    """
+    Start the mock servers, point the fox modules at them and run every benchmark.
+    :param options: The parsed command line options.
+    :return: A list of result dictionaries.
+    """
+    fox_server = MockFox(
+        devices=options.devices,
+        latency=options.latency,
+        jitter=options.jitter,
+        error_rate=options.error_rate,
+        rate_limit_rate=options.rate_limit_rate,
+    ).start()
+    myenergi_server = MockMyenergi(latency=options.latency, jitter=options.jitter).start()
+
+    # The fox modules read their settings from the environment, so set it before importing them
+    data_dir = tempfile.mkdtemp(prefix="fox-bench-")
+    os.environ.update({
+        "DEBUG": "false",
+        "FOX_API_KEY": fox_server.key,
+        "FOX_API_DOMAIN": fox_server.get_url(),
+        "FOX_ASYNC_CONCURRENCY": str(options.workers * 4),
+        "FOX_DATA_DIR": data_dir,
+        "FOX_BACKOFF": "0.01",
+        "FOX_RATE_LIMIT": str(options.rate_limit),
+        "FOX_RATE_BURST": str(int(options.rate_limit)),
+        "FOX_POOL_SIZE": str(options.workers),
+        "FOX_WORKERS": str(options.workers),
+        "MYENERGI_API_KEY": myenergi_server.key,
+        "MYENERGI_SERIAL_NUMBER": myenergi_server.serial,
+        "MYENERGI_DATA_DIR": tempfile.mkdtemp(prefix="myenergi-bench-"),
+        "MYENERGI_DIRECTOR": myenergi_server.get_url(),
+        "MYENERGI_WORKERS": str(options.workers),
+    })
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.join(root, "myenergi"))
+    sys.path.insert(0, os.path.join(root, "fox"))
+
+    import requests
+    import urllib3
+    from requests.auth import HTTPDigestAuth
+    from api import API
+    from async_data import AsyncData
+    from cache import MemoryCache
+    from client import Client
+    from data import Data
+    from device import Device
+    from manifest import Manifest
+    from records import Records
+    from workers import Workers
+
+    urllib3.disable_warnings()
+    results = []
+    serial = fox_server.serials[0]
+
+    def send():
+        api = API()
+        api.set_name("device_generation")
+        api.set_params({"sn": serial})
+        api.send_request()
+
+    results.append(measure("request_sequential", send, options.requests))
+
+    latencies = []
+    def timed_send(_):
+        started = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    Workers.map(timed_send, range(options.requests), options.workers)
+    results.append(summarise("request_concurrent", latencies, time.perf_counter() - started))
+
+    data = Data("device_list")
+    data.set_params({"currentPage": 1, "pageSize": 500})
+    data.get()
+    results.append(measure("cache_memory_hit", data.get, options.requests * 10))
+
+    def disk_hit():
+        MemoryCache.clear()
+        data.get()
+    results.append(measure("cache_disk_hit", disk_hit, options.requests))
+
+    started = time.perf_counter()
+    fleet = Device.fleet("history_query", max_workers=options.workers)
+    elapsed = time.perf_counter() - started
+    results.append({
+        "benchmark": "fleet_history",
+        "count": len(fleet["results"]),
+        "errors": len(fleet["errors"]),
+        "seconds": elapsed,
+        "per_second": len(fleet["results"]) / elapsed if elapsed else 0.0,
+    })
+
+    # The same fleet on one event loop, for a day that isn't cached yet
+    serial_numbers = Device.serials()
+    date = time.strftime("%Y-%m-%d", time.localtime(time.time() - 2 * 86400))
+    started = time.perf_counter()
+    fleet_results, fleet_errors = AsyncData.run(AsyncData.map(
+        lambda serial_number: AsyncData(
+            "device_history_query", Device.get_params("history_query", serial_number, date)
+        ).get(),
+        serial_numbers,
+    ))
+    elapsed = time.perf_counter() - started
+    results.append({
+        "benchmark": "fleet_history_async",
+        "count": len(fleet_results),
+        "errors": len(fleet_errors),
+        "seconds": elapsed,
+        "per_second": len(fleet_results) / elapsed if elapsed else 0.0,
+    })
+
+    # Cold-load every saved history file, one at a time and then across a process pool
+    manifest = Manifest()
+    entries = manifest.select("device_history_query")
+    started = time.perf_counter()
+    for entry in entries:
+        for record in Records.read("device_history_query", os.path.join(data_dir, entry["file"])):
+            record.compact()
+    elapsed = time.perf_counter() - started
+    results.append({
+        "benchmark": "history_load_sequential",
+        "count": len(entries),
+        "seconds": elapsed,
+        "per_second": len(entries) / elapsed if elapsed else 0.0,
+    })
+    started = time.perf_counter()
+    loaded = sum(1 for _ in manifest.load("device_history_query"))
+    elapsed = time.perf_counter() - started
+    results.append({
+        "benchmark": "history_load_processes",
+        "count": loaded,
+        "seconds": elapsed,
+        "per_second": loaded / elapsed if elapsed else 0.0,
+    })
+
+    auth = HTTPDigestAuth(myenergi_server.serial, myenergi_server.key)
+    url = f"{myenergi_server.get_url()}/cgi-jdayhour-Z{myenergi_server.serial}-2024-01-01"
+    results.append(measure(
+        "myenergi_new_session",
+        lambda: requests.get(url, auth=HTTPDigestAuth(myenergi_server.serial, myenergi_server.key)),
+        options.requests,
+    ))
+    session = requests.Session()
+    session.auth = auth
+    results.append(measure("myenergi_reused_session", lambda: session.get(url), options.requests))
+
+    client = Client()
+    started = time.perf_counter()
+    backfilled, errors = client.backfill("2024-01-01", "2024-03-31")
+    elapsed = time.perf_counter() - started
+    results.append({
+        "benchmark": "myenergi_backfill",
+        "count": len(backfilled),
+        "errors": len(errors),
+        "seconds": elapsed,
+        "per_second": len(backfilled) / elapsed if elapsed else 0.0,
+    })
+
+    # Process start-up, which dominates short commands like reading one cached file
+    script = os.path.join(root, "fox", "index.py")
+    def start(*args):
+        subprocess.run([sys.executable, script, *args], env=os.environ, check=True, capture_output=True)
+    results.append(measure("startup_usage", start, options.startup_runs))
+    start("device_detail", serial)
+    results.append(measure("startup_cached_detail", lambda: start("device_detail", serial), options.startup_runs))
+
+    results.append({
+        "benchmark": "mock_servers",
+        "fox_requests": fox_server.requests,
+        "myenergi_requests": myenergi_server.requests,
+        "myenergi_challenges": myenergi_server.challenges,
+    })
+    fox_server.shutdown()
+    myenergi_server.shutdown()
+    return results
+
+def print_results(results):
+    """
+    Print results as a table.
+    :param results: A list of result dictionaries.
+    """
+    print(f"{'benchmark':<26}{'count':>8}{'seconds':>10}{'per sec':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        if "seconds" not in result:
+            print(", ".join(f"{key}={value}" for key, value in result.items()))
+            continue
+        latency = f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}" if "p50_ms" in result else ""
+        print(
+            f"{result['benchmark']:<26}{result['count']:>8}{result['seconds']:>10.3f}"
+            f"{result['per_second']:>12.1f}{latency}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the fox and myenergi clients against local mock servers.")
+    parser.add_argument("--devices", type=int, default=50, help="Number of devices the mock FoxESS API reports.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per request benchmark.")
+    parser.add_argument("--workers", type=int, default=8, help="Worker pool size for concurrent benchmarks.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Injected server latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency of up to this many seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429.")
+    parser.add_argument("--rate-limit", type=float, default=10000, help="Client FOX_RATE_LIMIT in requests per second.")
+    parser.add_argument("--startup-runs", type=int, default=20, help="Process starts per start-up benchmark.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    options = parser.parse_args()
+
+    results = run(options)
+    if options.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
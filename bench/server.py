@@ -0,0 +1,407 @@
+# Global imports
+import hashlib
+import json
+import math
+import random
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Shared request handling for the mock servers: latency and fault injection,
+    and JSON responses.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # Send headers and body together, so delayed ACKs don't stall keep-alive connections
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean
+        pass
+
+    def inject_faults(self):
+        """
+        Sleep for the configured latency and maybe answer with a fault.
+        :return: True if a fault response was sent, False otherwise.
+        """
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        roll = random.random()
+        if roll < server.rate_limit_rate:
+            self.send_json({"errno": 40400, "msg": "Too many requests"}, status=429, headers={"Retry-After": "0"})
+            return True
+        if roll < server.rate_limit_rate + server.error_rate:
+            self.send_json({"errno": 500, "msg": "Injected failure"}, status=500)
+            return True
+
+        return False
+
+    def read_json(self):
+        """
+        Read the request body as JSON.
+        :return: The parsed body, or an empty dictionary.
+        """
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, payload, status=200, headers=None):
+        """
+        Send a JSON response.
+        :param payload: The response body.
+        :param status: The HTTP status code.
+        :param headers: Extra response headers.
+        """
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.requests += 1
+
+
+class FoxHandler(MockHandler):
+    """
+    Serves the FoxESS /op/v0/ endpoints used by fox/api.py.
+    """
+
+    # Endpoint paths to (method, handler name)
+    routes = {
+        "device/list": ("POST", "device_list"),
+        "device/detail": ("GET", "device_detail"),
+        "device/variable/get": ("GET", "device_variable_get"),
+        "device/history/query": ("POST", "device_history_query"),
+        "device/report/query": ("POST", "device_report_query"),
+        "device/generation": ("GET", "device_generation"),
+        "device/real/query": ("POST", "device_real_query"),
+        "module/list": ("POST", "module_list"),
+        "plant/list": ("POST", "plant_list"),
+        "plant/detail": ("GET", "plant_detail"),
+        "user/getAccessCount": ("GET", "user_get_access_count"),
+    }
+
+    history_variables = {
+        "pvPower": "kW",
+        "loadsPower": "kW",
+        "gridConsumptionPower": "kW",
+        "feedinPower": "kW",
+        "batChargePower": "kW",
+        "batDischargePower": "kW",
+        "SoC": "%",
+    }
+
+    report_variables = ["generation", "feedin", "gridConsumption", "chargeEnergyToTal", "dischargeEnergyToTal"]
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        if method == "POST":
+            params = self.read_json()
+        else:
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        endpoint = url.path.removeprefix("/op/v0/")
+        if endpoint not in self.routes or self.routes[endpoint][0] != method:
+            self.send_json({"errno": 40404, "msg": f"Unknown endpoint {method} {url.path}"}, status=404)
+            return
+
+        if not self.check_signature(url.path):
+            self.send_json({"errno": 40256, "msg": "Illegal signature"})
+            return
+
+        if self.inject_faults():
+            return
+
+        with self.server.lock:
+            if self.server.remaining <= 0:
+                exhausted = True
+            else:
+                exhausted = False
+                if endpoint != "user/getAccessCount":
+                    self.server.remaining -= 1
+        if exhausted:
+            self.send_json({"errno": 40402, "msg": "Daily request limit exceeded"})
+            return
+
+        result = getattr(self, self.routes[endpoint][1])(params)
+        self.send_json({"errno": 0, "msg": "success", "result": result})
+
+    def check_signature(self, path):
+        """
+        Check the token, timestamp and signature headers the way the FoxESS API does.
+        :param path: The request path, e.g. "/op/v0/device/list".
+        :return: True if the signature is valid, False otherwise.
+        """
+        token = self.headers.get("token")
+        timestamp = self.headers.get("timestamp")
+        signature = self.headers.get("signature")
+        if token != self.server.key or not timestamp or not signature:
+            return False
+
+        expected = hashlib.md5(fr"{path}\r\n{token}\r\n{timestamp}".encode("UTF-8")).hexdigest()
+        return signature == expected
+
+    def page(self, items, params):
+        current_page = int(params.get("currentPage", 1))
+        page_size = int(params.get("pageSize", 10))
+        start = (current_page - 1) * page_size
+        return {
+            "currentPage": current_page,
+            "pageSize": page_size,
+            "total": len(items),
+            "data": items[start:start + page_size],
+        }
+
+    def device_list(self, params):
+        return self.page(
+            [
+                {"deviceSN": serial, "stationID": f"station-{index}", "deviceType": "H1-5.0-E", "status": 1}
+                for index, serial in enumerate(self.server.serials)
+            ],
+            params,
+        )
+
+    def device_detail(self, params):
+        return {"deviceSN": params.get("sn"), "deviceType": "H1-5.0-E", "status": 1}
+
+    def device_variable_get(self, params):
+        return [{variable: {"unit": unit, "name": {"en": variable}}} for variable, unit in self.history_variables.items()]
+
+    def device_history_query(self, params):
+        begin = int(params.get("begin", 0)) // 1000
+        end = int(params.get("end", begin * 1000 + 86399999)) // 1000
+        serial = params.get("sn")
+        seed = sum(serial.encode()) if serial else 0
+        variables = params.get("variables") or list(self.history_variables)
+        moments = range(begin - begin % 300 + 300 if begin % 300 else begin, end + 1, 300)
+        times = [
+            datetime.fromtimestamp(moment).astimezone().strftime("%Y-%m-%d %H:%M:%S %Z%z") for moment in moments
+        ]
+        datas = []
+        for index, variable in enumerate(variables):
+            datas.append({
+                "unit": self.history_variables.get(variable, ""),
+                "name": variable,
+                "variable": variable,
+                "data": [
+                    {"time": time_string, "value": round(abs(math.sin((moment + seed) / 7200 + index)) * 5, 3)}
+                    for moment, time_string in zip(moments, times)
+                ],
+            })
+        return [{"deviceSN": serial, "datas": datas}]
+
+    def device_report_query(self, params):
+        return [
+            {
+                "variable": variable,
+                "unit": "kWh",
+                "values": [round(abs(math.sin(hour / 4 + index)), 3) for hour in range(24)],
+            }
+            for index, variable in enumerate(params.get("variables") or self.report_variables)
+        ]
+
+    def device_generation(self, params):
+        return {"today": 12.3, "month": 250.1, "cumulative": 10234.5}
+
+    def device_real_query(self, params):
+        serial = params.get("sn")
+        seed = sum(serial.encode()) if serial else 0
+        moment = int(time.time())
+        return [{
+            "deviceSN": serial,
+            "time": datetime.fromtimestamp(moment).astimezone().strftime("%Y-%m-%d %H:%M:%S %Z%z"),
+            "datas": [
+                {
+                    "unit": self.history_variables.get(variable, ""),
+                    "name": variable,
+                    "variable": variable,
+                    "value": round(abs(math.sin((moment + seed) / 7200 + index)) * 5, 3),
+                }
+                for index, variable in enumerate(params.get("variables") or list(self.history_variables))
+            ],
+        }]
+
+    def module_list(self, params):
+        return self.page(
+            [{"moduleSN": f"M{serial}", "deviceSN": serial} for serial in self.server.serials], params
+        )
+
+    def plant_list(self, params):
+        return self.page(
+            [{"stationID": f"station-{index}", "name": f"Plant {index}"} for index in range(len(self.server.serials))],
+            params,
+        )
+
+    def plant_detail(self, params):
+        return {"stationID": params.get("id"), "stationName": "Mock plant", "timezone": "UTC"}
+
+    def user_get_access_count(self, params):
+        with self.server.lock:
+            return {"total": str(self.server.total), "remaining": str(self.server.remaining)}
+
+
+class MyenergiHandler(MockHandler):
+    """
+    Serves the myenergi director and cgi-jdayhour endpoints behind digest auth.
+    """
+
+    realm = "MyEnergi Telemetry"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not self.check_digest():
+            return
+
+        if self.inject_faults():
+            return
+
+        # The director tells clients which server their hub is assigned to
+        asn = self.server.asn or self.server.get_url()
+        if url.path.startswith("/cgi-jdayhour-"):
+            self.send_json(self.dayhour(url.path.removeprefix("/cgi-jdayhour-")), headers={"x_myenergi-asn": asn})
+        elif url.path.startswith("/cgi-jstatus"):
+            self.send_json({"asn": asn}, headers={"x_myenergi-asn": asn})
+        else:
+            self.send_json({"status": -1, "statustext": "Unknown"}, status=404)
+
+    def check_digest(self):
+        """
+        Check the digest Authorization header, sending a 401 challenge if it is missing or invalid.
+        :return: True if the request is authorized, False otherwise.
+        """
+        authorization = self.headers.get("Authorization", "")
+        if authorization.startswith("Digest "):
+            fields = {}
+            for part in authorization[7:].split(","):
+                name, _, value = part.strip().partition("=")
+                fields[name] = value.strip('"')
+
+            with self.server.lock:
+                known_nonce = fields.get("nonce") in self.server.nonces
+            if known_nonce and fields.get("username") == self.server.serial:
+                ha1 = hashlib.md5(f"{self.server.serial}:{self.realm}:{self.server.key}".encode()).hexdigest()
+                ha2 = hashlib.md5(f"GET:{fields.get('uri')}".encode()).hexdigest()
+                expected = hashlib.md5(
+                    f"{ha1}:{fields['nonce']}:{fields.get('nc')}:{fields.get('cnonce')}:{fields.get('qop')}:{ha2}".encode()
+                ).hexdigest()
+                if fields.get("response") == expected:
+                    return True
+
+        nonce = secrets.token_hex(16)
+        with self.server.lock:
+            self.server.nonces.add(nonce)
+            self.server.challenges += 1
+        body = b"Unauthorized"
+        self.send_response(401)
+        self.send_header(
+            "WWW-Authenticate",
+            f'Digest realm="{self.realm}", qop="auth", algorithm="MD5", nonce="{nonce}", opaque="{secrets.token_hex(8)}"',
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return False
+
+    def dayhour(self, target):
+        """
+        Build a day of hourly records for a device, e.g. target "Z12345678-2024-01-01".
+        """
+        device, _, date = target.partition("-")
+        day = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        records = []
+        for hour in range(24):
+            moment = day + timedelta(hours=hour)
+            record = {"yr": moment.year, "mon": moment.month, "dom": moment.day, "dow": moment.strftime("%a")}
+            if hour:
+                record["hr"] = hour
+            record["imp"] = int(abs(math.cos(hour / 3)) * 3600000)
+            record["exp"] = int(abs(math.sin(hour / 5)) * 1800000)
+            record["gep"] = int(abs(math.sin(hour / 4)) * 7200000)
+            record["h1d"] = int(abs(math.sin(hour / 6)) * 900000)
+            records.append(record)
+        return {f"U{device[1:]}": records}
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    A threaded mock server with latency and fault injection settings.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0):
+        super().__init__(("127.0.0.1", port), handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def get_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        :return: The server, for chaining.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockFox(MockServer):
+    """
+    A stand-in for the FoxESS cloud API.
+    """
+
+    def __init__(self, key="mock-key", devices=10, budget=100000, **kwargs):
+        super().__init__(FoxHandler, **kwargs)
+        self.key = key
+        self.serials = [f"MOCK{index:06d}" for index in range(1, devices + 1)]
+        self.total = budget
+        self.remaining = budget
+
+
+class MockMyenergi(MockServer):
+    """
+    A stand-in for the myenergi director and hub servers.
+    """
+
+    def __init__(self, serial="12345678", key="mock-key", asn=None, **kwargs):
+        super().__init__(MyenergiHandler, **kwargs)
+        self.serial = serial
+        self.key = key
+        self.asn = asn
+        self.nonces = set()
+        self.challenges = 0
+
+
+if __name__ == "__main__":
+    # Run a mock server in the foreground, e.g. server.py fox 8080 [latency]
+    kind = sys.argv[1] if len(sys.argv) > 1 else "fox"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    server = MockFox(port=port, latency=latency) if kind == "fox" else MockMyenergi(port=port, latency=latency)
+    print(f"Mock {kind} server listening on {server.get_url()}")
+    server.serve_forever()
@@ -1,12 +1,18 @@
 # Global imports
 import hashlib
-import os
+import random
 import requests
+import threading
 import time
-from dotenv import load_dotenv
+import urllib3
+from datetime import date
+from requests.adapters import HTTPAdapter
 
 # Local imports
 from debug import Debug
+from metrics import Metrics
+from scheduler import Scheduler
+from settings import Settings
 
 class API:
 
@@ -15,16 +21,55 @@ class API:
     _endpoint = None
     _key = None
     _method = "get"
+    _name = None
     _params = None
 
-    def __init__(self):
+    # Connection pooling and retry settings
+    _backoff = 0.5
+    _pool_size = 10
+    _retries = 3
+    _timeout = 30
+
+    # Status codes that are worth retrying
+    _retry_statuses = (429, 500, 502, 503, 504)
+
+    # Request budget and rate limit settings
+    _budget = True
+    _budget_reserve = 0.1
+    _rate_burst = 10
+    _rate_limit = 10
+
+    # One pooled session shared by every API instance in the process
+    _session = None
+    _session_lock = threading.Lock()
+
+    # One request scheduler shared by every API instance in the process
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+
+    # When the remaining access count was last read, so long-running processes see the quota reset.
+    # FOX_BUDGET_REFRESH overrides the seconds between reads.
+    _budget_refresh = 3600
+    _budget_read_at = None
+    _budget_day = None
+
+    def __init__(self, settings=None):
         """
         Initialize the API class.
+        :param settings: The Settings to use. Defaults to the process's settings.
         """
-
-        load_dotenv()
-        self._key = os.getenv("FOX_API_KEY")
-        self._domain = os.getenv("FOX_API_DOMAIN", "https://www.foxesscloud.com")
+        self._settings = settings or Settings.load()
+        self._key = self._settings.get("FOX_API_KEY")
+        self._domain = self._settings.get("FOX_API_DOMAIN", "https://www.foxesscloud.com")
+        self._backoff = self._settings.get_float("FOX_BACKOFF", self._backoff)
+        self._pool_size = self._settings.get_int("FOX_POOL_SIZE", self._pool_size)
+        self._retries = self._settings.get_int("FOX_RETRIES", self._retries)
+        self._timeout = self._settings.get_float("FOX_TIMEOUT", self._timeout)
+        self._budget = self._settings.get_bool("FOX_BUDGET", True)
+        self._budget_reserve = self._settings.get_float("FOX_BUDGET_RESERVE", self._budget_reserve)
+        self._budget_refresh = self._settings.get_float("FOX_BUDGET_REFRESH", self._budget_refresh)
+        self._rate_burst = self._settings.get_int("FOX_RATE_BURST", self._rate_burst)
+        self._rate_limit = self._settings.get_float("FOX_RATE_LIMIT", self._rate_limit)
 
         # Bail if the key or domain is not set
         if not self._key or not self._domain:
@@ -42,6 +87,23 @@ class API:
 
         return f"{self._domain}{self._api_prefix}{self._endpoint}"
 
+    def get_access_count(self):
+        """
+        Get the number of requests remaining in today's quota, bypassing the scheduler.
+        :return: The remaining count as an integer, or None if it could not be read.
+        """
+        api = API(self._settings)
+        api.set_name("user_get_access_count")
+        try:
+            response = api.send_request()
+            remaining = int(response.json()["result"]["remaining"])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            Debug.warning("Could not read the remaining access count: %s", e)
+            return None
+
+        Debug.info("Remaining access count: %s", remaining)
+        return remaining
+
     def get_headers(self):
         """
         This function is used to generate the headers for the API request.
@@ -49,9 +111,8 @@ class API:
         """
         timestamp = round(time.time() * 1000)
         path = self._api_prefix + self._endpoint
-        Debug.info(f"Generating signature with path: {path}, key: {self._key}, timestamp: {timestamp}")
+        Debug.debug("Generating signature with path: %s, timestamp: %s", path, timestamp)
         signature = fr'{path}\r\n{self._key}\r\n{timestamp}'
-        Debug.info(f"Signature text: {signature}")
         result = {
             'token': self._key,
             'lang': 'en',
@@ -60,9 +121,90 @@ class API:
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
             'Chrome/117.0.0.0 Safari/537.36'
         }
-        Debug.info(f"Generated headers: {result}")
+        # The token and signature are credentials, so only the header names are logged
+        Debug.debug("Generated headers: %s", ", ".join(result))
         return result
 
+    def get_retry_delay(self, attempt, response=None):
+        """
+        Get the delay before the next attempt, using exponential backoff with jitter.
+        A Retry-After header from the server takes precedence when present.
+        :param attempt: The number of the attempt that just failed, starting at 0.
+        :param response: The failed response, if one was received.
+        :return: The delay in seconds.
+        """
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return float(retry_after)
+
+        delay = self._backoff * (2 ** attempt)
+        return delay + random.uniform(0, delay)
+
+    def get_scheduler(self):
+        """
+        Get the request scheduler shared by all API instances, creating it on first use.
+        The remaining access count is read when the scheduler is created, and read again when
+        the day rolls over or FOX_BUDGET_REFRESH seconds have passed, so the quota resets.
+        :return: The Scheduler instance.
+        """
+        with API._scheduler_lock:
+            if API._scheduler is None:
+                budget, reserve = self.read_budget()
+                API._scheduler = Scheduler(self._rate_limit, self._rate_burst, budget, reserve)
+            elif self.is_budget_stale():
+                budget, reserve = self.read_budget()
+                if budget is not None:
+                    API._scheduler.set_budget(budget, reserve)
+
+            return API._scheduler
+
+    def is_budget_stale(self):
+        """
+        Check if the remaining access count should be read again.
+        :return: True if the budget is enabled and was read on an earlier day or too long ago.
+        """
+        if not self._budget or API._budget_read_at is None:
+            return False
+
+        return (
+            API._budget_day != date.today()
+            or time.monotonic() - API._budget_read_at >= self._budget_refresh
+        )
+
+    def read_budget(self):
+        """
+        Read the remaining access count, and the part of it to reserve.
+        :return: A tuple of (budget, reserve). The budget is None if disabled or unreadable.
+        """
+        budget = self.get_access_count() if self._budget else None
+        API._budget_read_at = time.monotonic()
+        API._budget_day = date.today()
+        return budget, int(budget * self._budget_reserve) if budget else 0
+
+    def get_session(self):
+        """
+        Get the pooled session shared by all API instances, creating it on first use.
+        :return: A requests.Session with keep-alive connection pooling.
+        """
+        with API._session_lock:
+            if API._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self._pool_size,
+                    pool_maxsize=self._pool_size,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"Connection": "keep-alive"})
+                session.verify = False
+                # Certificates aren't verified, so don't warn on every request
+                urllib3.disable_warnings()
+                API._session = session
+                Debug.info("Created HTTP session with pool size %s", self._pool_size)
+
+            return API._session
+
     def md5c(self, text="", _type="lower"):
         res = hashlib.md5(text.encode(encoding="UTF-8")).hexdigest()
         if _type == "lower":
@@ -71,26 +213,60 @@ class API:
             return res.upper()
 
     def send_request(self):
+        """
+        Send the request over the shared session, retrying on 429/5xx responses
+        and connection errors with exponential backoff.
+        :return: The response from the API.
+        """
         url = self.get_url()
-        Debug.info(f"Requesting {url} with method {self._method} and params {self._params}")
+        Debug.info("Requesting %s with method %s and params %s", url, self._method, self._params)
         if self._method == "get":
-            response = requests.get(
-                url=url,
-                params=self._params,
-                headers=self.get_headers(),
-                verify=False
-            )
+            kwargs = {"params": self._params}
         elif self._method == "post":
-            response = requests.post(
-                url=url,
-                json=self._params,
-                headers=self.get_headers(),
-                verify=False
-            )
+            kwargs = {"json": self._params}
         else:
-            Debug.error(f"Invalid request method: {self._method}. Use 'get' or 'post'.")
+            Debug.error("Invalid request method: %s. Use 'get' or 'post'.", self._method)
 
-        return response
+        session = self.get_session()
+        attempt = 0
+        while True:
+            # The access count is only read to set up the scheduler, so it is not scheduled
+            if self._name != "user_get_access_count":
+                with Metrics.timer("schedule"):
+                    self.get_scheduler().acquire(self._name)
+
+            # Headers are regenerated each attempt as the signature is timestamped
+            with Metrics.timer("sign"):
+                headers = self.get_headers()
+
+            try:
+                with Metrics.timer("network"):
+                    response = session.request(
+                        self._method,
+                        url,
+                        headers=headers,
+                        timeout=self._timeout,
+                        **kwargs
+                    )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                Metrics.increment("requests", endpoint=self._endpoint, status="error")
+                if attempt >= self._retries:
+                    raise
+                delay = self.get_retry_delay(attempt)
+                Debug.warning("Request to %s failed (%s), retrying in %.2fs", url, e, delay)
+            else:
+                Metrics.increment("requests", endpoint=self._endpoint, status=response.status_code)
+                Metrics.increment("bytes_received", len(response.content), endpoint=self._endpoint)
+                if response.status_code not in self._retry_statuses or attempt >= self._retries:
+                    return response
+                delay = self.get_retry_delay(attempt, response)
+                Debug.warning(
+                    "Request to %s returned %s, retrying in %.2fs", url, response.status_code, delay
+                )
+
+            Metrics.increment("retries", endpoint=self._endpoint)
+            time.sleep(delay)
+            attempt += 1
 
     def set_name(self, name):
         """
@@ -100,6 +276,7 @@ class API:
         if not name:
             Debug.error("Data name cannot be empty.")
 
+        self._name = name
         match name:
             case "device_list":
                 self._endpoint = "device/list"
@@ -119,6 +296,9 @@ class API:
             case "device_generation":
                 self._endpoint = "device/generation"
                 self._method = "get"
+            case "device_real_query":
+                self._endpoint = "device/real/query"
+                self._method = "post"
             case "module_list":
                 self._endpoint = "module/list"
                 self._method = "post"
@@ -132,7 +312,7 @@ class API:
                 self._endpoint = "user/getAccessCount"
                 self._method = "get"
             case _:
-                Debug.error(f"Invalid data name: {name}.")
+                Debug.error("Invalid data name: %s.", name)
 
     def set_params(self, params):
         """
@@ -0,0 +1,139 @@
+# Global imports
+import aiohttp
+import asyncio
+import json
+import time
+import weakref
+
+# Local imports
+from api import API
+from debug import Debug
+from metrics import Metrics
+
+class AsyncResponse:
+    """
+    A response read in full, with the parts of requests.Response the rest of the code uses.
+    """
+
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncAPI(API):
+    """
+    The API client for asyncio. Signing, endpoints, retries and the request budget are shared with API.
+    """
+
+    # The maximum number of requests in flight per event loop, overridden by FOX_ASYNC_CONCURRENCY
+    _concurrency = 64
+
+    # The session and concurrency limit for each event loop, as aiohttp sessions can't be shared between loops
+    _sessions = weakref.WeakKeyDictionary()
+
+    def __init__(self, settings=None):
+        super().__init__(settings)
+        self._concurrency = self._settings.get_int("FOX_ASYNC_CONCURRENCY", self._concurrency)
+
+    @staticmethod
+    async def close():
+        """
+        Close the session of the running event loop, if one was opened.
+        """
+        state = AsyncAPI._sessions.pop(asyncio.get_running_loop(), None)
+        if state:
+            await state[0].close()
+
+    async def get_async_session(self):
+        """
+        Get the session and concurrency limit of the running event loop, creating them on first use.
+        :return: A tuple of (aiohttp.ClientSession, asyncio.Semaphore).
+        """
+        loop = asyncio.get_running_loop()
+        state = AsyncAPI._sessions.get(loop)
+        if state is None:
+            connector = aiohttp.TCPConnector(limit=self._concurrency, ssl=False)
+            state = (
+                aiohttp.ClientSession(connector=connector, headers={"Connection": "keep-alive"}),
+                asyncio.Semaphore(self._concurrency),
+            )
+            AsyncAPI._sessions[loop] = state
+            Debug.info("Created async HTTP session with concurrency %s", self._concurrency)
+
+        return state
+
+    async def schedule(self):
+        """
+        Wait for the shared scheduler to allow this request, without blocking the event loop.
+        :raises BudgetExhausted: If the budget does not allow the request.
+        """
+        # Creating the scheduler or refreshing its budget reads the access count with a blocking request
+        if API._scheduler is None or self.is_budget_stale():
+            scheduler = await asyncio.to_thread(self.get_scheduler)
+        else:
+            scheduler = API._scheduler
+        while True:
+            delay = scheduler.try_acquire(self._name)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    async def send_request(self):
+        """
+        Send the request over the event loop's session, retrying on 429/5xx responses
+        and connection errors with exponential backoff.
+        :return: An AsyncResponse.
+        """
+        url = self.get_url()
+        Debug.info("Requesting %s with method %s and params %s", url, self._method, self._params)
+        if self._method == "get":
+            kwargs = {"params": self._params}
+        elif self._method == "post":
+            kwargs = {"json": self._params}
+        else:
+            Debug.error("Invalid request method: %s. Use 'get' or 'post'.", self._method)
+
+        session, semaphore = await self.get_async_session()
+        timeout = aiohttp.ClientTimeout(total=self._timeout)
+        attempt = 0
+        while True:
+            if self._name != "user_get_access_count":
+                started = time.perf_counter()
+                await self.schedule()
+                Metrics.observe("schedule", time.perf_counter() - started)
+
+            # Headers are regenerated each attempt as the signature is timestamped
+            headers = self.get_headers()
+
+            try:
+                async with semaphore:
+                    started = time.perf_counter()
+                    async with session.request(
+                        self._method, url, headers=headers, timeout=timeout, **kwargs
+                    ) as raw:
+                        response = AsyncResponse(raw.status, raw.headers, await raw.read())
+                    Metrics.observe("network", time.perf_counter() - started)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                Metrics.increment("requests", endpoint=self._endpoint, status="error")
+                if attempt >= self._retries:
+                    raise
+                delay = self.get_retry_delay(attempt)
+                Debug.warning("Request to %s failed (%s), retrying in %.2fs", url, e, delay)
+            else:
+                Metrics.increment("requests", endpoint=self._endpoint, status=response.status_code)
+                Metrics.increment("bytes_received", len(response.content), endpoint=self._endpoint)
+                if response.status_code not in self._retry_statuses or attempt >= self._retries:
+                    return response
+                delay = self.get_retry_delay(attempt, response)
+                Debug.warning(
+                    "Request to %s returned %s, retrying in %.2fs", url, response.status_code, delay
+                )
+
+            Metrics.increment("retries", endpoint=self._endpoint)
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,149 @@
+# Global imports
+import aiohttp
+import asyncio
+import os
+import weakref
+
+# Local imports
+from async_api import AsyncAPI
+from cache import MemoryCache
+from data import Data
+from debug import Debug
+from errors import Errors, FoxError, RetryableError
+from metrics import Metrics
+from scheduler import BudgetExhausted
+
+class AsyncData(Data):
+    """
+    Data for asyncio. The cache, its file names and its TTLs are shared with Data, so either can
+    read what the other saved.
+    """
+
+    # Fetches in progress keyed by file path, per event loop, so concurrent gets share one request
+    _in_flight_async = weakref.WeakKeyDictionary()
+
+    async def fetch_data(self):
+        """
+        Fetch the data from the API. Only successful responses are saved.
+        :return: The response from the API as a dictionary.
+        :raises RetryableError: If the request may succeed if sent again later.
+        :raises PermanentError: If the request will keep failing.
+        """
+        Debug.info("Fetching data for %s", self.name)
+
+        api = AsyncAPI(self.settings)
+        api.set_name(self.name)
+        if self.args:
+            api.set_params(self.args)
+        try:
+            response = await api.send_request()
+        except BudgetExhausted:
+            # Queue the request so it can be resumed once the budget resets
+            self.defer()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            Metrics.increment("errors", name=self.name, kind="retryable")
+            raise RetryableError(f"Request for {self.name} failed: {e!r}", self.name) from e
+
+        with Metrics.timer("decode"):
+            try:
+                parsed = response.json()
+            except ValueError:
+                parsed = None
+
+        # Error payloads are never saved, so they can't be served from the cache later
+        try:
+            Errors.check_response(self.name, response.status_code, parsed)
+        except FoxError as e:
+            Metrics.increment("errors", name=self.name, kind="retryable" if e.retryable else "permanent")
+            if Errors.is_quota_spent(e):
+                self.defer()
+            raise
+
+        # File writes run on a thread so they don't stall other requests on the loop
+        await asyncio.to_thread(self.save_response_data, parsed, response.content)
+        file_path = self.get_file_path()
+        if os.path.exists(file_path):
+            MemoryCache.put(file_path, parsed, os.path.getsize(file_path), os.path.getmtime(file_path))
+
+        return parsed
+
+    async def get(self):
+        """
+        Get the specified data, checking first if it exists in memory or the data directory.
+        Concurrent gets for the same data on one event loop share one request.
+        :return: The response as a dictionary.
+        """
+        Debug.info("Getting data for %s", self.name)
+        if self.cache:
+            cached = MemoryCache.get(self.get_file_path())
+            if cached and self.is_fresh(cached[1]):
+                Metrics.increment("cache_hits", name=self.name, layer="memory")
+                return cached[0]
+
+        cached = await asyncio.to_thread(self.get_cached)
+        if cached is not None:
+            return cached
+
+        in_flight = AsyncData._in_flight_async.setdefault(asyncio.get_running_loop(), {})
+        key = self.get_file_path()
+        if key in in_flight:
+            Debug.info("Waiting for the request already in flight for %s", key)
+            Metrics.increment("coalesced", key=os.path.basename(key))
+            return await asyncio.shield(in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        in_flight[key] = future
+        try:
+            result = await self.fetch_data()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception retrieved, in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del in_flight[key]
+
+        return result
+
+    @staticmethod
+    async def map(func, items):
+        """
+        Await a coroutine function for each item concurrently, like Workers.map() does with threads.
+        Requests are limited by FOX_ASYNC_CONCURRENCY, and a failure for one item does not stop the others.
+        :param func: The coroutine function to call with each item.
+        :param items: The items to process.
+        :return: A tuple of (results, errors) dictionaries keyed by item. Errors are the exceptions raised.
+        """
+        items = list(items)
+        results = {}
+        errors = {}
+        if not items:
+            return results, errors
+
+        Debug.info("Processing %s items on one event loop", len(items))
+        outcomes = await asyncio.gather(*(func(item) for item in items), return_exceptions=True)
+        for item, outcome in zip(items, outcomes):
+            if isinstance(outcome, BaseException):
+                errors[item] = outcome
+                Debug.warning("Failed to process %s: %s", item, str(outcome) or type(outcome).__name__)
+            else:
+                results[item] = outcome
+        return results, errors
+
+    @staticmethod
+    def run(coroutine):
+        """
+        Run a coroutine on a new event loop from sync code, closing the loop's HTTP session afterwards.
+        :param coroutine: The coroutine to run.
+        :return: The coroutine's result.
+        """
+        async def main():
+            try:
+                return await coroutine
+            finally:
+                await AsyncAPI.close()
+
+        return asyncio.run(main())
@@ -0,0 +1,167 @@
+# Global imports
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+# Local imports
+from data import Data
+from debug import Debug
+from device import Device
+from errors import FoxError, PermanentError
+from retention import Retention
+from workers import Workers
+
+class Backfill:
+
+    # The queries that can be backfilled, and the function fetching one day of each.
+    # The FoxESS API limits a history query to 24 hours, so one day is one request.
+    queries = {
+        "device_history_query": Device.history_query,
+        "device_report_query": Device.report_query,
+    }
+
+    @staticmethod
+    def get_dates(start, end):
+        """
+        Get every day between two dates, inclusive.
+        :param start: The first day as a date or "YYYY-MM-DD" string.
+        :param end: The last day as a date or "YYYY-MM-DD" string.
+        :return: A list of "YYYY-MM-DD" strings.
+        """
+        if isinstance(start, str):
+            start = datetime.strptime(start, "%Y-%m-%d")
+        if isinstance(end, str):
+            end = datetime.strptime(end, "%Y-%m-%d")
+        if start > end:
+            Debug.error(
+                "Backfill start %s is after end %s.", start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+            )
+
+        return [
+            (start + timedelta(days=offset)).strftime("%Y-%m-%d")
+            for offset in range((end - start).days + 1)
+        ]
+
+    @staticmethod
+    def get_saved_dates(name, serial_numbers, dates=None):
+        """
+        Scan the data directory once for the days already saved for several devices.
+        Days saved before they ended are partial, so they are not counted.
+        :param name: The data name, e.g. "device_history_query".
+        :param serial_numbers: The serial numbers of the devices.
+        :param dates: The "YYYY-MM-DD" days of interest. Defaults to every day.
+        :return: A dictionary of serial number to a set of "YYYY-MM-DD" strings.
+        """
+        saved = {serial_number: set() for serial_number in serial_numbers}
+        data_dir = Data.get_data_dir()
+        if not os.path.isdir(data_dir):
+            return saved
+
+        dates = set(dates) if dates is not None else None
+        months = {date[:7] for date in dates} if dates is not None else None
+        pattern = re.compile(rf"^{re.escape(name)}_(.+)_(\d{{4}}-\d{{2}}-\d{{2}})\.json(\.gz)?$")
+        for file_name in os.listdir(data_dir):
+            match = pattern.match(file_name)
+            if match:
+                serial_number, date = match.group(1), match.group(2)
+                if serial_number not in saved or (dates is not None and date not in dates):
+                    continue
+                end_time = (Data.get_day(date).end_time + 1) / 1000
+                if os.path.getmtime(os.path.join(data_dir, file_name)) >= end_time:
+                    saved[serial_number].add(date)
+                continue
+            # Days compacted into a monthly archive are saved too, just downsampled
+            match = Retention.month_pattern.match(file_name)
+            if (
+                match
+                and name == "device_history_query"
+                and match.group(1) in saved
+                and (months is None or match.group(2) in months)
+            ):
+                saved[match.group(1)].update(Retention.read_month(os.path.join(data_dir, file_name)))
+
+        return saved
+
+    @staticmethod
+    def get_missing(name, serial_numbers, start, end):
+        """
+        Work out which days are missing for each device.
+        :param name: The data name, e.g. "device_history_query".
+        :param serial_numbers: The serial numbers of the devices.
+        :param start: The first day to check.
+        :param end: The last day to check.
+        :return: A list of (serial_number, date) tuples still to fetch.
+        """
+        dates = Backfill.get_dates(start, end)
+        saved = Backfill.get_saved_dates(name, serial_numbers, dates)
+        return [
+            (serial_number, date)
+            for serial_number in serial_numbers
+            for date in dates
+            if date not in saved[serial_number]
+        ]
+
+    @staticmethod
+    def run(name, start, end=None, serial_numbers=None, max_workers=None):
+        """
+        Fetch the missing days in a date range for one or more devices.
+        Each day is saved as soon as it is fetched, so an interrupted backfill
+        resumes from where it stopped when run again. A device whose request fails
+        permanently is not requested again in the same run.
+        :param name: "device_history_query" or "device_report_query".
+        :param start: The first day to backfill.
+        :param end: The last day to backfill. Defaults to yesterday.
+        :param serial_numbers: The serial numbers to backfill. Defaults to every device.
+        :param max_workers: The maximum number of concurrent requests.
+        :return: A dictionary with "results" and "errors" keyed by (serial_number, date).
+        """
+        if name not in Backfill.queries:
+            Debug.error("Invalid backfill data name: %s. Valid names are: %s", name, ', '.join(Backfill.queries))
+
+        if not end:
+            end = datetime.now() - timedelta(days=1)
+        if not serial_numbers:
+            serial_numbers = Device.serials()
+
+        missing = Backfill.get_missing(name, serial_numbers, start, end)
+        Debug.info("Backfilling %s missing days of %s for %s devices", len(missing), name, len(serial_numbers))
+
+        # A permanent failure for one day of a device would recur for its other days,
+        # so stop spending requests on that device
+        query = Backfill.queries[name]
+        failed = {}
+        failed_lock = threading.Lock()
+
+        def check(task, error=None):
+            serial_number = task[0]
+            if error is None and serial_number in failed:
+                raise PermanentError(f"Skipped after an earlier failure: {failed[serial_number]}", name)
+            if error is not None and not error.retryable:
+                with failed_lock:
+                    failed.setdefault(serial_number, error)
+
+        def fetch(task):
+            check(task)
+            try:
+                return query(*task)
+            except FoxError as e:
+                check(task, e)
+                raise
+
+        async def fetch_async(task):
+            check(task)
+            try:
+                return await AsyncData(name, Device.get_params(name.removeprefix("device_"), *task)).get()
+            except FoxError as e:
+                check(task, e)
+                raise
+
+        if Workers.use_async():
+            # Imported here so the thread path works without aiohttp installed
+            from async_data import AsyncData
+
+            results, errors = AsyncData.run(AsyncData.map(fetch_async, missing))
+        else:
+            results, errors = Workers.map(fetch, missing, max_workers)
+        return {"results": results, "errors": errors}
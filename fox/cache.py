@@ -0,0 +1,83 @@
+# Global imports
+import threading
+from collections import OrderedDict
+
+# Local imports
+from settings import Settings
+
+class MemoryCache:
+
+    # Parsed responses keyed by file path, least recently used first
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+    _max_bytes = None
+    _size = 0
+
+    @staticmethod
+    def clear():
+        """
+        Remove every entry from the cache.
+        """
+        with MemoryCache._lock:
+            MemoryCache._entries.clear()
+            MemoryCache._size = 0
+
+    @staticmethod
+    def get(key):
+        """
+        Get an entry from the cache, marking it as recently used.
+        :param key: The cache key, usually the data file path.
+        :return: A tuple of (value, stored_at), or None if the key is not cached.
+        """
+        with MemoryCache._lock:
+            entry = MemoryCache._entries.get(key)
+            if entry is None:
+                return None
+            MemoryCache._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    @staticmethod
+    def get_max_bytes():
+        """
+        Get the maximum size of the cache, from FOX_MEMORY_CACHE_BYTES.
+        :return: The size in bytes as an integer.
+        """
+        if MemoryCache._max_bytes is None:
+            MemoryCache._max_bytes = Settings.load().get_int("FOX_MEMORY_CACHE_BYTES", 64 * 1024 * 1024)
+
+        return MemoryCache._max_bytes
+
+    @staticmethod
+    def invalidate(key):
+        """
+        Remove an entry from the cache.
+        :param key: The cache key, usually the data file path.
+        """
+        with MemoryCache._lock:
+            entry = MemoryCache._entries.pop(key, None)
+            if entry is not None:
+                MemoryCache._size -= entry[2]
+
+    @staticmethod
+    def put(key, value, size, stored_at):
+        """
+        Add an entry to the cache, evicting the least recently used entries to make room.
+        :param key: The cache key, usually the data file path.
+        :param value: The parsed response.
+        :param size: The approximate size of the entry in bytes, usually the file size.
+        :param stored_at: When the value was saved, as a timestamp.
+        """
+        max_bytes = MemoryCache.get_max_bytes()
+        if size > max_bytes:
+            return
+
+        with MemoryCache._lock:
+            previous = MemoryCache._entries.pop(key, None)
+            if previous is not None:
+                MemoryCache._size -= previous[2]
+
+            MemoryCache._entries[key] = (value, stored_at, size)
+            MemoryCache._size += size
+            while MemoryCache._size > max_bytes:
+                _, evicted = MemoryCache._entries.popitem(last=False)
+                MemoryCache._size -= evicted[2]
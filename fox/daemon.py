@@ -0,0 +1,189 @@
+# Global imports
+import fcntl
+import importlib.util
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Local imports
+from backfill import Backfill
+from data import Data
+from debug import Debug
+from device import Device
+from metrics import Metrics
+from realtime import Realtime
+from retention import Retention
+from settings import Settings
+
+class Daemon:
+
+    # The default interval for each job, in seconds. FOX_DAEMON_<JOB>_INTERVAL overrides these.
+    intervals = {
+        "history": 86400,
+        "report": 86400,
+        "generation": 300,
+        "myenergi": 86400,
+        "realtime": 60,
+        "compact": 86400,
+        "resume": 3600,
+    }
+
+    # Jobs only run when named, as polling a fleet every minute spends the request budget fast
+    # and compacting removes raw history
+    optional_jobs = ("realtime", "compact")
+
+    # The myenergi client, loaded by path as it lives outside the fox directory
+    myenergi_client = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "myenergi", "client.py"
+    )
+
+    def __init__(self, jobs=None):
+        """
+        Initialize the daemon.
+        :param jobs: The names of the jobs to run. Defaults to every job.
+        """
+        settings = Settings.load()
+        jobs = jobs or [job for job in self.intervals if job not in self.optional_jobs]
+        for job in jobs:
+            if job not in self.intervals:
+                Debug.error("Invalid daemon job: %s. Valid jobs are: %s", job, ', '.join(self.intervals))
+
+        # Days to look back for missing history and reports on each run
+        self.backfill_days = settings.get_int("FOX_DAEMON_BACKFILL_DAYS", 7)
+
+        self._jobs = {
+            job: {
+                "interval": settings.get_int(f"FOX_DAEMON_{job.upper()}_INTERVAL", self.intervals[job]),
+                "lock": threading.Lock(),
+                "next": time.monotonic(),
+            }
+            for job in jobs
+        }
+        self._myenergi = None
+        self._realtime = None
+        self._stop = threading.Event()
+
+    def get_myenergi(self):
+        """
+        Get the myenergi client, creating it on first use so its session is reused between runs.
+        :return: The myenergi Client instance.
+        """
+        if self._myenergi is None:
+            spec = importlib.util.spec_from_file_location("myenergi_client", self.myenergi_client)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._myenergi = module.Client()
+
+        return self._myenergi
+
+    def run(self):
+        """
+        Run the jobs on their intervals until SIGINT or SIGTERM is received.
+        Running jobs are allowed to finish before the daemon exits.
+        """
+        lock_file = self.lock()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        Debug.info("Daemon started with jobs: %s", ', '.join(self._jobs))
+
+        with ThreadPoolExecutor(max_workers=len(self._jobs)) as executor:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                for job, state in self._jobs.items():
+                    if state["next"] <= now:
+                        state["next"] = now + state["interval"]
+                        executor.submit(self.run_job, job)
+
+                next_run = min(state["next"] for state in self._jobs.values())
+                self._stop.wait(max(next_run - time.monotonic(), 0))
+
+            Debug.info("Daemon stopping, waiting for running jobs to finish")
+
+        lock_file.close()
+        Debug.info("Daemon stopped")
+
+    def lock(self):
+        """
+        Take an exclusive lock in the data directory, so only one daemon runs at a time.
+        :return: The open lock file, which holds the lock until closed.
+        """
+        data_dir = Data.get_data_dir()
+        os.makedirs(data_dir, exist_ok=True)
+        lock_file = open(os.path.join(data_dir, "daemon.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            Debug.error("Another daemon is already running.")
+
+        return lock_file
+
+    def run_job(self, job):
+        """
+        Run a job once, unless the previous run of the same job is still going.
+        :param job: The name of the job.
+        """
+        state = self._jobs[job]
+        if not state["lock"].acquire(blocking=False):
+            Debug.warning("Skipping %s, the previous run has not finished", job)
+            return
+
+        started = time.monotonic()
+        try:
+            Debug.info("Running %s", job)
+            match job:
+                case "history":
+                    self.run_backfill("device_history_query")
+                case "report":
+                    self.run_backfill("device_report_query")
+                case "generation":
+                    fleet = Device.fleet("generation")
+                    for serial_number, error in fleet["errors"].items():
+                        Debug.warning("Generation failed for %s: %s", serial_number, error)
+                case "myenergi":
+                    end = datetime.now() - timedelta(days=1)
+                    start = end - timedelta(days=self.backfill_days - 1)
+                    _, errors = self.get_myenergi().backfill(start, end)
+                    for (device, date), error in errors.items():
+                        Debug.warning("myenergi failed for %s %s: %s", device, date, error)
+                case "realtime":
+                    # Keep the open logs between runs, so each poll only appends
+                    if self._realtime is None:
+                        self._realtime = Realtime()
+                    self._realtime.poll_all()
+                case "resume":
+                    # Send requests deferred while the budget was spent, once it has been refreshed
+                    results, errors = Data.resume()
+                    if results or errors:
+                        Debug.info("Resumed %s deferred requests, %s failed", len(results), len(errors))
+                case "compact":
+                    _, errors = Retention().compact()
+                    for (serial_number, month), error in errors.items():
+                        Debug.warning("Compacting %s %s failed: %s", serial_number, month, error)
+        except (Exception, SystemExit) as e:
+            # A failed run must not take the daemon down; the job runs again next interval
+            Debug.warning("Job %s failed: %s", job, e)
+        finally:
+            state["lock"].release()
+            Debug.info("Finished %s in %.2fs", job, time.monotonic() - started)
+            Metrics.write()
+
+    def run_backfill(self, name):
+        """
+        Fetch any days missing from the last few days, up to yesterday.
+        :param name: "device_history_query" or "device_report_query".
+        """
+        end = datetime.now() - timedelta(days=1)
+        start = end - timedelta(days=self.backfill_days - 1)
+        backfill = Backfill.run(name, start, end)
+        for (serial_number, date), error in backfill["errors"].items():
+            Debug.warning("%s failed for %s %s: %s", name, serial_number, date, error)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Ask the daemon to stop after the running jobs finish.
+        """
+        Debug.info("Received signal %s", signum)
+        self._stop.set()
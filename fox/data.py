@@ -1,17 +1,23 @@
 # Global imports
+import gzip
 import json
 import os
-import requests
 import sys
+import tempfile
+import threading
 import time
 from collections import namedtuple
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
 from json import JSONDecodeError
 
 # Local imports
-from api import API
+from cache import MemoryCache
 from debug import Debug
+from errors import Errors, FoxError, RetryableError
+from metrics import Metrics
+from scheduler import BudgetExhausted
+from settings import Settings
+from workers import Workers
 
 class Data:
 
@@ -19,6 +25,42 @@ class Data:
     cache = True
     data_dir = None
     name = None
+    storage_format = "json"
+
+    # The file extension for each storage format
+    storage_formats = {
+        "json": ".json",
+        "gzip": ".json.gz",
+    }
+
+    # How long saved data stays valid, in seconds, by data name.
+    # None never expires and 0 always revalidates. History and reports saved
+    # after their day ended never change, so they use closed_ttl instead.
+    cache_ttls = {
+        'device_list': 86400,
+        'device_detail': 86400,
+        'device_variable_get': 604800,
+        'device_history_query': 900,
+        'device_report_query': 900,
+        'device_generation': 60,
+        'device_real_query': 0,
+        'module_list': 86400,
+        'plant_list': 86400,
+        'plant_detail': 86400,
+        'user_get_access_count': 0,
+    }
+    closed_ttl = None
+
+    # Fetches in progress keyed by file path, so concurrent requests for the same data share one
+    _in_flight = {}
+    _in_flight_lock = threading.Lock()
+
+    # The queue of requests deferred until the budget resets
+    pending_file = "pending.jsonl"
+    _pending_lock = threading.Lock()
+
+    # Snapshots that a later poll replaces, so there is no point sending them once the budget resets
+    snapshot_names = ("device_generation", "device_real_query")
 
     # Specify the list of valid data names
     valid_data_names = [
@@ -28,20 +70,20 @@ class Data:
         'device_history_query',
         'device_report_query',
         'device_generation',
+        'device_real_query',
         'module_list',
         'plant_list',
         'plant_detail',
         'user_get_access_count',
     ]
 
-    def __init__(self, name=None, args=None):
-        # Load environment variables from .env file
-        load_dotenv()
+    def __init__(self, name=None, args=None, settings=None):
+        # The settings are read once per process unless given
+        self.settings = settings or Settings.load()
 
-        # Get the directory for saving data
-        self.data_dir = os.getenv(
-            "FOX_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
-        )
+        # Get the directory and format for saving data
+        self.data_dir = Data.get_data_dir(self.settings)
+        self.set_storage_format(self.settings.get("FOX_DATA_FORMAT", self.storage_format))
 
         # Ensure we have a name to work with
         if not name:
@@ -50,54 +92,190 @@ class Data:
 
         # Validate the data name
         if not self.is_valid_data_name(name):
-            Debug.error(f"Invalid data name: {name}. Valid names are: {', '.join(self.valid_data_names)}")
+            Debug.error("Invalid data name: %s. Valid names are: %s", name, ', '.join(self.valid_data_names))
             return
 
         # Set the name and args
         self.name = name
         self.args = args if args else {}
 
+    def defer(self):
+        """
+        Add this request to the pending queue in the data directory. Snapshots are not queued.
+        """
+        if self.name in self.snapshot_names:
+            Debug.info("Not deferring %s, the next poll replaces it", self.name)
+            return
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        with Data._pending_lock:
+            with open(os.path.join(self.data_dir, self.pending_file), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"name": self.name, "args": self.args}) + "\n")
+        Debug.info("Deferred %s with %s", self.name, self.args)
+
     def disable_cache(self):
         """
         Disable caching for the data retrieval.
         """
         self.cache = False
-        Debug.warning(f"Cache disabled for {self.name}")
+        Debug.warning("Cache disabled for %s", self.name)
 
     def fetch_data(self):
         """
-        Fetch the data from the API.
+        Fetch the data from the API. Only successful responses are saved.
         :return: The response from the API as a dictionary.
+        :raises RetryableError: If the request may succeed if sent again later.
+        :raises PermanentError: If the request will keep failing.
         """
-        Debug.info(f"Fetching data for {self.name}")
+        Debug.info("Fetching data for %s", self.name)
+
+        # The HTTP client is imported on first fetch, so commands served from the cache start quickly
+        import requests
+        from api import API
 
-        # Create an API instance
-        api = API()
+        api = API(self.settings)
         api.set_name(self.name)
         if self.args:
             api.set_params(self.args)
         try:
             response = api.send_request()
+        except BudgetExhausted:
+            # Queue the request so it can be resumed once the budget resets
+            self.defer()
+            raise
         except requests.exceptions.RequestException as e:
-            Debug.error(f"Request failed: {e}")
-            return None
+            Metrics.increment("errors", name=self.name, kind="retryable")
+            raise RetryableError(f"Request for {self.name} failed: {e}", self.name) from e
+
+        # Parse once, and save the raw bytes rather than re-encoding the parsed response
+        with Metrics.timer("decode"):
+            try:
+                parsed = response.json()
+            except ValueError:
+                parsed = None
+
+        # Error payloads are never saved, so they can't be served from the cache later
+        try:
+            Errors.check_response(self.name, response.status_code, parsed)
+        except FoxError as e:
+            Metrics.increment("errors", name=self.name, kind="retryable" if e.retryable else "permanent")
+            if Errors.is_quota_spent(e):
+                self.defer()
+            raise
 
-        self.save_response_data(response.json())
+        self.save_response_data(parsed, response.content)
 
-        return response.json() if response else None
+        # Keep the response in memory so later calls don't re-read the file
+        file_path = self.get_file_path()
+        if os.path.exists(file_path):
+            MemoryCache.put(file_path, parsed, os.path.getsize(file_path), os.path.getmtime(file_path))
+
+        return parsed
 
     def get(self):
         """
         Get the specified data, checking first if it exists in the data directory.
         """
-        Debug.info(f"Getting data for {self.name}")
-        Debug.info(f"Cache enabled: {self.cache}")
-        if self.cache and self.has_saved_data():
-            Debug.info(f"Using existing data for {self.name}")
-            return self.get_saved_data()
+        Debug.info("Getting data for %s", self.name)
+        cached = self.get_cached()
+        if cached is not None:
+            return cached
+
+        return Data.single_flight(self.get_file_path(), self.fetch_fresh_data)
+
+    def fetch_fresh_data(self):
+        """
+        Fetch the data from the API, unless another request saved it since get() checked the cache.
+        :return: The response from the API as a dictionary.
+        """
+        if self.cache:
+            cached = MemoryCache.get(self.get_file_path())
+            if cached and self.is_fresh(cached[1]):
+                return cached[0]
 
         return self.fetch_data()
 
+    def get_cached(self):
+        """
+        Get the specified data from memory or the data directory, if a valid copy is saved.
+        :return: The saved response as a dictionary, or None if caching is disabled or nothing valid is saved.
+        """
+        Debug.debug("Cache enabled: %s", self.cache)
+        if self.cache:
+            cached = MemoryCache.get(self.get_file_path())
+            if cached and self.is_fresh(cached[1]):
+                Debug.info("Using in-memory data for %s", self.name)
+                Metrics.increment("cache_hits", name=self.name, layer="memory")
+                return cached[0]
+
+            if self.has_saved_data():
+                with Metrics.timer("read"):
+                    saved = self.get_saved_data()
+                # Files saved before responses were checked may hold an error payload
+                if saved.get("errno", 0) == 0:
+                    Debug.info("Using existing data for %s", self.name)
+                    Metrics.increment("cache_hits", name=self.name, layer="disk")
+                    return saved
+                Debug.warning("Ignoring saved error response for %s: errno %s", self.name, saved.get("errno"))
+                self.invalidate()
+
+            compacted = self.get_compacted()
+            if compacted is not None:
+                Debug.info("Using compacted data for %s", self.name)
+                Metrics.increment("cache_hits", name=self.name, layer="archive")
+                return compacted
+
+        Metrics.increment("cache_misses", name=self.name)
+        return None
+
+    def get_cache_ttl(self, stored_at=None):
+        """
+        Get how long saved data stays valid. FOX_CACHE_TTL_<NAME> overrides the
+        default, either in seconds or as "never".
+        :param stored_at: When the data was saved, as a timestamp. Defaults to now.
+        :return: The TTL in seconds, None to never expire, or 0 to always revalidate.
+        """
+        override = self.settings.get(f"FOX_CACHE_TTL_{self.name.upper()}")
+        if override:
+            return None if override.lower() == "never" else int(override)
+
+        if self.is_closed(stored_at):
+            return self.closed_ttl
+
+        return self.cache_ttls.get(self.name, 0)
+
+    def get_compacted(self):
+        """
+        Get history for a day whose raw samples were compacted into a monthly archive.
+        :return: The downsampled response as a dictionary, or None if the day isn't compacted.
+        """
+        if self.name != "device_history_query" or not self.args.get("sn"):
+            return None
+
+        # Most misses have no archive, so don't pay for importing the retention code to find out
+        date = datetime.fromtimestamp(self.args.get("begin", 0) / 1000).strftime("%Y-%m-%d")
+        file_path = Data.get_archive_path(self.args["sn"], date[:7], self.data_dir)
+        if not os.path.exists(file_path):
+            return None
+
+        # Imported here as the archives are built from saved Data
+        from retention import Retention
+
+        return Retention.read_day(self.args["sn"], date, file_path)
+
+    @staticmethod
+    def get_archive_path(serial_number, month, data_dir=None):
+        """
+        Get the path of a device's monthly history archive, as written by Retention.
+        :param serial_number: The serial number of the device.
+        :param month: The month as a "YYYY-MM" string.
+        :param data_dir: The data directory. Defaults to FOX_DATA_DIR.
+        :return: The file path as a string.
+        """
+        return os.path.join(
+            data_dir or Data.get_data_dir(), f"device_history_query_{serial_number}_{month}.compact.json.gz"
+        )
+
     def get_file_name(self):
         """
         Get the file name for the specified data.
@@ -105,8 +283,13 @@ class Data:
         """
         file_name = self.name
         match self.name:
+            # Add the page to the file name. The full listing has no page.
+            case "device_list" | "module_list" | "plant_list":
+                if "currentPage" in self.args:
+                    file_name = f"{self.name}_{self.args['currentPage']}_{self.args.get('pageSize', 10)}"
+
             # Add the serial number to the file name.
-            case "device_detail" | "device_generation":
+            case "device_detail" | "device_generation" | "device_real_query":
                 if "sn" in self.args:
                     file_name = f"{self.name}_{self.args['sn']}"
 
@@ -149,54 +332,170 @@ class Data:
 
         return file_name + ".json"
 
+    def get_file_path(self, storage_format=None):
+        """
+        Get the full path of the file for the specified data.
+        :param storage_format: The storage format. Defaults to the format set for this data.
+        :return: The file path as a string.
+        """
+        extension = self.storage_formats[storage_format or self.storage_format]
+        return os.path.join(self.data_dir, self.get_file_name().removesuffix(".json") + extension)
+
     def get_saved_data(self):
         """
         Get the saved data from the specified file in the data directory.
         :param name: The name of the file to read (without the 'data/' prefix).
         :return: The content of the file as a dictionary.
         """
-        file_path = os.path.join(self.data_dir, self.get_file_name())
-        contents = open(file_path, "r", encoding="utf-8")
-        parsed = json.load(contents)
-        contents.close()
-        return parsed["response"]
+        file_path = self.get_saved_file_path()
+        response = Data.read_file(file_path)
+        MemoryCache.put(
+            self.get_file_path(),
+            response,
+            os.path.getsize(file_path),
+            os.path.getmtime(file_path),
+        )
+        return response
+
+    def get_saved_response(self):
+        """
+        Read the saved data without checking whether it has expired, from its file or the monthly archive.
+        :return: The saved response as a dictionary, or None if nothing is saved.
+        """
+        file_path = self.get_saved_file_path()
+        if file_path:
+            return Data.read_file(file_path)
+
+        return self.get_compacted()
+
+    def get_saved_file_path(self):
+        """
+        Find the saved file for the specified data, in any storage format.
+        The file in the format set for this data is preferred.
+        :return: The file path as a string, or None if no file is saved.
+        """
+        storage_formats = [self.storage_format] + [
+            storage_format for storage_format in self.storage_formats if storage_format != self.storage_format
+        ]
+        for storage_format in storage_formats:
+            file_path = self.get_file_path(storage_format)
+            if os.path.exists(file_path):
+                return file_path
+
+        return None
 
     @staticmethod
-    def get_yesterday():
+    def get_data_dir(settings=None):
         """
-        Get the begin and end time of yesterday in milliseconds.
-        :return: a named tuple with begin_time and end_time
+        Get the directory for saving data.
+        :param settings: The Settings to use. Defaults to the process's settings.
+        :return: The directory path as a string.
         """
-        now = datetime.now()
-        today_tup = (
-            now.year,
-            now.month,
-            now.day,
-            0,
-            0,
-            0,
-            now.weekday(),
-            now.timetuple().tm_yday,
-            now.timetuple().tm_isdst,
+        return (settings or Settings.load()).get(
+            "FOX_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
         )
-        today = time.mktime(today_tup)
-        yesterday = today - 86400  # 24 hours before today
-        begin_time = int(yesterday * 1000)  # Convert to milliseconds
+
+    @staticmethod
+    def get_myenergi_data_dir(settings=None):
+        """
+        Get the directory the myenergi script saves data to.
+        :param settings: The Settings to use. Defaults to the process's settings.
+        :return: The directory path as a string.
+        """
+        return (settings or Settings.load()).get("MYENERGI_DATA_DIR") or os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "myenergi", "data"
+        )
+
+    @staticmethod
+    def get_day(date):
+        """
+        Get the begin and end time of a day in milliseconds.
+        :param date: The day as a date, datetime or "YYYY-MM-DD" string.
+        :return: a named tuple with begin_time and end_time
+        """
+        if isinstance(date, str):
+            date = datetime.strptime(date, "%Y-%m-%d")
+        day = time.mktime((date.year, date.month, date.day, 0, 0, 0, 0, 0, -1))
+        begin_time = int(day * 1000)  # Convert to milliseconds
         end_time = begin_time + 86399999  # 24 hours in milliseconds minus 1 millisecond
         file_string = datetime.fromtimestamp(begin_time / 1000).strftime("%Y-%m-%d")
         return namedtuple("Time", ["begin_time", "end_time", "file_string"])(
             begin_time, end_time, file_string
         )
 
+    @staticmethod
+    def get_yesterday():
+        """
+        Get the begin and end time of yesterday in milliseconds.
+        :return: a named tuple with begin_time and end_time
+        """
+        return Data.get_day(datetime.now() - timedelta(days=1))
+
     def has_saved_data(self):
         """
-        Check if the specified data file exists in the data directory.
+        Check if the specified data file exists in the data directory and is still valid.
         :param name: The name of the file to check (without the 'data/' prefix).
-        :return: True if the file exists, False otherwise.
+        :return: True if the file exists and has not expired, False otherwise.
+        """
+        file_path = self.get_saved_file_path()
+        Debug.debug("Checking if data file exists: %s", file_path)
+        if not file_path:
+            return False
+
+        return self.is_fresh(os.path.getmtime(file_path))
+
+    def invalidate(self):
+        """
+        Remove the saved data from memory and the data directory, so the next get() fetches it.
+        """
+        from manifest import Manifest
+
+        MemoryCache.invalidate(self.get_file_path())
+        for storage_format in self.storage_formats:
+            file_path = self.get_file_path(storage_format)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                Manifest(self.data_dir).remove(file_path)
+        Debug.info("Invalidated %s", self.get_file_name())
+
+    def get_end_time(self):
         """
-        file_path = os.path.join(self.data_dir, self.get_file_name())
-        Debug.info(f"Checking if data file exists: {file_path}")
-        return os.path.exists(file_path)
+        Get when the day the data covers ends.
+        :return: The end as a timestamp, or None if the data doesn't cover a day.
+        """
+        match self.name:
+            case "device_history_query":
+                return (self.args.get("end", 0) + 1) / 1000
+            case "device_report_query":
+                day = datetime(self.args.get("year"), self.args.get("month"), self.args.get("day"))
+                return (day + timedelta(days=1)).timestamp()
+
+        return None
+
+    def is_closed(self, stored_at=None):
+        """
+        Check if the data was saved after the day it covers ended, so it can no longer change.
+        Data saved during the day is partial, however old the day is now.
+        :param stored_at: When the data was saved, as a timestamp. Defaults to now.
+        :return: True for history and reports saved after their day, False otherwise.
+        """
+        end_time = self.get_end_time()
+        if end_time is None:
+            return False
+
+        return (time.time() if stored_at is None else stored_at) >= end_time
+
+    def is_fresh(self, stored_at):
+        """
+        Check if data saved at the given time is still valid.
+        :param stored_at: When the data was saved, as a timestamp.
+        :return: True if the data has not expired, False otherwise.
+        """
+        ttl = self.get_cache_ttl(stored_at)
+        if ttl is None:
+            return True
+
+        return time.time() - stored_at < ttl
 
     def is_valid_data_name(self,name):
         """
@@ -209,25 +508,141 @@ class Data:
         if name in self.valid_data_names:
             return True
         else:
-            Debug.error(f"Invalid data name: {name}. Valid names are: {', '.join(self.valid_data_names)}")
+            Debug.error("Invalid data name: %s. Valid names are: %s", name, ', '.join(self.valid_data_names))
             return False
 
-    def save_response_data(self, response):
+    @staticmethod
+    def read_file(file_path):
+        """
+        Read a saved data file in any storage format.
+        :param file_path: The path of the file.
+        :return: The saved response as a dictionary.
+        """
+        opener = gzip.open if file_path.endswith(".gz") else open
+        with opener(file_path, "rt", encoding="utf-8") as contents:
+            parsed = json.load(contents)
+        return parsed["response"]
+
+    @staticmethod
+    def resume(max_workers=None):
+        """
+        Send the requests queued by defer(), once each. Requests that fail again are re-queued.
+        :param max_workers: The maximum number of concurrent requests.
+        :return: A tuple of (results, errors) dictionaries keyed by queue position.
+        """
+        file_path = os.path.join(Data.get_data_dir(), Data.pending_file)
+        with Data._pending_lock:
+            if not os.path.exists(file_path):
+                return {}, {}
+            with open(file_path, "r", encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            os.remove(file_path)
+
+        # The same request may have been deferred by several runs, so send it once
+        pending = [json.loads(line) for line in dict.fromkeys(line.strip() for line in lines)]
+
+        Debug.info("Resuming %s deferred requests", len(pending))
+        return Workers.map(
+            lambda index: Data(pending[index]["name"], pending[index]["args"]).get(),
+            range(len(pending)),
+            max_workers,
+        )
+
+    @staticmethod
+    def single_flight(key, func):
+        """
+        Call a function, sharing the call with any other thread already calling it for the same key.
+        The first caller runs the function; callers arriving while it runs wait and get its result.
+        :param key: The key identifying the call, usually the data file path.
+        :param func: The function to call.
+        :return: The function's result.
+        """
+        with Data._in_flight_lock:
+            call = Data._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                Data._in_flight[key] = call
+
+        if not leader:
+            Debug.info("Waiting for the request already in flight for %s", key)
+            Metrics.increment("coalesced", key=os.path.basename(key))
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func()
+        except BaseException as e:
+            # Debug.error() exits, so waiting callers need to see SystemExit too
+            call["error"] = e
+            raise
+        finally:
+            with Data._in_flight_lock:
+                del Data._in_flight[key]
+            call["done"].set()
+
+        return call["result"]
+
+    def save_response_data(self, response, raw=None):
         """
         Save the response data to a file in the data directory.
+        The file is written to a temporary file and renamed into place, so a
+        crash never leaves a partly written file behind.
         :param response: The response from the API as a dictionary.
+        :param raw: The raw JSON response body, saved as-is when provided.
         """
-        file = self.get_file_name()
-        file_path = os.path.join(self.data_dir, file)
-        if not os.path.exists(self.data_dir):
-            os.makedirs(self.data_dir)
+        file_path = self.get_file_path()
+        os.makedirs(self.data_dir, exist_ok=True)
+        if raw is not None:
+            payload = b'{"response":' + raw + b'}'
+        else:
+            payload = json.dumps(
+                {"response": response}, ensure_ascii=False, separators=(",", ":")
+            ).encode("utf-8")
+        if self.storage_format == "gzip":
+            payload = gzip.compress(payload, mtime=0)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.data_dir, prefix=".", suffix=".tmp")
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump({"response": response}, f, ensure_ascii=False, indent=4)
-            Debug.info(f"Data saved to {file_path}")
+            with Metrics.timer("write"), os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, file_path)
+            Metrics.increment("bytes_written", len(payload), name=self.name)
+            Debug.info("Data saved to %s", file_path)
         except (IOError, JSONDecodeError) as e:
-            Debug.error(f"Failed to save data to {file_path}: {e}")
-            return None
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise FoxError(f"Failed to save data to {file_path}: {e}", self.name) from e
+
+        # Imported here as the manifest describes files by their Data names
+        from manifest import Manifest
+
+        manifest = Manifest(self.data_dir)
+        manifest.record(file_path, payload)
+
+        # Remove copies saved in other formats so they can't go stale
+        for storage_format in self.storage_formats:
+            other_path = self.get_file_path(storage_format)
+            if other_path != file_path and os.path.exists(other_path):
+                os.remove(other_path)
+                manifest.remove(other_path)
+
+    def set_storage_format(self, storage_format):
+        """
+        Set the format used to save data.
+        :param storage_format: "json" for plain JSON or "gzip" for gzip-compressed JSON.
+        """
+        if storage_format not in self.storage_formats:
+            Debug.error(
+                "Invalid storage format: %s. Valid formats are: %s",
+                storage_format,
+                ", ".join(self.storage_formats),
+            )
+
+        self.storage_format = storage_format
 
     def set_params(self, params):
         """
@@ -235,4 +650,4 @@ class Data:
         :param params: A dictionary containing the parameters.
         """
         self.args = params
-        Debug.info(f"Parameters set for {self.name}: {self.args}")
+        Debug.debug("Parameters set for %s: %s", self.name, self.args)
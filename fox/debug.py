@@ -1,42 +1,135 @@
 # Global imports
-import os
+import json
 import sys
-from dotenv import load_dotenv
+import threading
+import time
+
+# Local imports
+from settings import Settings
 
 class Debug:
+
+    # Log levels, from most to least verbose
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    level_names = {
+        "debug": DEBUG,
+        "info": INFO,
+        "warning": WARNING,
+        "error": ERROR,
+    }
+
+    # Fields that must never be logged in plaintext
+    secret_fields = ("key", "signature", "token")
+
+    # The resolved configuration. The level is None until configure() runs.
+    _json = False
+    _level = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def configure(level=None, log_format=None):
+        """
+        Resolve the logging configuration. This runs once, on first use, unless called directly.
+        LOG_LEVEL sets the level; without it, DEBUG=true logs from "info" and anything else logs nothing.
+        LOG_FORMAT=json emits one JSON object per line instead of text.
+        :param level: The level name, overriding LOG_LEVEL.
+        :param log_format: "text" or "json", overriding LOG_FORMAT.
+        """
+        settings = Settings.load()
+        level = level or settings.get("LOG_LEVEL")
+        if not level and settings.get_bool("DEBUG"):
+            level = "info"
+
+        # Logging is off unless a level is set
+        Debug._level = Debug.level_names.get(level.lower(), Debug.INFO) if level else Debug.ERROR + 1
+        Debug._json = (log_format or settings.get("LOG_FORMAT", "text")).lower() == "json"
+
+    @staticmethod
+    def enabled(level):
+        """
+        Check if messages at a level are logged, to guard building expensive arguments.
+        :param level: The level, e.g. Debug.INFO.
+        :return: True if the level is logged, False otherwise.
+        """
+        if Debug._level is None:
+            Debug.configure()
+        return level >= Debug._level
+
+    @staticmethod
+    def log(level, name, message, args, fields):
+        """
+        Format and print a message, if its level is enabled.
+        The message is only formatted with its arguments once it is known to be logged.
+        :param level: The level of the message.
+        :param name: The level name to print.
+        :param message: The message, with %-style placeholders for args.
+        :param args: The values for the placeholders.
+        :param fields: Extra structured fields to log with the message.
+        """
+        if Debug._level is None:
+            Debug.configure()
+        if level < Debug._level:
+            return
+
+        if args:
+            message = message % args
+        for field in Debug.secret_fields:
+            if field in fields:
+                fields[field] = "***"
+
+        if Debug._json:
+            line = json.dumps(
+                {"time": round(time.time(), 3), "level": name, "message": message, **fields},
+                ensure_ascii=False,
+                default=str,
+            )
+        else:
+            line = f"{name.upper()}: {message}" + "".join(f" {key}={value}" for key, value in fields.items())
+
+        with Debug._lock:
+            print(line)
+
     @staticmethod
     def on():
         """
-        Print debug information if debug mode is enabled.
+        Check if debug mode is enabled.
+        """
+        return Debug.enabled(Debug.INFO)
+
+    @staticmethod
+    def debug(message, *args, **fields):
+        """
+        Print a verbose diagnostic message.
+        :param message: The message to print, with %-style placeholders for args.
         """
-        load_dotenv()
-        return os.getenv("DEBUG", "False").lower() in ("true", "1", "yes")
-            
+        Debug.log(Debug.DEBUG, "debug", message, args, fields)
+
     @staticmethod
-    def info(message):
+    def info(message, *args, **fields):
         """
         Print an informational message.
-        :param message: The informational message to print.
+        :param message: The informational message to print, with %-style placeholders for args.
         """
-        if Debug.on():
-            print(f"INFO: {message}")
+        Debug.log(Debug.INFO, "info", message, args, fields)
 
     @staticmethod
-    def warning(message):
+    def warning(message, *args, **fields):
         """
         Print a warning message.
-        :param message: The warning message to print.
+        :param message: The warning message to print, with %-style placeholders for args.
         """
-        if Debug.on():
-            print(f"WARNING: {message}")
+        Debug.log(Debug.WARNING, "warning", message, args, fields)
 
     @staticmethod
-    def error(message):
+    def error(message, *args, **fields):
         """
         Print an error message and exit the program.
-        :param message: The error message to print.
+        :param message: The error message to print, with %-style placeholders for args.
         """
-        if Debug.on():
-            print(f"ERROR: {message}")
+        Debug.log(Debug.ERROR, "error", message, args, fields)
 
         sys.exit(1)
@@ -4,13 +4,110 @@ from datetime import datetime, timedelta
 # Local imports
 from data import Data
 from debug import Debug
+from errors import PermanentError
+from pages import Pages
+from workers import Workers
 
 class Device:
     @staticmethod
     def list():
-        data = Data("device_list")
-        data.set_params({"currentPage": 1, "pageSize": 500} )
-        return data.get()
+        """
+        Get every device, walking all pages of the device list.
+        The assembled listing is cached as device_list.json.
+        """
+        return Pages.collect("device_list", 500)
+
+    @staticmethod
+    def list_iter(page_size=500):
+        """
+        Iterate over every device, fetching pages ahead of the caller.
+        :param page_size: The number of devices to request per page.
+        :return: A generator of device dictionaries.
+        """
+        return Pages.iterate("device_list", page_size)
+
+    @staticmethod
+    def serials():
+        """
+        Get the serial numbers of every device in the device list.
+        :return: A list of serial numbers.
+        """
+        device_list = Device.list()
+        if not device_list or "result" not in device_list or "data" not in device_list["result"]:
+            raise PermanentError("Device list is empty or invalid.")
+
+        return [device["deviceSN"] for device in device_list["result"]["data"]]
+
+    @staticmethod
+    def fleet(query, serial_numbers=None, max_workers=None):
+        """
+        Run a per-device query for many devices in parallel.
+        If no serial numbers are provided, every device in the list is queried.
+        :param query: One of "history_query", "report_query" or "generation".
+        :param serial_numbers: The serial numbers to query.
+        :param max_workers: The maximum number of concurrent requests, when not running on an event loop.
+        :return: A dictionary with per-device "results" and "errors".
+        """
+        if query not in ("history_query", "report_query", "generation"):
+            Debug.error("Invalid fleet query: %s.", query)
+
+        if not serial_numbers:
+            serial_numbers = Device.serials()
+
+        if Workers.use_async():
+            # Imported here so the thread path works without aiohttp installed
+            from async_data import AsyncData
+
+            results, errors = AsyncData.run(
+                AsyncData.map(
+                    lambda serial_number: AsyncData(f"device_{query}", Device.get_params(query, serial_number)).get(),
+                    serial_numbers,
+                )
+            )
+        else:
+            results, errors = Workers.map(getattr(Device, query), serial_numbers, max_workers)
+        return {"results": results, "errors": errors}
+
+    @staticmethod
+    def get_params(query, serial_number, date=None):
+        """
+        Get the request parameters of a per-device query, shared by the sync and async paths.
+        :param query: One of "history_query", "report_query" or "generation".
+        :param serial_number: The serial number of the device.
+        :param date: The day, for history and reports, as a date or "YYYY-MM-DD". Defaults to yesterday.
+        :return: The parameters as a dictionary.
+        """
+        match query:
+            case "history_query":
+                day = Data.get_day(date) if date else Data.get_yesterday()
+                return {
+                    "sn": serial_number,
+                    "variables": [],
+                    "begin": day.begin_time,
+                    "end": day.end_time,
+                }
+            case "report_query":
+                if isinstance(date, str):
+                    date = datetime.strptime(date, "%Y-%m-%d")
+                day = date if date else datetime.now() - timedelta(days=1)
+                return {
+                    "sn": serial_number,
+                    "year": day.year,
+                    "month": day.month,
+                    "day": day.day,
+                    "dimension": "day",
+                    "variables": [
+                        "generation",
+                        "feedin",
+                        "gridConsumption",
+                        "chargeEnergyToTal",
+                        "dischargeEnergyToTal",
+                    ],
+                }
+            case "generation":
+                return {"sn": serial_number}
+
+        Debug.error("Invalid device query: %s.", query)
 
     @staticmethod
     def detail(serial_number=None):
@@ -21,11 +118,11 @@ class Device:
         if not serial_number:
             # Fetch the device list and get the first device's serial number
             device_list = Device.list()
-            print(f"Device list: {device_list}")  # Debugging line
+            Debug.debug("Device list: %s", device_list)
             if not device_list or "result" not in device_list or "data" not in device_list["result"]:
-                Debug.error("Device list is empty or invalid.")
+                raise PermanentError("Device list is empty or invalid.")
             if len(device_list["result"]["data"]) == 0:
-                Debug.error("No devices found in the list.")
+                raise PermanentError("No devices found in the list.")
             serial_number = device_list["result"]["data"][0]["deviceSN"]
 
         data = Data("device_detail")
@@ -38,29 +135,33 @@ class Device:
         return data.get()
 
     @staticmethod
-    def history_query(serial_number=None):
+    def history_query(serial_number=None, date=None):
+        """
+        Get the history data for a device for one day.
+        If no serial number is provided, it will fetch the first device in the list.
+        :param serial_number: The serial number of the device.
+        :param date: The day to fetch, as a date or "YYYY-MM-DD". Defaults to yesterday.
+        """
         if not serial_number:
             device = Device.detail()
             if not device or "result" not in device or "deviceSN" not in device["result"]:
-                Debug.error("Device detail is empty or invalid.")
-            Debug.info(f"Device detail: {device}")
+                raise PermanentError("Device detail is empty or invalid.")
+            Debug.debug("Device detail: %s", device)
             # Get the serial number from the first device in the detail response
             serial_number = device["result"]["deviceSN"]
 
         data = Data("device_history_query")
-        yesterday = Data.get_yesterday()
-        data.set_params(
-            {
-                "sn": serial_number,
-                "variables": [],
-                "begin": yesterday.begin_time,
-                "end": yesterday.end_time,
-            }
-        )
+        data.set_params(Device.get_params("history_query", serial_number, date))
         return data.get()
 
     @staticmethod
-    def report_query(serial_number=None):
+    def report_query(serial_number=None, date=None):
+        """
+        Get the daily report for a device.
+        If no serial number is provided, it will fetch the first device in the list.
+        :param serial_number: The serial number of the device.
+        :param date: The day to fetch, as a date or "YYYY-MM-DD". Defaults to yesterday.
+        """
         if not serial_number:
             device = Device.detail()
             if (
@@ -68,28 +169,14 @@ class Device:
                 or "result" not in device
                 or "deviceSN" not in device["result"]
             ):
-                Debug.error("Device detail is empty or invalid.")
+                raise PermanentError("Device detail is empty or invalid.")
 
-            Debug.info(f"Device detail: {device}")
+            Debug.debug("Device detail: %s", device)
             # Get the serial number from the first device in the detail response
             serial_number = device["result"]["deviceSN"]
 
         data = Data("device_report_query")
-        yesterday = datetime.now() - timedelta(days=1)
-        data.set_params( {
-            "sn": serial_number,
-            "year": yesterday.year,
-            "month": yesterday.month,
-            "day": yesterday.day,
-            "dimension": "day",
-            "variables": [
-                "generation",
-                "feedin",
-                "gridConsumption",
-                "chargeEnergyToTal",
-                "dischargeEnergyToTal",
-            ],
-        } )
+        data.set_params(Device.get_params("report_query", serial_number, date))
         return data.get()
 
     @staticmethod
@@ -105,17 +192,30 @@ class Device:
                 or "result" not in device
                 or "deviceSN" not in device["result"]
             ):
-                Debug.error("Device detail is empty or invalid.")
+                raise PermanentError("Device detail is empty or invalid.")
 
-            Debug.info(f"Device detail: {device}")
+            Debug.debug("Device detail: %s", device)
             # Get the serial number from the first device in the detail response
             serial_number = device["result"]["deviceSN"]
 
+        # Generation data has a short cache TTL, so repeated calls in one run share a request
         data = Data("device_generation")
-        data.disable_cache()  # We always want the latest generation data
+        data.set_params(Device.get_params("generation", serial_number))
+        return data.get()
+
+    @staticmethod
+    def real_query(serial_number, variables=None):
+        """
+        Get the latest real-time values for a device.
+        The snapshot always revalidates, so use Realtime to keep a history of them.
+        :param serial_number: The serial number of the device.
+        :param variables: The variables to get. Defaults to every variable.
+        """
+        data = Data("device_real_query")
         data.set_params(
             {
                 "sn": serial_number,
+                "variables": variables or [],
             }
         )
         return data.get()
@@ -0,0 +1,91 @@
+class FoxError(Exception):
+    """
+    Raised when data could not be fetched or saved.
+    """
+
+    # Whether the same request may succeed if sent again later
+    retryable = False
+
+    def __init__(self, message, name=None, errno=None, status=None):
+        """
+        :param message: The error message.
+        :param name: The data name of the failed request.
+        :param errno: The FoxESS errno of the response, if there was one.
+        :param status: The HTTP status code of the response, if there was one.
+        """
+        super().__init__(message)
+        self.name = name
+        self.errno = errno
+        self.status = status
+
+    @staticmethod
+    def is_retryable(error):
+        """
+        Check if a failure is worth retrying, e.g. when deciding what a batch should re-run.
+        :param error: The exception.
+        :return: True if the failure is transient, False otherwise.
+        """
+        if isinstance(error, FoxError):
+            return error.retryable
+
+        # Imported here so reporting errors doesn't load the HTTP client at startup
+        import requests
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+class RetryableError(FoxError):
+    """
+    Raised for transient failures: network errors, rate limits, spent budgets and 5xx responses.
+    """
+
+    retryable = True
+
+class PermanentError(FoxError):
+    """
+    Raised for failures that will recur if retried: bad parameters, unknown devices or bad keys.
+    """
+
+class Errors:
+
+    # FoxESS errnos that are worth retrying, and whether they mean today's quota is spent
+    retryable_errnos = {
+        40400: False,  # Requests too frequent
+        40402: True,   # Daily request limit exceeded
+    }
+
+    # HTTP status codes that are worth retrying, as retried by API.send_request()
+    retryable_statuses = (429, 500, 502, 503, 504)
+
+    @staticmethod
+    def check_response(name, status, parsed):
+        """
+        Check an API response, raising if it is an error rather than data.
+        :param name: The data name of the request.
+        :param status: The HTTP status code.
+        :param parsed: The parsed JSON body, or None if it was not JSON.
+        :raises RetryableError: If the request may succeed if sent again later.
+        :raises PermanentError: If the request will keep failing.
+        """
+        errno = parsed.get("errno") if isinstance(parsed, dict) else None
+        message = parsed.get("msg") if isinstance(parsed, dict) else None
+
+        if status >= 400 or not isinstance(parsed, dict):
+            error = RetryableError if status in Errors.retryable_statuses or status < 400 else PermanentError
+            raise error(
+                f"{name} returned HTTP {status}" + (f": {message}" if message else ""), name, errno, status
+            )
+
+        if errno is None:
+            raise RetryableError(f"{name} returned a response without an errno", name, None, status)
+
+        if errno != 0:
+            error = RetryableError if errno in Errors.retryable_errnos else PermanentError
+            raise error(f"{name} returned errno {errno}: {message or 'no message'}", name, errno, status)
+
+    @staticmethod
+    def is_quota_spent(error):
+        """
+        Check if a failure means today's request quota is spent.
+        :param error: The exception.
+        :return: True if the request should wait for the quota to reset.
+        """
+        return isinstance(error, FoxError) and Errors.retryable_errnos.get(error.errno, False)
@@ -0,0 +1,269 @@
+# Global imports
+import csv
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+# Local imports
+from data import Data
+from debug import Debug
+from metrics import Metrics
+from records import Records
+from retention import Retention
+from samples import Samples
+from settings import Settings
+from store import Store
+
+class Export:
+
+    formats = ("influx", "csv")
+
+    csv_columns = ("source", "serial", "variable", "unit", "timestamp", "value")
+
+    # Lines buffered before each write, overridden by FOX_EXPORT_BATCH
+    batch_size = 5000
+
+    # Seconds between checkpoint writes while exporting, overridden by FOX_EXPORT_CHECKPOINT_INTERVAL
+    checkpoint_interval = 10
+
+    def __init__(self, export_format="influx", checkpoint_path=None):
+        """
+        :param export_format: "influx" for InfluxDB line protocol or "csv".
+        :param checkpoint_path: The checkpoint file. Defaults to export_<format>.checkpoint.json
+            in the data directory.
+        """
+        if export_format not in self.formats:
+            Debug.error("Invalid export format: %s. Valid formats are: %s", export_format, ", ".join(self.formats))
+
+        self.format = export_format
+        settings = Settings.load()
+        self.batch_size = settings.get_int("FOX_EXPORT_BATCH", self.batch_size)
+        self.checkpoint_interval = settings.get_float("FOX_EXPORT_CHECKPOINT_INTERVAL", self.checkpoint_interval)
+        self.checkpoint_path = checkpoint_path or os.path.join(
+            Data.get_data_dir(), f"export_{export_format}.checkpoint.json"
+        )
+
+    @staticmethod
+    def escape(value):
+        """
+        Escape a tag value for InfluxDB line protocol.
+        :param value: The tag value.
+        :return: The value with commas, equals signs and spaces escaped.
+        """
+        return str(value).replace("\\", "\\\\").replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+    def get_files(self, fox_dir=None, myenergi_dir=None):
+        """
+        List the history and dayhour files that can be exported, in name order.
+        History includes the monthly archives that retention compacts raw days into.
+        :param fox_dir: The FoxESS data directory. Defaults to FOX_DATA_DIR.
+        :param myenergi_dir: The myenergi data directory. Defaults to MYENERGI_DATA_DIR.
+        :return: A list of (source, file path) tuples.
+        """
+        files = []
+        for source, data_dir, patterns in (
+            ("fox", fox_dir or Data.get_data_dir(), (Store.history_pattern, Retention.month_pattern)),
+            ("myenergi", myenergi_dir or Data.get_myenergi_data_dir(), (Store.dayhour_pattern,)),
+        ):
+            if not os.path.isdir(data_dir):
+                continue
+            files.extend(
+                (source, os.path.join(data_dir, file_name))
+                for file_name in sorted(os.listdir(data_dir))
+                if any(pattern.match(file_name) for pattern in patterns)
+            )
+        return files
+
+    def read_checkpoint(self):
+        """
+        Read the last export's checkpoint.
+        :return: A dictionary of file path to [mtime, last exported timestamp].
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("files", {})
+
+    def write_checkpoint(self, checkpoint):
+        """
+        Write the checkpoint atomically, so an interrupted export never corrupts it.
+        :param checkpoint: A dictionary of file path to [mtime, last exported timestamp].
+        """
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"files": checkpoint}, f, separators=(",", ":"))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.checkpoint_path)
+
+    @staticmethod
+    def get_exported_days(checkpoint):
+        """
+        Get the days whose raw history files were exported, so their compacted copies aren't exported again.
+        :param checkpoint: A dictionary of file path to [mtime, last exported timestamp].
+        :return: A set of (serial number, "YYYY-MM-DD") tuples.
+        """
+        days = set()
+        for file_path in checkpoint:
+            match = Store.history_pattern.match(os.path.basename(file_path))
+            if match:
+                days.add((match.group(1), match.group(2)))
+        return days
+
+    @staticmethod
+    def read_samples(source, file_path, exported_days=()):
+        """
+        Iterate over the samples in one saved file.
+        A monthly archive gives each compacted period's mean, stamped with the period's start.
+        :param source: "fox" or "myenergi".
+        :param file_path: The path of the file.
+        :param exported_days: (serial number, date) tuples to skip in a monthly archive.
+        :return: A generator of (serial, variable, unit, timestamp, value) tuples.
+        """
+        if source == "myenergi":
+            with open(file_path, "r", encoding="utf-8") as f:
+                yield from Samples.from_dayhour(json.load(f))
+            return
+
+        match = Retention.month_pattern.match(os.path.basename(file_path))
+        if match:
+            serial_number = match.group(1)
+            records = (
+                record
+                for date in sorted(Retention.read_month(file_path))
+                if (serial_number, date) not in exported_days
+                for record in Records.from_history(Retention.read_day(serial_number, date, file_path), file_path)
+            )
+        else:
+            records = Records.read("device_history_query", file_path)
+
+        for record in records:
+            for series in record:
+                for timestamp, value in series:
+                    if not math.isnan(value):
+                        yield record.serial, series.variable, series.unit, timestamp, value
+
+    def format_lines(self, source, samples):
+        """
+        Format samples for the export format.
+        :param source: "fox" or "myenergi", the InfluxDB measurement.
+        :param samples: An iterable of (serial, variable, unit, timestamp, value) tuples.
+        :return: A generator of lines for InfluxDB, or rows for CSV.
+        """
+        if self.format == "csv":
+            for serial, variable, unit, timestamp, value in samples:
+                yield (source, serial, variable, unit or "", timestamp, value)
+            return
+
+        # Tags are the same for every sample of a series, so escape them once
+        tags = {}
+        for serial, variable, unit, timestamp, value in samples:
+            key = (serial, variable, unit)
+            prefix = tags.get(key)
+            if prefix is None:
+                prefix = tags[key] = (
+                    f"{source},serial={Export.escape(serial)},variable={Export.escape(variable)}"
+                    + (f",unit={Export.escape(unit)}" if unit else "")
+                    + " value="
+                )
+            yield f"{prefix}{value!r} {timestamp * 1000000000}\n"
+
+    def run(self, output=None, full=False, fox_dir=None, myenergi_dir=None):
+        """
+        Stream saved history and dayhour samples to InfluxDB line protocol or CSV.
+        One file is read at a time and lines are written in batches, so memory stays bounded.
+        Unless full is set, files unchanged since the last export are skipped, and samples
+        already exported from a changed file are not written again. Nor are compacted days
+        whose raw files were already exported.
+        The checkpoint is rewritten at most every checkpoint_interval seconds while exporting, and
+        once at the end, so an interrupted export repeats at most that much work.
+        InfluxDB timestamps are in nanoseconds.
+        :param output: The file to write to, appended to for incremental exports. Defaults to standard output.
+        :param full: Export everything and start a new checkpoint.
+        :param fox_dir: The FoxESS data directory. Defaults to FOX_DATA_DIR.
+        :param myenergi_dir: The myenergi data directory. Defaults to MYENERGI_DATA_DIR.
+        :return: The number of samples exported.
+        """
+        checkpoint = {} if full else self.read_checkpoint()
+        mode = "w" if full else "a"
+        file = open(output, mode, encoding="utf-8", newline="") if output else sys.stdout
+        try:
+            writer = csv.writer(file) if self.format == "csv" else None
+            if writer and (not output or file.tell() == 0):
+                writer.writerow(self.csv_columns)
+
+            exported = 0
+            batch = []
+            exported_days = Export.get_exported_days(checkpoint)
+            checkpointed_at = time.monotonic()
+            for source, file_path in self.get_files(fox_dir, myenergi_dir):
+                mtime = os.path.getmtime(file_path)
+                saved_mtime, last_timestamp = checkpoint.get(file_path, (None, None))
+                if saved_mtime == mtime:
+                    continue
+
+                latest = {"timestamp": last_timestamp}
+                samples = Export.get_new_samples(self.read_samples(source, file_path, exported_days), latest)
+                for line in self.format_lines(source, samples):
+                    batch.append(line)
+                    if len(batch) >= self.batch_size:
+                        # Every file already in the checkpoint is out of the buffer once it is written
+                        exported += self.flush(file, writer, batch)
+                        if time.monotonic() - checkpointed_at >= self.checkpoint_interval:
+                            self.write_checkpoint(checkpoint)
+                            checkpointed_at = time.monotonic()
+                checkpoint[file_path] = [mtime, latest["timestamp"]]
+
+            exported += self.flush(file, writer, batch)
+            self.write_checkpoint(checkpoint)
+        finally:
+            if output:
+                file.close()
+            else:
+                file.flush()
+
+        Metrics.increment("exported", exported, format=self.format)
+        Debug.info("Exported %s samples as %s", exported, self.format)
+        return exported
+
+    @staticmethod
+    def get_new_samples(samples, latest):
+        """
+        Filter out samples already exported, tracking the latest timestamp passed through.
+        :param samples: An iterable of (serial, variable, unit, timestamp, value) tuples.
+        :param latest: A dictionary whose "timestamp" is the latest already exported, or None.
+            It is updated as samples pass through.
+        :return: A generator of the samples newer than the latest exported.
+        """
+        since = latest["timestamp"]
+        for sample in samples:
+            if since is not None and sample[3] <= since:
+                continue
+            if latest["timestamp"] is None or sample[3] > latest["timestamp"]:
+                latest["timestamp"] = sample[3]
+            yield sample
+
+    def flush(self, file, writer, batch):
+        """
+        Write buffered lines and empty the buffer.
+        :param file: The output file.
+        :param writer: The CSV writer, or None for line protocol.
+        :param batch: The buffered lines or rows.
+        :return: The number of lines written.
+        """
+        if not batch:
+            return 0
+
+        with Metrics.timer("export"):
+            if writer:
+                writer.writerows(batch)
+            else:
+                file.write("".join(batch))
+            file.flush()
+        written = len(batch)
+        batch.clear()
+        return written
@@ -0,0 +1,178 @@
+# Global imports
+import csv
+import heapq
+import itertools
+import json
+import os
+import sys
+from collections import defaultdict
+
+# Local imports
+from backfill import Backfill
+from data import Data
+from debug import Debug
+from samples import Samples
+
+class Flows:
+
+    # FoxESS history power variables (kW) and the energy columns they become
+    fox_columns = {
+        "pvPower": "pv_kwh",
+        "gridConsumptionPower": "grid_import_kwh",
+        "feedinPower": "grid_export_kwh",
+        "batChargePower": "battery_charge_kwh",
+        "batDischargePower": "battery_discharge_kwh",
+        "loadsPower": "load_kwh",
+    }
+
+    # myenergi dayhour fields (joules) and the energy columns they become.
+    # h1d-h3d are energy diverted and h1b-h3b energy boosted, per phase.
+    myenergi_columns = {
+        "imp": "myenergi_import_kwh",
+        "exp": "myenergi_export_kwh",
+        "gep": "myenergi_generation_kwh",
+        "h1d": "ev_diverter_kwh",
+        "h2d": "ev_diverter_kwh",
+        "h3d": "ev_diverter_kwh",
+        "h1b": "ev_diverter_kwh",
+        "h2b": "ev_diverter_kwh",
+        "h3b": "ev_diverter_kwh",
+    }
+
+    columns = [
+        "timestamp",
+        *dict.fromkeys(fox_columns.values()),
+        "soc",
+        *dict.fromkeys(myenergi_columns.values()),
+    ]
+
+    @staticmethod
+    def get_dayhour_path(device, date):
+        """
+        Get the path of a saved myenergi dayhour file.
+        :param device: The myenergi device, e.g. "Z12345678", or None for the default zappi.
+        :param date: The day as a "YYYY-MM-DD" string.
+        :return: The file path as a string.
+        """
+        data_dir = Data.get_myenergi_data_dir()
+        if device:
+            file_path = os.path.join(data_dir, f"dayhour_{device}_{date}.json")
+            if os.path.exists(file_path):
+                return file_path
+
+        return os.path.join(data_dir, f"dayhour_{date}.json")
+
+    @staticmethod
+    def iterate(serial_number, start, end, interval=3600, device=None):
+        """
+        Join FoxESS history and myenergi dayhour data onto a common time grid.
+        Both sources are read one day at a time and merged in time order, so
+        memory use does not grow with the length of the range.
+        :param serial_number: The FoxESS device serial number.
+        :param start: The first day to include.
+        :param end: The last day to include.
+        :param interval: The grid interval in seconds.
+        :param device: The myenergi device, e.g. "Z12345678". Defaults to the default zappi.
+        :return: A generator of row dictionaries with the keys in Flows.columns.
+        """
+        dates = Backfill.get_dates(start, end)
+        merged = heapq.merge(
+            Flows.iterate_fox(serial_number, dates, interval),
+            Flows.iterate_myenergi(device, dates, interval),
+            key=lambda bucket: bucket[0],
+        )
+        for timestamp, buckets in itertools.groupby(merged, key=lambda bucket: bucket[0]):
+            row = dict.fromkeys(Flows.columns, 0.0)
+            row["timestamp"] = timestamp
+            row["soc"] = None
+            for _, values in buckets:
+                for column, value in values.items():
+                    if column == "soc":
+                        row["soc"] = value
+                    else:
+                        row[column] += value
+            yield row
+
+    @staticmethod
+    def iterate_fox(serial_number, dates, interval):
+        """
+        Resample FoxESS history onto the grid, one day at a time.
+        Energy in each interval is the mean power of its samples times the interval.
+        :param serial_number: The FoxESS device serial number.
+        :param dates: The days to read, in order.
+        :param interval: The grid interval in seconds.
+        :return: A generator of (timestamp, values) tuples in time order.
+        """
+        hours = interval / 3600
+        for date in dates:
+            data = Data("device_history_query", {"sn": serial_number, "begin": Data.get_day(date).begin_time})
+            response = data.get_saved_response()
+            if not response:
+                Debug.info("No history saved for %s on %s", serial_number, date)
+                continue
+
+            sums = defaultdict(float)
+            counts = defaultdict(int)
+            soc = {}
+            # Compacted days hold one mean per hour or day, spread over the grid like raw samples
+            for _, variable, _, timestamp, value in Samples.from_history(Samples.spread(response, interval)):
+                bucket = timestamp - timestamp % interval
+                if variable == "SoC":
+                    soc[bucket] = value
+                elif variable in Flows.fox_columns:
+                    key = (bucket, Flows.fox_columns[variable])
+                    sums[key] += value
+                    counts[key] += 1
+
+            buckets = defaultdict(dict)
+            for (bucket, column), total in sums.items():
+                buckets[bucket][column] = total / counts[(bucket, column)] * hours
+            for bucket, value in soc.items():
+                buckets[bucket]["soc"] = value
+
+            yield from sorted(buckets.items())
+
+    @staticmethod
+    def iterate_myenergi(device, dates, interval):
+        """
+        Resample myenergi hourly data onto the grid, one day at a time.
+        Intervals shorter than an hour share the hour's energy evenly.
+        :param device: The myenergi device, or None for the default zappi.
+        :param dates: The days to read, in order.
+        :param interval: The grid interval in seconds.
+        :return: A generator of (timestamp, values) tuples in time order.
+        """
+        for date in dates:
+            file_path = Flows.get_dayhour_path(device, date)
+            if not os.path.exists(file_path):
+                Debug.info("No myenergi data saved for %s", date)
+                continue
+
+            with open(file_path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+
+            buckets = defaultdict(lambda: defaultdict(float))
+            parts = max(3600 // interval, 1)
+            for _, variable, _, timestamp, value in Samples.from_dayhour(payload):
+                if variable not in Flows.myenergi_columns:
+                    continue
+                kwh = value / 3600000 / parts
+                for part in range(parts):
+                    moment = timestamp + part * interval
+                    buckets[moment - moment % interval][Flows.myenergi_columns[variable]] += kwh
+
+            yield from sorted(buckets.items())
+
+    @staticmethod
+    def write_csv(rows, file=None):
+        """
+        Write joined rows as CSV.
+        :param rows: An iterable of row dictionaries from iterate().
+        :param file: The file to write to. Defaults to standard output.
+        """
+        writer = csv.DictWriter(file or sys.stdout, fieldnames=Flows.columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {column: round(value, 4) if isinstance(value, float) else value for column, value in row.items()}
+            )
@@ -1,79 +1,270 @@
 # Global imports
+import atexit
 import sys
-import urllib3
 
 # Local imports
+# Each command imports only the modules it uses, so short commands start quickly
 from debug import Debug
-from device import Device
-from module import Module
-from plant import Plant
-from user import User
-
-urllib3.disable_warnings()
+from errors import FoxError
+from metrics import Metrics
 
 if __name__ == '__main__':
+    # Print a timing and cache summary on exit, e.g. index.py --profile device_history_query
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        atexit.register(lambda: print(Metrics.summary()))
+
+    # Write FOX_METRICS_FILE, if set, on exit
+    atexit.register(Metrics.write)
+
     # Get the function to execute from the command line arguments
     if len(sys.argv) > 1:
         data_name = sys.argv[1]
         args = sys.argv[2:] if len(sys.argv) > 2 else None
 
-        match data_name:
+        # Failed requests raise, so they are reported once here rather than where they happen
+        try:
+            match data_name:
 
-            case "device_list":
-                Debug.info("Fetching device list...")
-                Device.list()
+                case "device_list":
+                    from device import Device
+                    Debug.info("Fetching device list...")
+                    Device.list()
 
-            case "device_detail":
-                serial_number = args[0] if args else None
-                Debug.info(f"Fetching device detail for serial number: {serial_number}")
-                Device.detail(serial_number)
+                case "device_detail":
+                    from device import Device
+                    serial_number = args[0] if args else None
+                    Debug.info("Fetching device detail for serial number: %s", serial_number)
+                    Device.detail(serial_number)
 
-            case "device_variable_get":
-                Debug.info("Fetching device variables...")
-                Device.variable_get()
+                case "device_variable_get":
+                    from device import Device
+                    Debug.info("Fetching device variables...")
+                    Device.variable_get()
 
-            case "device_history_query":
-                serial_number = args[0] if args else None
-                Debug.info("Fetching device history query...")
-                Device.history_query(serial_number)
+                case "device_history_query":
+                    from device import Device
+                    serial_number = args[0] if args else None
+                    Debug.info("Fetching device history query...")
+                    Device.history_query(serial_number)
 
-            case "device_report_query":
-                serial_number = args[0] if args else None
-                Debug.info("Fetching device report query...")
-                Device.report_query(serial_number)
+                case "device_report_query":
+                    from device import Device
+                    serial_number = args[0] if args else None
+                    Debug.info("Fetching device report query...")
+                    Device.report_query(serial_number)
 
-            case "device_generation":
-                serial_number = args[0] if args else None
-                Debug.info("Fetching device generation...")
-                Device.generation(serial_number)
+                case "device_generation":
+                    from device import Device
+                    serial_number = args[0] if args else None
+                    Debug.info("Fetching device generation...")
+                    Device.generation(serial_number)
                 
-            case "module_list":
-                current_page = int(args[0]) if args and len(args) > 0 else 1
-                page_size = int(args[1]) if args and len(args) > 1 else 10
-                Debug.info("Fetching module list...")
-                Module.module_list(current_page=current_page, page_size=page_size)
-
-            case "plant_list":
-                current_page = int(args[0]) if args and len(args) > 0 else 1
-                page_size = int(args[1]) if args and len(args) > 1 else 10
-                Debug.info("Fetching plant list...")
-                Plant.plant_list(current_page=current_page, page_size=page_size)
+                case "backfill":
+                    # Fetch missing days, e.g. backfill device_history_query 2024-01-01 2024-01-31 [serial]
+                    from backfill import Backfill
+                    if not args or len(args) < 2:
+                        Debug.error("Usage: index.py backfill <data_name> <start> [<end>] [<serial_number>]")
+                    end = args[2] if len(args) > 2 else None
+                    serial_numbers = [args[3]] if len(args) > 3 else None
+                    backfill = Backfill.run(args[0], args[1], end, serial_numbers)
+                    Debug.info(
+                        "Backfilled %s days, %s failed, %s worth retrying",
+                        len(backfill['results']),
+                        len(backfill['errors']),
+                        sum(FoxError.is_retryable(error) for error in backfill['errors'].values()),
+                    )
+                    for (serial_number, date), error in backfill["errors"].items():
+                        Debug.warning("%s %s: %s", serial_number, date, error)
+
+                case "compact":
+                    # Compact raw history older than FOX_RETENTION_RAW_DAYS into monthly archives, e.g. compact [serial ...]
+                    from retention import Retention
+                    results, errors = Retention().compact(args)
+                    Debug.info("Compacted %s days in %s device months, %s failed", sum(results.values()), len(results), len(errors))
+                    for (serial_number, month), error in errors.items():
+                        Debug.warning("%s %s: %s", serial_number, month, error)
+
+                case "costs":
+                    # Print what a tariff cost per period as CSV, e.g. costs "Economy 7" 2024-01-01 2024-12-31 month [serial]
+                    from tariff import Costs
+                    if not args or len(args) < 3:
+                        Debug.error("Usage: index.py costs <tariff> <start> <end> [<day|week|month>] [<serial_number>]")
+                    period = args[3] if len(args) > 3 else "day"
+                    serial_numbers = [args[4]] if len(args) > 4 else None
+                    summary = Costs.summarise(args[0], args[1], args[2], period, serial_numbers)
+                    print(",".join(summary))
+                    for row in zip(*summary.values()):
+                        print(",".join(str(value) if index == 0 else f"{value:.2f}" for index, value in enumerate(row)))
+
+                case "daemon":
+                    # Run jobs on their intervals in one process, e.g. daemon generation history
+                    from daemon import Daemon
+                    Daemon(args).run()
+
+                case "export":
+                    # Stream saved history as line protocol or CSV, e.g. export influx out.lp [full]
+                    from export import Export
+                    export_format = args[0] if args else "influx"
+                    output = args[1] if args and len(args) > 1 and args[1] != "-" else None
+                    full = bool(args) and args[-1] == "full"
+                    if output == "full":
+                        output = None
+                    Export(export_format).run(output, full)
+
+                case "fleet":
+                    # Run a device query for every device, e.g. fleet device_history_query 16
+                    from device import Device
+                    query = args[0].removeprefix("device_") if args else "history_query"
+                    max_workers = int(args[1]) if args and len(args) > 1 else None
+                    Debug.info("Fetching %s for the whole fleet...", query)
+                    fleet = Device.fleet(query, max_workers=max_workers)
+                    Debug.info(
+                        "Fetched %s devices, %s failed, %s worth retrying",
+                        len(fleet['results']),
+                        len(fleet['errors']),
+                        sum(FoxError.is_retryable(error) for error in fleet['errors'].values()),
+                    )
+                    for serial_number, error in fleet["errors"].items():
+                        Debug.warning("%s: %s", serial_number, error)
+
+                case "flows":
+                    # Print joined FoxESS and myenergi data as CSV, e.g. flows 123456789 2024-01-01 2024-01-31 1800
+                    from flows import Flows
+                    if not args or len(args) < 3:
+                        Debug.error("Usage: index.py flows <serial_number> <start> <end> [<interval>] [<myenergi_device>]")
+                    interval = int(args[3]) if len(args) > 3 else 3600
+                    device = args[4] if len(args) > 4 else None
+                    Flows.write_csv(Flows.iterate(args[0], args[1], args[2], interval, device))
+
+                case "load":
+                    # Decode saved files across every core and report what was loaded, e.g. load device_history_query 2024-01-01 2024-12-31 [serial]
+                    from manifest import Manifest
+                    if not args:
+                        Debug.error("Usage: index.py load <data_name> [<start>] [<end>] [<serial_number>]")
+                    start = args[1] if len(args) > 1 else None
+                    end = args[2] if len(args) > 2 else None
+                    serial_numbers = [args[3]] if len(args) > 3 else None
+                    loaded = 0
+                    for serial_number, date, decoded in Manifest().load(args[0], serial_numbers, start, end):
+                        loaded += 1
+                    Debug.info("Loaded %s files of %s", loaded, args[0])
+
+                case "manifest":
+                    # Rebuild the index of the data directory from a scan, e.g. manifest rebuild
+                    from manifest import Manifest
+                    manifest = Manifest()
+                    if args and args[0] == "rebuild":
+                        manifest.rebuild()
+                    entries = manifest.entries()
+                    Debug.info(
+                        "%s files indexed, %s bytes", len(entries), sum(entry["size"] for entry in entries.values())
+                    )
+
+                case "module_list":
+                    from module import Module
+                    if args and args[0] == "all":
+                        Debug.info("Fetching every page of the module list...")
+                        Module.module_list_all()
+                    else:
+                        current_page = int(args[0]) if args and len(args) > 0 else 1
+                        page_size = int(args[1]) if args and len(args) > 1 else 10
+                        Debug.info("Fetching module list...")
+                        Module.module_list(current_page=current_page, page_size=page_size)
+
+                case "plant_list":
+                    from plant import Plant
+                    if args and args[0] == "all":
+                        Debug.info("Fetching every page of the plant list...")
+                        Plant.plant_list_all()
+                    else:
+                        current_page = int(args[0]) if args and len(args) > 0 else 1
+                        page_size = int(args[1]) if args and len(args) > 1 else 10
+                        Debug.info("Fetching plant list...")
+                        Plant.plant_list(current_page=current_page, page_size=page_size)
                 
-            case "plant_detail":
-                plant_id = args[0] if args else None
-                if plant_id:
-                    Debug.info(f"Fetching plant detail for plant ID: {plant_id}")
-                else:
-                    Debug.info("Fetching plant detail for the first plant in the list.")
+                case "plant_detail":
+                    from plant import Plant
+                    plant_id = args[0] if args else None
+                    if plant_id:
+                        Debug.info("Fetching plant detail for plant ID: %s", plant_id)
+                    else:
+                        Debug.info("Fetching plant detail for the first plant in the list.")
                     
-                Plant.plant_detail(plant_id)
+                    Plant.plant_detail(plant_id)
                 
-            case "user_get_access_count":
-                Debug.info("Fetching user access count...")
-                User.user_get_access_count()
+                case "realtime":
+                    # Poll real-time values into per-device logs, e.g. realtime 60 [serial ...]
+                    from realtime import Realtime
+                    interval = float(args[0]) if args else None
+                    serial_numbers = args[1:] if args and len(args) > 1 else None
+                    Realtime(serial_numbers, interval=interval).run()
+
+                case "realtime_read":
+                    # Print a day of a device's real-time log as CSV, e.g. realtime_read 123456789 2024-01-01
+                    from realtime import Realtime, SampleLog
+                    if not args or len(args) < 2:
+                        Debug.error("Usage: index.py realtime_read <serial_number> <date>")
+                    for timestamp, values in SampleLog.read(Realtime.get_log_path(args[0], args[1])):
+                        for variable, value in values.items():
+                            print(f"{timestamp},{variable},{value}")
+
+                case "resume":
+                    from data import Data
+                    max_workers = int(args[0]) if args else None
+                    Debug.info("Resuming deferred requests...")
+                    results, errors = Data.resume(max_workers)
+                    Debug.info("Resumed %s requests, %s failed", len(results), len(errors))
+
+                case "rollup":
+                    # Print totals as CSV, e.g. rollup month 2024-01-01 2024-12-31 [serial]
+                    from rollup import Rollup
+                    if not args or len(args) < 3:
+                        Debug.error("Usage: index.py rollup <day|week|month> <start> <end> [<serial_number>]")
+                    serial_numbers = [args[3]] if len(args) > 3 else None
+                    summary = Rollup.summarise(args[1], args[2], args[0], serial_numbers)
+                    print(",".join(summary))
+                    for row in zip(*summary.values()):
+                        print(",".join(str(value) if index == 0 else f"{value:.3f}" for index, value in enumerate(row)))
+
+                case "store_ingest":
+                    from store import Store
+                    Debug.info("Ingesting saved history into the store...")
+                    Store().ingest_dir()
+
+                case "store_query":
+                    # Print samples as CSV, e.g. store_query 123456789 SoC 2024-01-01 2024-04-01 [fox|myenergi]
+                    from data import Data
+                    from store import Store
+                    if not args or len(args) < 4:
+                        Debug.error("Usage: index.py store_query <serial_number> <variable> <start> <end> [<source>]")
+                    source = args[4] if len(args) > 4 else "fox"
+                    start = Data.get_day(args[2]).begin_time / 1000
+                    end = Data.get_day(args[3]).begin_time / 1000
+                    for timestamp, value in Store().query(args[0], args[1], start, end, source):
+                        print(f"{timestamp},{value}")
+
+                case "tariff_compare":
+                    # Print what each tariff would have cost as CSV, e.g. tariff_compare 2024-01-01 2024-12-31 [month] [serial]
+                    from tariff import Costs
+                    if not args or len(args) < 2:
+                        Debug.error("Usage: index.py tariff_compare <start> <end> [<day|week|month>] [<serial_number>]")
+                    period = args[2] if len(args) > 2 else "month"
+                    serial_numbers = [args[3]] if len(args) > 3 else None
+                    comparison = Costs.compare(args[0], args[1], period, serial_numbers=serial_numbers)
+                    print(",".join(comparison))
+                    for row in zip(*comparison.values()):
+                        print(",".join(str(value) if index == 0 else f"{value:.2f}" for index, value in enumerate(row)))
+
+                case "user_get_access_count":
+                    from user import User
+                    Debug.info("Fetching user access count...")
+                    User.user_get_access_count()
 
-            case _:
-                Debug.error(f"Invalid data name: {data_name}.")
+                case _:
+                    Debug.error("Invalid data name: %s.", data_name)
+        except FoxError as e:
+            Debug.error("%s", e)
     else:
         Debug.warning("Usage: python example.py <data_name> [<args>]")
         Debug.warning("Example: python index.py device_detail 123456789")
@@ -0,0 +1,433 @@
+# Global imports
+import fcntl
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Local imports
+from data import Data
+from debug import Debug
+from metrics import Metrics
+from settings import Settings
+
+class Manifest:
+    """
+    An index of the files in the data directory: data name, serial number, date, size, mtime and checksum.
+
+    The index is an append-only log of JSON lines, so a save adds one short line instead of rewriting
+    the index. Later lines replace earlier ones for the same file, and removed files get a line of
+    their own. rebuild() rewrites the log from a scan of the directory, and once enough lines are
+    superseded or removed the log is rewritten with only the current entries.
+    """
+
+    file_name = "manifest.jsonl"
+
+    # Data names whose file names include a serial number
+    serial_names = (
+        "device_detail",
+        "device_generation",
+        "device_real_query",
+        "device_history_query",
+        "device_report_query",
+    )
+
+    # The date or month at the end of a file name, after the data name and serial number
+    _date_pattern = re.compile(r"_(\d{4}-\d{2}(?:-\d{2})?)$")
+    _extension_pattern = re.compile(r"(\.compact)?\.json(\.gz)?$")
+
+    # Superseded or removed lines before the log is compacted, overridden by FOX_MANIFEST_COMPACT_LINES.
+    # The log is also never compacted while they are fewer than its current entries.
+    compact_lines = 1000
+
+    # The replayed log of each manifest by path, with how far it has been read
+    _states = {}
+    # Lines appended to each manifest by this process since it was last replayed
+    _appended = {}
+    _lock = threading.Lock()
+
+    def __init__(self, data_dir=None):
+        """
+        :param data_dir: The data directory. Defaults to FOX_DATA_DIR.
+        """
+        self.data_dir = data_dir or Data.get_data_dir()
+        self.path = os.path.join(self.data_dir, self.file_name)
+        self.compact_lines = Settings.load().get_int("FOX_MANIFEST_COMPACT_LINES", self.compact_lines)
+
+    @staticmethod
+    def checksum(payload):
+        """
+        Get the checksum of a file's contents.
+        :param payload: The file contents as bytes.
+        :return: The CRC-32 as 8 hex digits.
+        """
+        return f"{zlib.crc32(payload):08x}"
+
+    @staticmethod
+    def describe(file_name):
+        """
+        Work out what a data file holds from its name.
+        :param file_name: The file name, e.g. "device_history_query_123456789_2024-01-01.json".
+        :return: A dictionary with "name", "serial" and "date", or None if it isn't a data file.
+            Serial and date are None when the name has none; a monthly archive's date is "YYYY-MM".
+        """
+        stem = Manifest._extension_pattern.sub("", file_name)
+        if stem == file_name or file_name.startswith("."):
+            return None
+
+        names = [name for name in Data.valid_data_names if stem == name or stem.startswith(name + "_")]
+        if not names:
+            return None
+        name = max(names, key=len)
+
+        rest = stem[len(name) + 1:]
+        match = Manifest._date_pattern.search("_" + rest)
+        date = match.group(1) if match else None
+        if date:
+            rest = rest[:-len(date)].rstrip("_")
+        serial = (rest or None) if name in Manifest.serial_names else None
+        return {"name": name, "serial": serial, "date": date}
+
+    def get_entry(self, file_path, payload=None):
+        """
+        Build the index entry for a file.
+        :param file_path: The path of the file.
+        :param payload: The file contents, if already in memory.
+        :return: The entry as a dictionary, or None if it isn't a data file.
+        """
+        file_name = os.path.basename(file_path)
+        entry = Manifest.describe(file_name)
+        if entry is None:
+            return None
+
+        if payload is None:
+            with open(file_path, "rb") as f:
+                payload = f.read()
+        stat = os.stat(file_path)
+        entry.update({
+            "file": file_name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "crc32": Manifest.checksum(payload),
+        })
+        return entry
+
+    def open_locked(self, flags, operation):
+        """
+        Open the log and lock it against other processes. Appends take a shared lock and rewrites an
+        exclusive one, so no line is appended to a log that is being replaced.
+        :param flags: The os.open() flags.
+        :param operation: fcntl.LOCK_SH or fcntl.LOCK_EX.
+        :return: The locked file descriptor, which holds the lock until closed.
+        """
+        while True:
+            fd = os.open(self.path, flags, 0o644)
+            try:
+                fcntl.flock(fd, operation)
+                # A rewrite may have replaced the log while waiting, so lock the new one instead
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def append(self, lines):
+        """
+        Append entries to the log in one write, which O_APPEND keeps whole even with other writers.
+        :param lines: The entries as dictionaries.
+        :return: Whether enough lines have been appended since the log was last replayed that it may
+            need compacting.
+        """
+        if not lines:
+            return False
+
+        payload = "".join(json.dumps(line, separators=(",", ":")) + "\n" for line in lines).encode("utf-8")
+        fd = self.open_locked(os.O_WRONLY | os.O_APPEND | os.O_CREAT, fcntl.LOCK_SH)
+        try:
+            os.write(fd, payload)
+        finally:
+            os.close(fd)
+
+        appended = Manifest._appended[self.path] = Manifest._appended.get(self.path, 0) + len(lines)
+        return appended >= self.compact_lines
+
+    def record(self, file_path, payload=None):
+        """
+        Index a file that was just written. Nothing is recorded until the index exists, as building
+        it scans the whole directory; manifest rebuild or the first entries() call builds it.
+        :param file_path: The path of the file.
+        :param payload: The file contents, if already in memory.
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with Manifest._lock:
+                entry = self.get_entry(file_path, payload)
+                due = self.append([entry]) if entry else False
+            if due:
+                self.entries()
+        except OSError as e:
+            # The index can always be rebuilt, so failing to update it must not fail the save
+            Debug.warning("Failed to update the manifest for %s: %s", file_path, e)
+
+    def remove(self, file_path):
+        """
+        Mark a file as removed from the data directory.
+        :param file_path: The path of the file.
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with Manifest._lock:
+                due = self.append([{"file": os.path.basename(file_path), "removed": True}])
+            if due:
+                self.entries()
+        except OSError as e:
+            Debug.warning("Failed to update the manifest for %s: %s", file_path, e)
+
+    def rebuild(self, locked=False):
+        """
+        Rewrite the index from a scan of the data directory, checksumming every file.
+        :param locked: Whether the caller already holds the manifest lock.
+        :return: The number of files indexed.
+        """
+        if not locked:
+            with Manifest._lock:
+                return self.rebuild(locked=True)
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        entries = []
+        with Metrics.timer("manifest"):
+            for file_name in sorted(os.listdir(self.data_dir)):
+                try:
+                    entry = self.get_entry(os.path.join(self.data_dir, file_name))
+                except FileNotFoundError:
+                    continue
+                if entry:
+                    entries.append(entry)
+
+            lock_fd = self.open_locked(os.O_RDONLY | os.O_CREAT, fcntl.LOCK_EX)
+            try:
+                self.write(entries)
+            finally:
+                os.close(lock_fd)
+
+        Debug.info("Indexed %s files in %s", len(entries), self.path)
+        return len(entries)
+
+    def write(self, entries):
+        """
+        Replace the log atomically with one line per entry. The caller holds the exclusive lock.
+        :param entries: The entries as dictionaries.
+        :return: The os.stat() of the new log.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.data_dir, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            os.chmod(temp_path, 0o644)
+            stat = os.stat(temp_path)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return stat
+
+    def entries(self):
+        """
+        Get the indexed files, reading only the lines appended since the last call, and compact the
+        log once enough of its lines are superseded or removed.
+        :return: A dictionary of file name to entry. It is shared, so don't modify it.
+        """
+        if not os.path.exists(self.path):
+            self.rebuild()
+
+        with Manifest._lock:
+            with open(self.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                state = Manifest._states.get(self.path)
+                # A rebuild or compaction replaces the file, so start again from the top
+                if state is None or state["inode"] != stat.st_ino or state["offset"] > stat.st_size:
+                    state = Manifest._states[self.path] = {"inode": stat.st_ino, "offset": 0, "lines": 0, "entries": {}}
+                Manifest.replay(state, f)
+            Manifest._appended[self.path] = 0
+
+            superseded = state["lines"] - len(state["entries"])
+            if superseded >= max(self.compact_lines, len(state["entries"])):
+                self.compact(state)
+            return state["entries"]
+
+    @staticmethod
+    def replay(state, f):
+        """
+        Apply the lines of the log after the state's offset to its entries.
+        :param state: The replayed state, with "offset", "lines" and "entries".
+        :param f: The log, opened for reading in binary mode.
+        """
+        f.seek(state["offset"])
+        contents = f.read()
+
+        # A line without its newline is still being written, so leave it for next time
+        complete = contents[:contents.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            state["lines"] += 1
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("removed"):
+                state["entries"].pop(entry["file"], None)
+            else:
+                state["entries"][entry["file"]] = entry
+        state["offset"] += len(complete)
+
+    def compact(self, state):
+        """
+        Rewrite the log with only its current entries. Appends wait for the rewrite, and lines
+        appended since the log was replayed are applied first, so none are lost.
+        The caller holds the manifest lock.
+        :param state: The replayed state of the log.
+        """
+        lines = state["lines"]
+        fd = self.open_locked(os.O_RDONLY, fcntl.LOCK_EX)
+        try:
+            # Another process rebuilt or compacted the log since it was replayed
+            if os.fstat(fd).st_ino != state["inode"]:
+                return
+            with os.fdopen(os.dup(fd), "rb") as f:
+                Manifest.replay(state, f)
+            with Metrics.timer("manifest"):
+                stat = self.write(state["entries"].values())
+        finally:
+            os.close(fd)
+
+        state.update({"inode": stat.st_ino, "offset": stat.st_size, "lines": len(state["entries"])})
+        Debug.info("Compacted %s from %s lines to %s", self.path, lines, len(state["entries"]))
+
+    def select(self, name, serial_numbers=None, start=None, end=None):
+        """
+        Pick the indexed files holding one kind of data, without listing the directory.
+        :param name: The data name, e.g. "device_history_query".
+        :param serial_numbers: The serial numbers to include. Defaults to every device.
+        :param start: The first day to include, as "YYYY-MM-DD". Defaults to the earliest.
+        :param end: The last day to include, as "YYYY-MM-DD". Defaults to the latest.
+        :return: A list of entries in date then serial number order. Monthly archives are
+            included when the month overlaps the range.
+        """
+        selected = []
+        for entry in self.entries().values():
+            date = entry.get("date")
+            if entry["name"] != name or (serial_numbers and entry.get("serial") not in serial_numbers):
+                continue
+            if date and start and date < start[:len(date)]:
+                continue
+            if date and end and date > end[:len(date)]:
+                continue
+            selected.append(entry)
+
+        return sorted(selected, key=lambda entry: (entry.get("date") or "", entry.get("serial") or ""))
+
+    def load(self, name, serial_numbers=None, start=None, end=None, max_workers=None):
+        """
+        Decode the saved files for one kind of data across a process pool, streaming the results back
+        in date order. History is decoded to Records and reports to a Record, so only compact columns
+        cross between processes; other data comes back as the response dictionary.
+        Days compacted into monthly archives are decoded one day at a time.
+        Only a few files per process are in flight, so memory stays bounded however much is loaded.
+        :param name: The data name, e.g. "device_history_query".
+        :param serial_numbers: The serial numbers to include. Defaults to every device.
+        :param start: The first day to include, as "YYYY-MM-DD".
+        :param end: The last day to include, as "YYYY-MM-DD".
+        :param max_workers: The number of processes. Defaults to FOX_LOAD_WORKERS, or one per core.
+        :return: A generator of (serial_number, date, decoded) tuples.
+        """
+        tasks = []
+        for entry in self.select(name, serial_numbers, start, end):
+            file_path = os.path.join(self.data_dir, entry["file"])
+            date = entry.get("date")
+            if date and len(date) == 7:
+                # Imported here as only history has monthly archives
+                from retention import Retention
+
+                for day in sorted(Retention.read_month(file_path)):
+                    if (not start or day >= start) and (not end or day <= end):
+                        tasks.append((name, file_path, entry["serial"], day, None))
+            else:
+                tasks.append((name, file_path, entry.get("serial"), date, entry.get("crc32")))
+        tasks.sort(key=lambda task: (task[3] or "", task[2] or ""))
+
+        max_workers = max_workers or Settings.load().get_int("FOX_LOAD_WORKERS") or os.cpu_count() or 1
+        Debug.info("Loading %s files of %s with %s processes", len(tasks), name, max_workers)
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(Manifest.decode, task))
+                if len(pending) >= max_workers * 4:
+                    yield from Manifest.get_result(pending.popleft())
+            while pending:
+                yield from Manifest.get_result(pending.popleft())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def get_result(future):
+        """
+        Unpack a decoded file, skipping files that failed to decode.
+        :param future: The future of a decode() call.
+        :return: A generator of the (serial_number, date, decoded) tuple, or nothing if decoding failed.
+        """
+        serial_number, date, decoded, error = future.result()
+        if error:
+            Debug.warning("Skipping %s %s: %s", serial_number, date, error)
+            return
+        Metrics.increment("loaded")
+        yield serial_number, date, decoded
+
+    @staticmethod
+    def decode(task):
+        """
+        Read and decode one saved file, in a worker process.
+        :param task: A tuple of (name, file path, serial number, date, expected checksum or None).
+            Without a checksum the file is a monthly archive and only the date is decoded.
+        :return: A tuple of (serial_number, date, decoded, error), where error is None on success.
+        """
+        # Imported here so the records are only loaded in processes that decode
+        from records import Records
+
+        name, file_path, serial_number, date, checksum = task
+        try:
+            if checksum is None:
+                from retention import Retention
+
+                response = Retention.read_day(serial_number, date, file_path)
+                return serial_number, date, [record.compact() for record in Records.from_history(response)], None
+
+            with open(file_path, "rb") as f:
+                payload = f.read()
+            if Manifest.checksum(payload) != checksum:
+                Debug.warning("%s has changed since it was indexed", file_path)
+            if file_path.endswith(".gz"):
+                payload = gzip.decompress(payload)
+            response = json.loads(payload)["response"]
+        except (OSError, ValueError, KeyError) as e:
+            return serial_number, date, None, f"{type(e).__name__}: {e}"
+
+        match name:
+            case "device_history_query":
+                decoded = [record.compact() for record in Records.from_history(response, file_path)]
+            case "device_report_query":
+                decoded = Records.from_report(response, serial_number, date, file_path).compact()
+            case _:
+                decoded = response
+        return serial_number, date, decoded, None
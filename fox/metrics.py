@@ -0,0 +1,183 @@
+# Global imports
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Local imports
+from settings import Settings
+
+class Metrics:
+
+    # Counters keyed by (metric, labels), where labels is a tuple of (name, value) pairs
+    _counters = {}
+
+    # Stage timings keyed by stage, as [count, total seconds, max seconds]
+    _timings = {}
+
+    _lock = threading.Lock()
+    _started = time.time()
+
+    # Help text for each metric, used in the Prometheus output
+    descriptions = {
+        "bytes_received": "Response bytes received from the API.",
+        "bytes_written": "Bytes written to the data directory.",
+        "cache_hits": "Data served from the memory or disk cache, or the monthly archives.",
+        "cache_misses": "Data fetched from the API because no valid cache was saved.",
+        "compacted": "Raw history days compacted into monthly archives.",
+        "coalesced": "Requests that waited for an identical request already in flight.",
+        "exported": "Samples exported from the data directory, by format.",
+        "loaded": "Saved files decoded by the bulk loader.",
+        "errors": "Failed API requests, by data name and whether they are worth retrying.",
+        "requests": "API responses received, by endpoint and status code.",
+        "retries": "API requests retried, by endpoint.",
+    }
+
+    @staticmethod
+    def increment(metric, value=1, **labels):
+        """
+        Add to a counter.
+        :param metric: The counter name, e.g. "cache_hits".
+        :param value: The amount to add.
+        :param labels: Labels identifying the series, e.g. name="device_list".
+        """
+        key = (metric, tuple(sorted(labels.items())))
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(stage, seconds):
+        """
+        Record how long a stage took.
+        :param stage: The stage name, e.g. "network".
+        :param seconds: The duration in seconds.
+        """
+        with Metrics._lock:
+            timing = Metrics._timings.setdefault(stage, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @staticmethod
+    @contextmanager
+    def timer(stage):
+        """
+        Time the enclosed block as a stage.
+        :param stage: The stage name, e.g. "network".
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            Metrics.observe(stage, time.perf_counter() - started)
+
+    @staticmethod
+    def reset():
+        """
+        Clear every counter and timing.
+        """
+        with Metrics._lock:
+            Metrics._counters.clear()
+            Metrics._timings.clear()
+            Metrics._started = time.time()
+
+    @staticmethod
+    def snapshot():
+        """
+        Get a copy of the current metrics.
+        :return: A dictionary with "uptime", "stages" and "counters".
+        """
+        with Metrics._lock:
+            return {
+                "uptime": time.time() - Metrics._started,
+                "stages": {
+                    stage: {"count": count, "total": total, "max": maximum}
+                    for stage, (count, total, maximum) in sorted(Metrics._timings.items())
+                },
+                "counters": [
+                    {"metric": metric, "labels": dict(labels), "value": value}
+                    for (metric, labels), value in sorted(Metrics._counters.items())
+                ],
+            }
+
+    @staticmethod
+    def summary():
+        """
+        Format the metrics as a human readable table.
+        :return: The summary as a string.
+        """
+        snapshot = Metrics.snapshot()
+        lines = [
+            f"Profile after {snapshot['uptime']:.3f}s",
+            "",
+            f"{'stage':<12}{'count':>8}{'total s':>12}{'mean ms':>12}{'max ms':>12}",
+        ]
+        for stage, timing in snapshot["stages"].items():
+            lines.append(
+                f"{stage:<12}{timing['count']:>8}{timing['total']:>12.3f}"
+                f"{timing['total'] / timing['count'] * 1000:>12.2f}{timing['max'] * 1000:>12.2f}"
+            )
+
+        lines.append("")
+        for counter in snapshot["counters"]:
+            labels = ", ".join(f"{name}={value}" for name, value in counter["labels"].items())
+            lines.append(f"{counter['metric']}{'{' + labels + '}' if labels else ''}: {counter['value']}")
+
+        return "\n".join(lines)
+
+    @staticmethod
+    def to_prometheus():
+        """
+        Format the metrics in the Prometheus text exposition format.
+        :return: The metrics as a string.
+        """
+        snapshot = Metrics.snapshot()
+        lines = [
+            "# HELP fox_uptime_seconds Seconds since metrics collection started.",
+            "# TYPE fox_uptime_seconds gauge",
+            f"fox_uptime_seconds {snapshot['uptime']:.3f}",
+            "# HELP fox_stage_seconds Time spent in each stage of the fetch pipeline.",
+            "# TYPE fox_stage_seconds summary",
+        ]
+        for stage, timing in snapshot["stages"].items():
+            lines.append(f'fox_stage_seconds_count{{stage="{stage}"}} {timing["count"]}')
+            lines.append(f'fox_stage_seconds_sum{{stage="{stage}"}} {timing["total"]:.6f}')
+
+        described = set()
+        for counter in snapshot["counters"]:
+            name = f"fox_{counter['metric']}_total"
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {Metrics.descriptions.get(counter['metric'], counter['metric'])}")
+                lines.append(f"# TYPE {name} counter")
+            labels = ",".join(f'{label}="{value}"' for label, value in counter["labels"].items())
+            lines.append(f"{name}{{{labels}}} {counter['value']}" if labels else f"{name} {counter['value']}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write(file_path=None):
+        """
+        Write the metrics to a file, replacing it atomically.
+        Files ending in .json are written as JSON, anything else in Prometheus text format.
+        :param file_path: The file to write. Defaults to FOX_METRICS_FILE; nothing is written if neither is set.
+        """
+        if not file_path:
+            file_path = Settings.load().get("FOX_METRICS_FILE")
+        if not file_path:
+            return
+
+        if file_path.endswith(".json"):
+            contents = json.dumps(Metrics.snapshot(), indent=4)
+        else:
+            contents = Metrics.to_prometheus()
+
+        directory = os.path.dirname(os.path.abspath(file_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(contents)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
@@ -1,5 +1,6 @@
 # Local imports
 from data import Data
+from pages import Pages
 
 class Module:
     @staticmethod
@@ -7,3 +8,20 @@ class Module:
         data = Data("module_list")
         data.set_params({"currentPage": current_page, "pageSize": page_size})
         return data.get()
+
+    @staticmethod
+    def module_list_all(page_size=100):
+        """
+        Get every module, walking all pages of the module list.
+        The assembled listing is cached as module_list.json.
+        """
+        return Pages.collect("module_list", page_size)
+
+    @staticmethod
+    def module_list_iter(page_size=100):
+        """
+        Iterate over every module, fetching pages ahead of the caller.
+        :param page_size: The number of modules to request per page.
+        :return: A generator of module dictionaries.
+        """
+        return Pages.iterate("module_list", page_size)
@@ -0,0 +1,121 @@
+# Global imports
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Local imports
+from cache import MemoryCache
+from data import Data
+from debug import Debug
+from errors import PermanentError
+from workers import Workers
+
+class Pages:
+    @staticmethod
+    def collect(name, page_size=100, max_workers=None):
+        """
+        Get every item of a paged listing as one response, cached as <name>.json.
+        :param name: "device_list", "module_list" or "plant_list".
+        :param page_size: The number of items to request per page.
+        :param max_workers: The maximum number of pages to fetch at once.
+        :return: A response dictionary in the same shape as a single page, holding every item.
+        """
+        data = Data(name)
+        cached = data.get_cached()
+        if cached is not None:
+            return cached
+
+        return Data.single_flight(data.get_file_path(), lambda: Pages.assemble(data, page_size, max_workers))
+
+    @staticmethod
+    def assemble(data, page_size, max_workers):
+        """
+        Fetch every page of a listing and save the assembled response.
+        :param data: The Data instance for the listing.
+        :param page_size: The number of items to request per page.
+        :param max_workers: The maximum number of pages to fetch at once.
+        :return: The assembled response dictionary.
+        """
+        cached = MemoryCache.get(data.get_file_path())
+        if cached and data.is_fresh(cached[1]):
+            return cached[0]
+
+        name = data.name
+        items = list(Pages.iterate(name, page_size, max_workers))
+        response = {
+            "errno": 0,
+            "msg": "success",
+            "result": {
+                "currentPage": 1,
+                "pageSize": len(items),
+                "total": len(items),
+                "data": items,
+            },
+        }
+        data.save_response_data(response)
+        MemoryCache.put(
+            data.get_file_path(),
+            response,
+            os.path.getsize(data.get_file_path()),
+            os.path.getmtime(data.get_file_path()),
+        )
+        Debug.info("Collected %s items for %s", len(items), name)
+        return response
+
+    @staticmethod
+    def fetch(name, current_page, page_size):
+        """
+        Get one page of a listing.
+        :param name: The data name.
+        :param current_page: The page number, starting at 1.
+        :param page_size: The number of items per page.
+        :return: A tuple of (items, total), where total is None if the response doesn't say.
+        """
+        data = Data(name)
+        data.set_params({"currentPage": current_page, "pageSize": page_size})
+        response = data.get()
+        if not response or "result" not in response:
+            raise PermanentError(f"Page {current_page} of {name} is empty or invalid.", name)
+
+        result = response["result"]
+        if isinstance(result, list):
+            return result, len(result)
+
+        return result.get("data") or [], result.get("total")
+
+    @staticmethod
+    def iterate(name, page_size=100, max_workers=None):
+        """
+        Iterate over every item of a paged listing.
+        Once the first page gives the total, the remaining pages are all fetched at once.
+        Without a total, the next page is fetched while the current one is consumed.
+        :param name: "device_list", "module_list" or "plant_list".
+        :param page_size: The number of items to request per page.
+        :param max_workers: The maximum number of pages to fetch at once.
+        :return: A generator of items, in page order.
+        """
+        items, total = Pages.fetch(name, 1, page_size)
+        if total is not None:
+            pages = math.ceil(int(total) / page_size)
+            if pages <= 1:
+                yield from items
+                return
+
+            max_workers = min(Workers.get_max_workers(max_workers), pages - 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Submit the other pages before yielding the first, so they load while it is consumed
+                futures = [executor.submit(Pages.fetch, name, page, page_size) for page in range(2, pages + 1)]
+                yield from items
+                for future in futures:
+                    yield from future.result()[0]
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = 1
+            while True:
+                future = executor.submit(Pages.fetch, name, page + 1, page_size) if len(items) == page_size else None
+                yield from items
+                if not future:
+                    return
+                items, _ = future.result()
+                page += 1
@@ -1,6 +1,7 @@
 # Local imports
 from data import Data
-from debug import Debug
+from errors import PermanentError
+from pages import Pages
 
 class Plant:
     @staticmethod
@@ -10,15 +11,32 @@ class Plant:
         data.set_params(request_param)
         return data.get()
 
+    @staticmethod
+    def plant_list_all(page_size=100):
+        """
+        Get every plant, walking all pages of the plant list.
+        The assembled listing is cached as plant_list.json.
+        """
+        return Pages.collect("plant_list", page_size)
+
+    @staticmethod
+    def plant_list_iter(page_size=100):
+        """
+        Iterate over every plant, fetching pages ahead of the caller.
+        :param page_size: The number of plants to request per page.
+        :return: A generator of plant dictionaries.
+        """
+        return Pages.iterate("plant_list", page_size)
+
     @staticmethod
     def plant_detail(plant_id=None):
         if not plant_id:
             # Fetch the plant list and get the first plant's ID
             plant_list = Plant.plant_list()
             if not plant_list or "result" not in plant_list or "data" not in plant_list["result"]:
-                Debug.error("Plant list is empty or invalid.")
+                raise PermanentError("Plant list is empty or invalid.")
             if len(plant_list["result"]["data"]) == 0:
-                Debug.error("No plants found in the list.")
+                raise PermanentError("No plants found in the list.")
             plant_id = plant_list["result"]["data"][0]["stationID"]
 
         request_param = {"id": plant_id}
@@ -0,0 +1,340 @@
+# Global imports
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Local imports
+from api import API
+from data import Data
+from debug import Debug
+from device import Device
+from errors import Errors, RetryableError
+from metrics import Metrics
+from records import Series
+from settings import Settings
+from workers import Workers
+
+class SampleLog:
+    """
+    An append-only log of one device's real-time samples for one day.
+
+    Each record is a type byte then varints. A variables record lists the variable names.
+    A sample record holds the zigzag-encoded change in timestamp, a bitmap of the variables
+    present, and the zigzag-encoded change in each present value, scaled to an integer.
+    Each value is stored as its change from the previous sample of the same variable, so a
+    slowly changing value takes a byte or two.
+    """
+
+    VARIABLES = 1
+    SAMPLE = 2
+
+    # Values are stored to three decimal places
+    scale = 1000
+
+    def __init__(self, path):
+        """
+        Open a log, recovering its last state and dropping any record cut short by a crash.
+        :param path: The log file.
+        """
+        self.path = path
+        self._variables = []
+        self._timestamp = 0
+        self._values = []
+        self._lock = threading.Lock()
+
+        size = 0
+        end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                contents = f.read()
+            size = len(contents)
+            for end, _, timestamp, variables, values, _ in SampleLog.decode(contents):
+                self._timestamp = timestamp
+                self._variables = variables
+                self._values = values
+        if end < size:
+            Debug.warning("Dropping %s bytes of a partly written record from %s", size - end, path)
+            with open(path, "r+b") as f:
+                f.truncate(end)
+
+    @staticmethod
+    def encode_varint(value, out):
+        """
+        Append an unsigned integer as a varint.
+        :param value: The integer, zero or more.
+        :param out: The bytearray to append to.
+        """
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def decode_varint(contents, offset):
+        """
+        Read a varint.
+        :param contents: The bytes to read from.
+        :param offset: The offset of the varint.
+        :return: A tuple of (value, offset after the varint).
+        :raises IndexError: If the varint is cut short.
+        """
+        value = 0
+        shift = 0
+        while True:
+            byte = contents[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, offset
+            shift += 7
+
+    @staticmethod
+    def decode(contents):
+        """
+        Decode the records of a log.
+        :param contents: The bytes of the log.
+        :return: A generator of (end offset, record type, timestamp, variables, scaled values, present)
+            tuples, one per record, stopping at the first record cut short. Values carry forward from
+            earlier samples; present is the bitmap of the variables this record sampled.
+        """
+        offset = 0
+        timestamp = 0
+        variables = []
+        values = []
+        present = 0
+        while offset < len(contents):
+            try:
+                kind = contents[offset]
+                position = offset + 1
+                if kind == SampleLog.VARIABLES:
+                    count, position = SampleLog.decode_varint(contents, position)
+                    names = []
+                    for _ in range(count):
+                        length, position = SampleLog.decode_varint(contents, position)
+                        if position + length > len(contents):
+                            raise IndexError
+                        names.append(contents[position:position + length].decode("utf-8"))
+                        position += length
+                    variables = names
+                    values = [None] * count
+                    present = 0
+                elif kind == SampleLog.SAMPLE:
+                    delta, position = SampleLog.decode_varint(contents, position)
+                    present, position = SampleLog.decode_varint(contents, position)
+                    updated = list(values)
+                    for index in range(len(variables)):
+                        if present >> index & 1:
+                            change, position = SampleLog.decode_varint(contents, position)
+                            change = (change >> 1) ^ -(change & 1)
+                            updated[index] = (updated[index] or 0) + change
+                    timestamp += (delta >> 1) ^ -(delta & 1)
+                    values = updated
+                else:
+                    return
+            except IndexError:
+                return
+
+            offset = position
+            yield offset, kind, timestamp, variables, values, present
+
+    def append(self, timestamp, values):
+        """
+        Append a sample to the log.
+        :param timestamp: The Unix timestamp in seconds.
+        :param values: A dictionary of variable name to value. Missing or None values are skipped.
+        :return: The number of bytes appended.
+        """
+        with self._lock:
+            out = bytearray()
+            variables = list(values)
+            if not set(variables) <= set(self._variables):
+                # A new variable starts a new dictionary, and values restart from zero
+                out.append(SampleLog.VARIABLES)
+                SampleLog.encode_varint(len(variables), out)
+                for variable in variables:
+                    name = variable.encode("utf-8")
+                    SampleLog.encode_varint(len(name), out)
+                    out += name
+                self._variables = variables
+                self._values = [None] * len(variables)
+
+            out.append(SampleLog.SAMPLE)
+            delta = int(timestamp) - self._timestamp
+            SampleLog.encode_varint((delta << 1) ^ (delta >> 63), out)
+            present = 0
+            changes = bytearray()
+            for index, variable in enumerate(self._variables):
+                value = values.get(variable)
+                if value is None or (isinstance(value, float) and math.isnan(value)):
+                    continue
+                scaled = round(float(value) * self.scale)
+                change = scaled - (self._values[index] or 0)
+                SampleLog.encode_varint((change << 1) ^ (change >> 63), changes)
+                present |= 1 << index
+                self._values[index] = scaled
+            SampleLog.encode_varint(present, out)
+            out += changes
+            self._timestamp = int(timestamp)
+
+            # One small append per poll, never a rewrite
+            with open(self.path, "ab") as f:
+                f.write(out)
+            return len(out)
+
+    @staticmethod
+    def read(path):
+        """
+        Read the samples of a log.
+        :param path: The log file.
+        :return: A generator of (timestamp, values) tuples, where values maps variable names to floats.
+        """
+        with open(path, "rb") as f:
+            contents = f.read()
+        for _, kind, timestamp, variables, values, present in SampleLog.decode(contents):
+            if kind == SampleLog.SAMPLE:
+                yield timestamp, {
+                    variable: values[index] / SampleLog.scale
+                    for index, variable in enumerate(variables)
+                    if present >> index & 1
+                }
+
+class Realtime:
+
+    # Variables polled unless FOX_REALTIME_VARIABLES overrides them
+    variables = [
+        "pvPower",
+        "loadsPower",
+        "gridConsumptionPower",
+        "feedinPower",
+        "batChargePower",
+        "batDischargePower",
+        "SoC",
+    ]
+
+    def __init__(self, serial_numbers=None, variables=None, interval=None):
+        """
+        :param serial_numbers: The devices to poll. Defaults to every device.
+        :param variables: The variables to poll. Defaults to FOX_REALTIME_VARIABLES.
+        :param interval: Seconds between polls. Defaults to FOX_REALTIME_INTERVAL, or 60.
+        """
+        settings = Settings.load()
+        self.serial_numbers = serial_numbers
+        self.variables = variables or [
+            variable.strip() for variable in settings.get("FOX_REALTIME_VARIABLES", "").split(",") if variable.strip()
+        ] or self.variables
+        self.interval = float(interval or settings.get_float("FOX_REALTIME_INTERVAL", 60))
+        self.retention_days = settings.get_int("FOX_REALTIME_RETENTION_DAYS", 30)
+        self.log_dir = Realtime.get_log_dir()
+        self._logs = {}
+        self._logs_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @staticmethod
+    def get_log_dir():
+        """
+        Get the directory of the real-time logs.
+        :return: The directory path as a string.
+        """
+        return Settings.load().get("FOX_REALTIME_DIR") or os.path.join(Data.get_data_dir(), "realtime")
+
+    @staticmethod
+    def get_log_path(serial_number, date):
+        """
+        Get the path of a device's log for one day.
+        :param serial_number: The serial number of the device.
+        :param date: The day as a "YYYY-MM-DD" string.
+        :return: The file path as a string.
+        """
+        return os.path.join(Realtime.get_log_dir(), serial_number, f"{date}.log")
+
+    def get_log(self, serial_number, timestamp):
+        """
+        Get the open log for a device on the day of a timestamp.
+        :param serial_number: The serial number of the device.
+        :param timestamp: The Unix timestamp of the sample.
+        :return: A SampleLog.
+        """
+        date = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+        with self._logs_lock:
+            log = self._logs.get(serial_number)
+            if log is None or log[0] != date:
+                path = Realtime.get_log_path(serial_number, date)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                log = self._logs[serial_number] = (date, SampleLog(path))
+                self.prune(serial_number)
+            return log[1]
+
+    def poll(self, serial_number):
+        """
+        Get the latest values for one device and append them to its log.
+        :param serial_number: The serial number of the device.
+        :return: The number of bytes appended.
+        """
+        api = API()
+        api.set_name("device_real_query")
+        api.set_params({"sn": serial_number, "variables": self.variables})
+        response = api.send_request()
+        try:
+            parsed = response.json()
+        except ValueError:
+            parsed = None
+        Errors.check_response("device_real_query", response.status_code, parsed)
+
+        written = 0
+        for device in parsed.get("result") or []:
+            timestamp = Series.parse_time(device["time"]) if device.get("time") else int(time.time())
+            values = {data.get("variable"): data.get("value") for data in device.get("datas") or []}
+            written += self.get_log(device.get("deviceSN") or serial_number, timestamp).append(timestamp, values)
+
+        Metrics.increment("bytes_written", written, name="device_real_query")
+        return written
+
+    def poll_all(self):
+        """
+        Poll every device once, in parallel.
+        :return: A tuple of (results, errors) dictionaries keyed by serial number.
+        """
+        if not self.serial_numbers:
+            self.serial_numbers = Device.serials()
+
+        results, errors = Workers.map(self.poll, self.serial_numbers)
+        for serial_number, error in errors.items():
+            Debug.warning("Real-time poll failed for %s: %s", serial_number, error)
+        return results, errors
+
+    def prune(self, serial_number):
+        """
+        Remove a device's logs older than the retention period.
+        :param serial_number: The serial number of the device.
+        """
+        if not self.retention_days:
+            return
+
+        device_dir = os.path.join(self.log_dir, serial_number)
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        for file_name in os.listdir(device_dir):
+            if file_name.endswith(".log") and file_name[:-4] < cutoff:
+                os.remove(os.path.join(device_dir, file_name))
+                Debug.info("Removed expired real-time log %s/%s", serial_number, file_name)
+
+    def run(self):
+        """
+        Poll every device at a fixed cadence until stopped.
+        Polls are aligned to the interval, so a slow poll doesn't push later ones back.
+        """
+        Debug.info("Polling %s variables every %ss", len(self.variables), self.interval)
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                self.poll_all()
+            except RetryableError as e:
+                Debug.warning("Real-time poll failed: %s", e)
+            self._stop.wait(self.interval - (time.time() - started) % self.interval)
+
+    def stop(self):
+        """
+        Stop polling after the current poll.
+        """
+        self._stop.set()
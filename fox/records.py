@@ -0,0 +1,315 @@
+# Global imports
+import math
+from array import array
+from datetime import datetime, timedelta, timezone
+
+# Local imports
+from data import Data
+from debug import Debug
+from device import Device
+from samples import Samples
+
+class Series:
+    """
+    One variable's samples, held as two compact columns: Unix timestamps and float values.
+    The raw samples are only decoded when the columns are first used, and are then released.
+    Missing values are NaN, so the columns stay aligned with the raw samples.
+    """
+
+    __slots__ = ("variable", "unit", "name", "_samples", "_times", "_values")
+
+    # Start of day timestamps by date and time zone suffix, e.g. "2024-01-01 CST+0800"
+    _days = {}
+
+    def __init__(self, variable, unit=None, name=None, samples=None, times=None, values=None):
+        """
+        :param variable: The variable, e.g. "pvPower".
+        :param unit: The unit, e.g. "kW".
+        :param name: The display name.
+        :param samples: The raw FoxESS samples, a list of {"time", "value"} dictionaries.
+        :param times: Already decoded timestamps, instead of samples.
+        :param values: Already decoded values, instead of samples.
+        """
+        self.variable = variable
+        self.unit = unit
+        self.name = name
+        self._samples = samples
+        self._times = times
+        self._values = values
+
+    def __len__(self):
+        if self._samples is not None:
+            return len(self._samples)
+        return len(self._values) if self._values is not None else 0
+
+    def __iter__(self):
+        """
+        Iterate over the samples.
+        :return: A generator of (timestamp, value) tuples.
+        """
+        return zip(self.times, self.values)
+
+    def __repr__(self):
+        return f"Series({self.variable!r}, unit={self.unit!r}, samples={len(self)})"
+
+    @property
+    def decoded(self):
+        return self._samples is None
+
+    @property
+    def times(self):
+        """
+        The timestamps, in seconds since the epoch.
+        :return: An array of signed 64-bit integers.
+        """
+        self.decode()
+        return self._times
+
+    @property
+    def values(self):
+        """
+        The values, with NaN for missing samples.
+        :return: An array of doubles.
+        """
+        self.decode()
+        return self._values
+
+    def decode(self):
+        """
+        Decode the raw samples into the time and value columns, then drop the raw samples.
+        """
+        if self._samples is None:
+            if self._times is None:
+                self._times, self._values = array("q"), array("d")
+            return
+
+        times = array("q", bytes(8 * len(self._samples)))
+        values = array("d", bytes(8 * len(self._samples)))
+        for index, sample in enumerate(self._samples):
+            times[index] = Series.parse_time(sample["time"])
+            value = sample.get("value")
+            values[index] = math.nan if value is None else float(value)
+
+        self._times, self._values, self._samples = times, values, None
+
+    @staticmethod
+    def parse_time(text):
+        """
+        Parse a FoxESS time string into a Unix timestamp.
+        This is Samples.parse_time(), with the start of each day parsed once per time zone suffix.
+        :param text: The time, e.g. "2024-01-01 00:05:10 CST+0800".
+        :return: The timestamp in seconds as an integer.
+        """
+        key = text[:10] + text[19:]
+        day = Series._days.get(key)
+        if day is None:
+            match = Samples._offset_pattern.search(text)
+            if not match:
+                # Without an offset the time is local, so days may not be 86400 seconds long
+                return Samples.parse_time(text)
+            offset = timedelta(hours=int(match.group(2)), minutes=int(match.group(3)))
+            zone = timezone(-offset if match.group(1) == "-" else offset)
+            day = Series._days[key] = int(datetime.fromisoformat(text[:10]).replace(tzinfo=zone).timestamp())
+
+        return day + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+
+class Record:
+    """
+    A decoded response for one device, keyed by variable.
+    The raw JSON is not held in memory when the record came from a saved file; raw reads it back.
+    """
+
+    __slots__ = ("name", "serial", "series", "file_path", "_raw")
+
+    def __init__(self, name, serial, series, file_path=None, raw=None):
+        """
+        :param name: The data name, e.g. "device_history_query".
+        :param serial: The serial number of the device.
+        :param series: A dictionary of variable name to Series.
+        :param file_path: The saved file the record was decoded from.
+        :param raw: The raw response, kept when there is no saved file to read back.
+        """
+        self.name = name
+        self.serial = serial
+        self.series = series
+        self.file_path = file_path
+        self._raw = None if file_path else raw
+
+    def __contains__(self, variable):
+        return variable in self.series
+
+    def __getitem__(self, variable):
+        return self.series[variable]
+
+    def __iter__(self):
+        return iter(self.series.values())
+
+    def __repr__(self):
+        return f"Record({self.name!r}, {self.serial!r}, variables={list(self.series)})"
+
+    @property
+    def raw(self):
+        """
+        The raw response the record was decoded from.
+        :return: The response as a dictionary.
+        """
+        if self._raw is None and self.file_path:
+            return Data.read_file(self.file_path)
+        return self._raw
+
+    @property
+    def variables(self):
+        return list(self.series)
+
+    def compact(self):
+        """
+        Decode every series, releasing the raw samples, so the record holds only its columns.
+        :return: The record itself.
+        """
+        for series in self.series.values():
+            series.decode()
+        return self
+
+class Generation:
+    """
+    A decoded device_generation response, in kWh.
+    """
+
+    __slots__ = ("serial", "today", "month", "cumulative")
+
+    def __init__(self, serial, today=math.nan, month=math.nan, cumulative=math.nan):
+        self.serial = serial
+        self.today = today
+        self.month = month
+        self.cumulative = cumulative
+
+    def __repr__(self):
+        return (
+            f"Generation({self.serial!r}, today={self.today}, month={self.month}, cumulative={self.cumulative})"
+        )
+
+    @property
+    def raw(self):
+        return {"errno": 0, "result": {"today": self.today, "month": self.month, "cumulative": self.cumulative}}
+
+class Records:
+
+    @staticmethod
+    def from_history(response, file_path=None):
+        """
+        Decode a device_history_query response. The samples are decoded lazily, per variable.
+        :param response: The response from the API as a dictionary.
+        :param file_path: The saved file the response was read from.
+        :return: A list of Records, one per device in the response.
+        """
+        records = []
+        for device in (response or {}).get("result") or []:
+            series = {}
+            for data in device.get("datas") or []:
+                variable = data.get("variable")
+                series[variable] = Series(variable, data.get("unit"), data.get("name"), data.get("data") or [])
+            records.append(Record("device_history_query", device.get("deviceSN"), series, file_path, response))
+        return records
+
+    @staticmethod
+    def from_report(response, serial_number, date, file_path=None):
+        """
+        Decode a daily device_report_query response into hourly series.
+        The response has no times, so each value is stamped with the start of its hour in local time.
+        :param response: The response from the API as a dictionary.
+        :param serial_number: The serial number of the device.
+        :param date: The day of the report, as a date or "YYYY-MM-DD".
+        :param file_path: The saved file the response was read from.
+        :return: A Record.
+        """
+        start = int(datetime.strptime(Data.get_day(date).file_string, "%Y-%m-%d").timestamp())
+        series = {}
+        for data in (response or {}).get("result") or []:
+            variable = data.get("variable")
+            values = array("d", (math.nan if value is None else float(value) for value in data.get("values") or []))
+            times = array("q", range(start, start + 3600 * len(values), 3600))
+            series[variable] = Series(variable, data.get("unit"), data.get("name"), times=times, values=values)
+        return Record("device_report_query", serial_number, series, file_path, response)
+
+    @staticmethod
+    def from_generation(response, serial_number):
+        """
+        Decode a device_generation response.
+        :param response: The response from the API as a dictionary.
+        :param serial_number: The serial number of the device.
+        :return: A Generation.
+        """
+        result = (response or {}).get("result") or {}
+        return Generation(
+            serial_number,
+            *(math.nan if result.get(field) is None else float(result[field]) for field in Generation.__slots__[1:]),
+        )
+
+    @staticmethod
+    def history(serial_number=None, date=None):
+        """
+        Get the history for a device for one day, as Records.
+        :param serial_number: The serial number of the device. Defaults to the first device.
+        :param date: The day to fetch, as a date or "YYYY-MM-DD". Defaults to yesterday.
+        :return: A list of Records, usually one.
+        """
+        response = Device.history_query(serial_number, date)
+        records = Records.from_history(response)
+        day = Data.get_day(date) if date else Data.get_yesterday()
+        for record in records:
+            file_path = Data(
+                "device_history_query", {"sn": record.serial, "begin": day.begin_time}
+            ).get_saved_file_path()
+            if file_path:
+                record.file_path, record._raw = file_path, None
+        return records
+
+    @staticmethod
+    def report(serial_number=None, date=None):
+        """
+        Get the daily report for a device, as a Record of hourly series.
+        :param serial_number: The serial number of the device. Defaults to the first device.
+        :param date: The day to fetch, as a date or "YYYY-MM-DD". Defaults to yesterday.
+        :return: A Record.
+        """
+        if not serial_number:
+            serial_number = Device.detail()["result"]["deviceSN"]
+        day = Data.get_day(date) if date else Data.get_yesterday()
+        response = Device.report_query(serial_number, day.file_string)
+        year, month, day_of_month = (int(part) for part in day.file_string.split("-"))
+        file_path = Data(
+            "device_report_query", {"sn": serial_number, "year": year, "month": month, "day": day_of_month}
+        ).get_saved_file_path()
+        return Records.from_report(response, serial_number, day.file_string, file_path)
+
+    @staticmethod
+    def generation(serial_number=None):
+        """
+        Get the generation totals for a device.
+        :param serial_number: The serial number of the device. Defaults to the first device.
+        :return: A Generation.
+        """
+        if not serial_number:
+            serial_number = Device.detail()["result"]["deviceSN"]
+        return Records.from_generation(Device.generation(serial_number), serial_number)
+
+    @staticmethod
+    def read(name, file_path, serial_number=None, date=None):
+        """
+        Decode a saved response file, without keeping its raw JSON in memory.
+        :param name: The data name of the file.
+        :param file_path: The path to the saved file.
+        :param serial_number: The serial number, needed for reports and generation.
+        :param date: The day, needed for reports.
+        :return: A list of Records for history, a Record for reports or a Generation.
+        """
+        response = Data.read_file(file_path)
+        match name:
+            case "device_history_query":
+                return Records.from_history(response, file_path)
+            case "device_report_query":
+                return Records.from_report(response, serial_number, date, file_path)
+            case "device_generation":
+                return Records.from_generation(response, serial_number)
+
+        Debug.error("No record type for %s.", name)
@@ -0,0 +1,317 @@
+# Global imports
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+
+# Local imports
+from cache import MemoryCache
+from data import Data
+from debug import Debug
+from manifest import Manifest
+from metrics import Metrics
+from settings import Settings
+from store import Store
+from workers import Workers
+
+class Retention:
+    """
+    Retention tiers for saved history. Raw samples are kept for FOX_RETENTION_RAW_DAYS, then each day
+    is downsampled to hourly min, max, mean, sum and count per variable and packed into one file per
+    device per month. After FOX_RETENTION_HOURLY_DAYS the hourly aggregates are downsampled to daily.
+    Data reads compacted days from the monthly files, so the files in the data directory grow with
+    the number of months rather than days.
+    """
+
+    # Monthly archives, e.g. device_history_query_123456789_2024-01.compact.json.gz
+    month_pattern = re.compile(r"^device_history_query_(.+)_(\d{4}-\d{2})\.compact\.json\.gz$")
+
+    # The aggregates kept for each period
+    aggregates = ("min", "max", "mean", "sum", "count")
+
+    def __init__(self, raw_days=None, hourly_days=None):
+        """
+        :param raw_days: Days to keep raw samples. Defaults to FOX_RETENTION_RAW_DAYS, or 90.
+        :param hourly_days: Days to keep hourly aggregates, after which only daily ones are kept.
+            Defaults to FOX_RETENTION_HOURLY_DAYS, or 730. Zero keeps them forever.
+        """
+        settings = Settings.load()
+        self.raw_days = settings.get_int("FOX_RETENTION_RAW_DAYS", 90) if raw_days is None else raw_days
+        self.hourly_days = settings.get_int("FOX_RETENTION_HOURLY_DAYS", 730) if hourly_days is None else hourly_days
+
+    @staticmethod
+    def get_month_path(serial_number, month):
+        """
+        Get the path of a device's archive for one month.
+        :param serial_number: The serial number of the device.
+        :param month: The month as a "YYYY-MM" string.
+        :return: The file path as a string.
+        """
+        return Data.get_archive_path(serial_number, month)
+
+    @staticmethod
+    def read_month(file_path):
+        """
+        Read a monthly archive, from memory if it hasn't changed since it was last read.
+        :param file_path: The path of the archive.
+        :return: A dictionary of "YYYY-MM-DD" to the day's aggregates, or an empty dictionary if there is no archive.
+        """
+        try:
+            mtime = os.path.getmtime(file_path)
+        except FileNotFoundError:
+            return {}
+
+        cached = MemoryCache.get(file_path)
+        if cached and cached[1] == mtime:
+            return cached[0]
+
+        with Metrics.timer("read"), gzip.open(file_path, "rt", encoding="utf-8") as f:
+            days = json.load(f)["days"]
+        MemoryCache.put(file_path, days, os.path.getsize(file_path), mtime)
+        return days
+
+    @staticmethod
+    def write_month(file_path, days):
+        """
+        Write a monthly archive atomically, so a crash never leaves a partly written file behind.
+        :param file_path: The path of the archive.
+        :param days: A dictionary of "YYYY-MM-DD" to the day's aggregates.
+        """
+        directory = os.path.dirname(file_path)
+        payload = gzip.compress(
+            json.dumps({"days": dict(sorted(days.items()))}, separators=(",", ":")).encode("utf-8"), mtime=0
+        )
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with Metrics.timer("write"), os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, file_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        MemoryCache.invalidate(file_path)
+        Metrics.increment("bytes_written", len(payload), name="compact")
+        Manifest(directory).record(file_path, payload)
+
+    @staticmethod
+    def get_days(serial_number, data_dir=None):
+        """
+        Get the days compacted into a device's monthly archives.
+        :param serial_number: The serial number of the device.
+        :param data_dir: The data directory. Defaults to FOX_DATA_DIR.
+        :return: A set of "YYYY-MM-DD" strings.
+        """
+        data_dir = data_dir or Data.get_data_dir()
+        if not os.path.isdir(data_dir):
+            return set()
+
+        days = set()
+        for file_name in os.listdir(data_dir):
+            match = Retention.month_pattern.match(file_name)
+            if match and match.group(1) == serial_number:
+                days.update(Retention.read_month(os.path.join(data_dir, file_name)))
+        return days
+
+    @staticmethod
+    def read_day(serial_number, date, file_path=None):
+        """
+        Read a compacted day back as a device_history_query response, marked with "compacted".
+        Each sample is one period's mean, stamped with the period's start, and also carries the
+        period's length in seconds as "period", and its min, max, sum and count. Callers that
+        resample should spread each sample over its period with Samples.spread().
+        :param serial_number: The serial number of the device.
+        :param date: The day as a "YYYY-MM-DD" string.
+        :param file_path: The month's archive. Defaults to the archive in the data directory.
+        :return: The response as a dictionary, or None if the day isn't compacted.
+        """
+        file_path = file_path or Retention.get_month_path(serial_number, date[:7])
+        day = Retention.read_month(file_path).get(date)
+        if day is None:
+            return None
+
+        step = 3600 if day["resolution"] == "hour" else 86400
+        datas = []
+        for series in day["datas"]:
+            data = []
+            for index, start in enumerate(series["start"]):
+                seconds = start * step
+                sample = {
+                    "time": f"{date} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:00{day['zone']}",
+                    "value": series["mean"][index],
+                    "period": step,
+                }
+                for aggregate in ("min", "max", "sum", "count"):
+                    sample[aggregate] = series[aggregate][index]
+                data.append(sample)
+            datas.append({"variable": series["variable"], "unit": series.get("unit"), "name": series.get("name"), "data": data})
+
+        return {
+            "errno": 0,
+            "msg": "success",
+            "compacted": day["resolution"],
+            "result": [{"deviceSN": serial_number, "datas": datas}],
+        }
+
+    @staticmethod
+    def aggregate_hours(response):
+        """
+        Downsample a day of raw history to hourly aggregates, in wall-clock hours.
+        :param response: The device_history_query response for one day.
+        :return: The day's aggregates as a dictionary. A day without samples has no series, so the
+            archive still records that it was fetched.
+        """
+        zone = None
+        datas = []
+        for device in (response or {}).get("result") or []:
+            for series in device.get("datas") or []:
+                samples = [sample for sample in series.get("data") or [] if sample.get("value") is not None]
+                if not samples:
+                    continue
+                if zone is None:
+                    zone = samples[0]["time"][19:]
+
+                hours = np.array([int(sample["time"][11:13]) for sample in samples])
+                values = np.array([sample["value"] for sample in samples], dtype=np.float64)
+                start, index = np.unique(hours, return_inverse=True)
+                datas.append(Retention.reduce(series, start, index, values, values, values, values))
+
+        return {"resolution": "hour", "zone": zone or "", "datas": datas}
+
+    @staticmethod
+    def aggregate_day(day):
+        """
+        Downsample a day of hourly aggregates to one daily aggregate per variable.
+        :param day: The day's hourly aggregates.
+        :return: The day's daily aggregates.
+        """
+        datas = []
+        for series in day["datas"]:
+            index = np.zeros(len(series["start"]), dtype=np.int64)
+            datas.append(Retention.reduce(
+                series,
+                np.zeros(1, dtype=np.int64),
+                index,
+                np.array(series["min"], dtype=np.float64),
+                np.array(series["max"], dtype=np.float64),
+                np.array(series["sum"], dtype=np.float64),
+                np.array(series["count"], dtype=np.float64),
+                counted=True,
+            ))
+        return {"resolution": "day", "zone": day["zone"], "datas": datas}
+
+    @staticmethod
+    def reduce(series, start, index, minimums, maximums, sums, counts, counted=False):
+        """
+        Combine samples or finer aggregates into one aggregate per period.
+        :param series: The series the values belong to, for its variable, unit and name.
+        :param start: The start of each period, in periods since midnight.
+        :param index: The period each value falls in.
+        :param minimums: The minimum of each value.
+        :param maximums: The maximum of each value.
+        :param sums: The sum of each value.
+        :param counts: The sample count of each value, when counted, else ignored.
+        :param counted: Whether the values are aggregates with counts, rather than samples.
+        :return: The series' aggregates as a dictionary.
+        """
+        periods = len(start)
+        low = np.full(periods, np.inf)
+        high = np.full(periods, -np.inf)
+        np.minimum.at(low, index, minimums)
+        np.maximum.at(high, index, maximums)
+        total = np.bincount(index, weights=sums, minlength=periods)
+        count = np.bincount(index, weights=counts if counted else None, minlength=periods)
+        return {
+            "variable": series.get("variable"),
+            "unit": series.get("unit"),
+            "name": series.get("name"),
+            "start": start.tolist(),
+            "min": np.round(low, 4).tolist(),
+            "max": np.round(high, 4).tolist(),
+            "mean": np.round(total / count, 4).tolist(),
+            "sum": np.round(total, 4).tolist(),
+            "count": count.astype(np.int64).tolist(),
+        }
+
+    def compact(self, serial_numbers=None, today=None):
+        """
+        Compact raw history older than the raw window into monthly archives, and downsample
+        archived days older than the hourly window. Each archive is written before the raw files
+        it replaces are removed, so an interrupted run loses nothing and is finished by the next.
+        :param serial_numbers: The devices to compact. Defaults to every device with saved history.
+        :param today: The day retention is counted from. Defaults to today.
+        :return: A tuple of (results, errors) dictionaries keyed by (serial_number, month). Results
+            are the number of raw days compacted.
+        """
+        today = today or datetime.now()
+        raw_cutoff = (today - timedelta(days=self.raw_days)).strftime("%Y-%m-%d")
+        hourly_cutoff = (today - timedelta(days=self.hourly_days)).strftime("%Y-%m-%d") if self.hourly_days else None
+
+        data_dir = Data.get_data_dir()
+        if not os.path.isdir(data_dir):
+            return {}, {}
+
+        # One listing finds the raw days to compact and the archives that may need downsampling
+        months = {}
+        for file_name in os.listdir(data_dir):
+            match = Store.history_pattern.match(file_name)
+            if match:
+                serial_number, date = match.group(1), match.group(2)
+                if date < raw_cutoff:
+                    months.setdefault((serial_number, date[:7]), []).append(os.path.join(data_dir, file_name))
+                continue
+            match = Retention.month_pattern.match(file_name)
+            if match and hourly_cutoff and match.group(2) <= hourly_cutoff[:7]:
+                months.setdefault((match.group(1), match.group(2)), [])
+
+        if serial_numbers:
+            months = {key: files for key, files in months.items() if key[0] in serial_numbers}
+
+        Debug.info("Compacting %s device months of history", len(months))
+        return Workers.map(lambda key: self.compact_month(*key, months[key], hourly_cutoff), list(months))
+
+    def compact_month(self, serial_number, month, raw_files, hourly_cutoff=None):
+        """
+        Fold raw days into a device's archive for one month, and downsample its old hourly days.
+        :param serial_number: The serial number of the device.
+        :param month: The month as a "YYYY-MM" string.
+        :param raw_files: The raw history files to compact.
+        :param hourly_cutoff: Days before this "YYYY-MM-DD" keep only daily aggregates.
+        :return: The number of raw days compacted.
+        """
+        file_path = Retention.get_month_path(serial_number, month)
+        days = dict(Retention.read_month(file_path))
+        changed = False
+        compacted = []
+        for raw_file in sorted(raw_files):
+            date = Store.history_pattern.match(os.path.basename(raw_file)).group(2)
+            response = Data.read_file(raw_file)
+            if response.get("errno", 0) != 0:
+                Debug.warning("Not compacting saved error response %s", raw_file)
+                continue
+            # A raw file is newer than any archived copy of the same day
+            days[date] = Retention.aggregate_hours(response)
+            changed = True
+            compacted.append(raw_file)
+
+        if hourly_cutoff:
+            for date, day in days.items():
+                if day["resolution"] == "hour" and date < hourly_cutoff:
+                    days[date] = Retention.aggregate_day(day)
+                    changed = True
+
+        if changed:
+            Retention.write_month(file_path, days)
+        manifest = Manifest(os.path.dirname(file_path))
+        for raw_file in compacted:
+            os.remove(raw_file)
+            MemoryCache.invalidate(raw_file)
+            manifest.remove(raw_file)
+
+        Metrics.increment("compacted", len(compacted))
+        Debug.info("Compacted %s days of %s into %s", len(compacted), serial_number, os.path.basename(file_path))
+        return len(compacted)
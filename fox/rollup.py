@@ -0,0 +1,249 @@
+# Global imports
+import numpy as np
+
+# Local imports
+from backfill import Backfill
+from data import Data
+from debug import Debug
+from device import Device
+from records import Series
+from retention import Retention
+
+class Rollup:
+
+    # Report variables (hourly energy in kWh) and the totals they roll up into
+    energy_variables = {
+        "generation": "generation",
+        "feedin": "feedin",
+        "gridConsumption": "grid_consumption",
+        "chargeEnergyToTal": "charge",
+        "dischargeEnergyToTal": "discharge",
+    }
+
+    # History variables (power in kW) and the peaks they roll up into
+    peak_variables = {
+        "pvPower": "peak_pv",
+        "loadsPower": "peak_load",
+        "gridConsumptionPower": "peak_import",
+        "feedinPower": "peak_export",
+    }
+
+    periods = ("day", "week", "month")
+
+    @staticmethod
+    def get_periods(times, period):
+        """
+        Get the period each time falls in.
+        :param times: A numpy datetime64 array.
+        :param period: "day", "week" (starting on Monday) or "month".
+        :return: A numpy datetime64 array of period start dates.
+        """
+        days = times.astype("datetime64[D]")
+        match period:
+            case "day":
+                return days
+            case "week":
+                # Day 0 of the epoch was a Thursday, so shift back to the Monday
+                return days - (days.astype("int64") + 3) % 7
+            case "month":
+                return days.astype("datetime64[M]").astype("datetime64[D]")
+
+        Debug.error("Invalid rollup period: %s. Valid periods are: %s", period, ', '.join(Rollup.periods))
+
+    @staticmethod
+    def load_history(serial_numbers, start, end, variables=None, spacing=None, field="value"):
+        """
+        Load saved history samples into flat arrays.
+        Times are the device's wall-clock times, so days match the saved file dates.
+        Raw days are decoded into Series columns and compacted days read from their archive's
+        aggregate columns, so samples are never handled one at a time here.
+        :param serial_numbers: The serial numbers of the devices.
+        :param start: The first day to load.
+        :param end: The last day to load.
+        :param variables: The variables to load. Defaults to the peak variables.
+        :param spacing: Spread compacted samples over their periods every this many seconds,
+            for callers that resample. By default each compacted sample is loaded once.
+        :param field: The aggregate to load from compacted samples, e.g. "max" for peaks.
+            Raw samples only have a value, which is used whatever the field.
+        :return: A dictionary of variable name to a (times, values) tuple of numpy arrays.
+        """
+        variables = variables or list(Rollup.peak_variables)
+        times = {variable: [] for variable in variables}
+        values = {variable: [] for variable in variables}
+        for serial_number in serial_numbers:
+            for date in Backfill.get_dates(start, end):
+                day = Data.get_day(date)
+                data = Data("device_history_query", {"sn": serial_number, "begin": day.begin_time})
+                file_path = data.get_saved_file_path()
+                if file_path:
+                    columns = Rollup.read_raw(Data.read_file(file_path), times)
+                else:
+                    compacted = Retention.read_month(Data.get_archive_path(serial_number, date[:7])).get(date)
+                    if compacted is None:
+                        continue
+                    columns = Rollup.read_compacted(date, compacted, times, spacing, field)
+                for variable, series_times, series_values in columns:
+                    times[variable].append(series_times)
+                    values[variable].append(series_values)
+
+        return {
+            variable: (
+                np.concatenate(times[variable]) if times[variable] else np.array([], dtype="datetime64[s]"),
+                np.concatenate(values[variable]) if values[variable] else np.array([], dtype=np.float64),
+            )
+            for variable in variables
+        }
+
+    @staticmethod
+    def read_raw(response, variables):
+        """
+        Decode the raw samples of a day of history into wall-clock columns.
+        The Series columns are Unix timestamps, shifted to wall-clock time by the offset of each
+        series' first sample.
+        :param response: The device_history_query response.
+        :param variables: The variables to read.
+        :return: A generator of (variable, times, values) tuples of numpy arrays, without missing values.
+        """
+        for device in (response or {}).get("result") or []:
+            for data in device.get("datas") or []:
+                variable = data.get("variable")
+                samples = data.get("data")
+                if variable not in variables or not samples:
+                    continue
+
+                series = Series(variable, samples=samples)
+                timestamps = np.frombuffer(series.times, dtype=np.int64)
+                series_values = np.frombuffer(series.values, dtype=np.float64)
+                offset = np.datetime64(samples[0]["time"][:19], "s").astype(np.int64) - timestamps[0]
+                present = ~np.isnan(series_values)
+                yield variable, (timestamps[present] + offset).astype("datetime64[s]"), series_values[present]
+
+    @staticmethod
+    def read_compacted(date, day, variables, spacing=None, field="value"):
+        """
+        Read a compacted day's aggregate columns, stamped with each period's wall-clock start.
+        :param date: The day as a "YYYY-MM-DD" string.
+        :param day: The day's aggregates, from Retention.read_month().
+        :param variables: The variables to read.
+        :param spacing: Repeat each aggregate every this many seconds across its period.
+        :param field: The aggregate to read, or "value" for the mean.
+        :return: A generator of (variable, times, values) tuples of numpy arrays.
+        """
+        step = 3600 if day["resolution"] == "hour" else 86400
+        offsets = np.arange(0, step, min(spacing, step)) if spacing else np.zeros(1, dtype=np.int64)
+        midnight = np.datetime64(date, "s")
+        for series in day["datas"]:
+            if series["variable"] not in variables:
+                continue
+            starts = np.asarray(series["start"], dtype=np.int64) * step
+            series_times = midnight + (starts[:, None] + offsets).ravel().astype("timedelta64[s]")
+            series_values = np.repeat(
+                np.asarray(series[field if field in Retention.aggregates else "mean"], dtype=np.float64), len(offsets)
+            )
+            yield series["variable"], series_times, series_values
+
+    @staticmethod
+    def load_reports(serial_numbers, start, end):
+        """
+        Load saved daily reports into arrays of hourly energy.
+        :param serial_numbers: The serial numbers of the devices.
+        :param start: The first day to load.
+        :param end: The last day to load.
+        :return: A tuple of (days, energy), where days is a datetime64 array with
+            one entry per loaded report and energy maps each report variable to
+            an array of shape (len(days), 24) in kWh.
+        """
+        days = []
+        energy = {variable: [] for variable in Rollup.energy_variables}
+        for serial_number in serial_numbers:
+            for date in Backfill.get_dates(start, end):
+                year, month, day = (int(part) for part in date.split("-"))
+                data = Data(
+                    "device_report_query", {"sn": serial_number, "year": year, "month": month, "day": day}
+                )
+                file_path = data.get_saved_file_path()
+                if not file_path:
+                    continue
+
+                hourly = {variable: np.zeros(24) for variable in Rollup.energy_variables}
+                for series in Data.read_file(file_path).get("result") or []:
+                    if series.get("variable") in hourly:
+                        report_values = np.array(series.get("values") or [], dtype=np.float64)[:24]
+                        hourly[series["variable"]][: len(report_values)] = np.nan_to_num(report_values)
+
+                days.append(date)
+                for variable in Rollup.energy_variables:
+                    energy[variable].append(hourly[variable])
+
+        return (
+            np.array(days, dtype="datetime64[D]"),
+            {
+                variable: np.array(rows).reshape(len(days), 24)
+                for variable, rows in energy.items()
+            },
+        )
+
+    @staticmethod
+    def summarise(start, end, period="day", serial_numbers=None):
+        """
+        Roll up saved reports and history into totals, peaks and ratios per period.
+        Energy totals come from the reports and peaks from the history, summed or
+        maximised across every device.
+        :param start: The first day to include.
+        :param end: The last day to include.
+        :param period: "day", "week" or "month".
+        :param serial_numbers: The serial numbers to include. Defaults to every device.
+        :return: A dictionary of numpy arrays, one entry per period, keyed by
+            "period", the energy totals, "consumption", "self_consumption",
+            "self_sufficiency" and the peaks.
+        """
+        if not serial_numbers:
+            serial_numbers = Device.serials()
+
+        days, energy = Rollup.load_reports(serial_numbers, start, end)
+        # Compacted days keep each period's max, which is the peak the raw samples had
+        history = Rollup.load_history(serial_numbers, start, end, field="max")
+
+        report_periods = Rollup.get_periods(days, period)
+        history_periods = {
+            variable: Rollup.get_periods(times, period) for variable, (times, _) in history.items()
+        }
+        periods = np.unique(np.concatenate([report_periods, *history_periods.values()]))
+
+        # Daily totals per report, then summed into each period
+        index = np.searchsorted(periods, report_periods)
+        summary = {"period": periods}
+        for variable, name in Rollup.energy_variables.items():
+            summary[name] = np.bincount(index, weights=energy[variable].sum(axis=1), minlength=len(periods))
+
+        summary["consumption"] = (
+            summary["generation"]
+            + summary["grid_consumption"]
+            - summary["feedin"]
+            + summary["discharge"]
+            - summary["charge"]
+        )
+        summary["self_consumption"] = np.divide(
+            summary["generation"] - summary["feedin"],
+            summary["generation"],
+            out=np.zeros(len(periods)),
+            where=summary["generation"] > 0,
+        )
+        summary["self_sufficiency"] = np.divide(
+            summary["consumption"] - summary["grid_consumption"],
+            summary["consumption"],
+            out=np.zeros(len(periods)),
+            where=summary["consumption"] > 0,
+        )
+
+        for variable, name in Rollup.peak_variables.items():
+            peaks = np.full(len(periods), np.nan)
+            _, values = history[variable]
+            if len(values):
+                index = np.searchsorted(periods, history_periods[variable])
+                order = np.argsort(index, kind="stable")
+                starts = np.flatnonzero(np.diff(index[order], prepend=-1))
+                peaks[index[order][starts]] = np.maximum.reduceat(values[order], starts)
+            summary[name] = peaks
+
+        return summary
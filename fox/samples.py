@@ -0,0 +1,104 @@
+# Global imports
+import re
+from datetime import datetime, timedelta, timezone
+
+class Samples:
+
+    # FoxESS times look like "2024-01-01 00:05:10 CST+0800"
+    _offset_pattern = re.compile(r"([+-])(\d{2}):?(\d{2})$")
+
+    # Fields in myenergi dayhour records that describe the time, not a measurement
+    dayhour_time_fields = ("yr", "mon", "dom", "dow", "hr", "min")
+
+    @staticmethod
+    def parse_time(text):
+        """
+        Parse a FoxESS time string into a Unix timestamp.
+        :param text: The time, e.g. "2024-01-01 00:05:10 CST+0800".
+        :return: The timestamp in seconds as an integer.
+        """
+        moment = datetime.strptime(text[:19], "%Y-%m-%d %H:%M:%S")
+        match = Samples._offset_pattern.search(text)
+        if match:
+            offset = timedelta(hours=int(match.group(2)), minutes=int(match.group(3)))
+            if match.group(1) == "-":
+                offset = -offset
+            return int(moment.replace(tzinfo=timezone(offset)).timestamp())
+
+        # Without an offset, treat the time as local time
+        return int(moment.timestamp())
+
+    @staticmethod
+    def from_history(response):
+        """
+        Iterate over the samples in a device_history_query response.
+        :param response: The response from the API as a dictionary.
+        :return: A generator of (serial, variable, unit, timestamp, value) tuples.
+        """
+        for device in (response or {}).get("result") or []:
+            serial = device.get("deviceSN")
+            for series in device.get("datas") or []:
+                variable = series.get("variable")
+                unit = series.get("unit")
+                for sample in series.get("data") or []:
+                    value = sample.get("value")
+                    if value is None:
+                        continue
+                    yield serial, variable, unit, Samples.parse_time(sample["time"]), float(value)
+
+    @staticmethod
+    def from_dayhour(payload):
+        """
+        Iterate over the samples in a myenergi cgi-jdayhour response.
+        Records without an hour are for hour 0, and all times are UTC.
+        :param payload: The response from the API as a dictionary, keyed by "U<serial>".
+        :return: A generator of (serial, variable, unit, timestamp, value) tuples, in joules.
+        """
+        for key, records in (payload or {}).items():
+            serial = key[1:] if key[:1] == "U" else key
+            for record in records or []:
+                timestamp = int(
+                    datetime(
+                        record["yr"],
+                        record["mon"],
+                        record["dom"],
+                        record.get("hr", 0),
+                        record.get("min", 0),
+                        tzinfo=timezone.utc,
+                    ).timestamp()
+                )
+                for variable, value in record.items():
+                    if variable in Samples.dayhour_time_fields or not isinstance(value, (int, float)):
+                        continue
+                    yield serial, variable, "J", timestamp, float(value)
+
+    @staticmethod
+    def spread(response, spacing):
+        """
+        Spread the aggregates of a compacted device_history_query response over the periods they cover.
+        A compacted sample is the mean of an hour or a day, so reading it as one sample would count it
+        for only the first slot of its period. Each is repeated every spacing seconds across its period
+        instead, so resampling it gives the same energy as the raw samples did.
+        :param response: The response from the API as a dictionary. Raw responses are returned as they are.
+        :param spacing: The seconds between the spread samples, usually the caller's slot length.
+        :return: The response with each compacted sample repeated across its period.
+        """
+        if not (response or {}).get("compacted"):
+            return response
+
+        result = []
+        for device in response.get("result") or []:
+            datas = []
+            for series in device.get("datas") or []:
+                data = []
+                for sample in series.get("data") or []:
+                    text = sample["time"]
+                    period = sample.get("period") or spacing
+                    start = int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+                    for seconds in range(start, start + period, min(spacing, period)):
+                        data.append(dict(
+                            sample, time=f"{text[:10]} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}{text[19:]}"
+                        ))
+                datas.append(dict(series, data=data))
+            result.append(dict(device, datas=datas))
+        return dict(response, result=result)
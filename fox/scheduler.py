@@ -0,0 +1,148 @@
+# Global imports
+import heapq
+import itertools
+import threading
+import time
+
+# Local imports
+from debug import Debug
+from errors import RetryableError
+
+class BudgetExhausted(RetryableError):
+    """
+    Raised when the daily request budget has been spent.
+    """
+
+class Scheduler:
+
+    # Request priority by data name. Lower numbers are served first.
+    priorities = {
+        "device_list": 0,
+        "device_detail": 0,
+        "device_variable_get": 0,
+        "module_list": 0,
+        "plant_list": 0,
+        "plant_detail": 0,
+        "device_history_query": 1,
+        "device_report_query": 1,
+        "device_generation": 2,
+        "device_real_query": 2,
+    }
+
+    # Requests with a priority above this may not spend the reserved budget
+    reserved_priority = 1
+
+    def __init__(self, rate, burst=1, budget=None, reserve=0):
+        """
+        Initialize the token bucket.
+        :param rate: The number of requests allowed per second. Must be positive.
+        :param burst: The number of requests that may be sent back to back.
+        :param budget: The number of requests remaining today, or None if unknown.
+        :param reserve: The part of the budget kept back for high priority requests.
+        """
+        if not rate or rate <= 0:
+            Debug.error("Invalid request rate: %s. FOX_RATE_LIMIT must be a positive number of requests per second.", rate)
+
+        self._rate = rate
+        self._capacity = max(burst, 1)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._budget = budget
+        self._reserve = reserve
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._waiting = []
+
+    def acquire(self, name):
+        """
+        Block until a request for the given data name may be sent.
+        :param name: The data name of the request.
+        :raises BudgetExhausted: If the budget does not allow the request.
+        """
+        priority = self.priorities.get(name, 0)
+        ticket = (priority, next(self._sequence))
+        with self._condition:
+            self.check_budget(name, priority)
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self.refill()
+                    if self._waiting[0] == ticket and self._tokens >= 1:
+                        break
+                    timeout = (1 - self._tokens) / self._rate if self._waiting[0] == ticket else None
+                    self._condition.wait(timeout)
+                    self.check_budget(name, priority)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+            self._tokens -= 1
+            if self._budget is not None:
+                self._budget -= 1
+
+    def try_acquire(self, name):
+        """
+        Take a token if one is free, without blocking, for callers that wait on their own like AsyncAPI.
+        Callers blocked in acquire() with the same or a higher priority go first.
+        :param name: The data name of the request.
+        :return: 0 if the request may be sent now, otherwise the seconds to wait before trying again.
+        :raises BudgetExhausted: If the budget does not allow the request.
+        """
+        priority = self.priorities.get(name, 0)
+        with self._condition:
+            self.check_budget(name, priority)
+            self.refill()
+            if self._waiting and self._waiting[0][0] <= priority:
+                return 1 / self._rate
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._rate
+
+            self._tokens -= 1
+            if self._budget is not None:
+                self._budget -= 1
+            return 0
+
+    def check_budget(self, name, priority):
+        """
+        Check the remaining budget allows a request.
+        :param name: The data name of the request.
+        :param priority: The priority of the request.
+        :raises BudgetExhausted: If the budget does not allow the request.
+        """
+        if self._budget is None:
+            return
+
+        if self._budget <= 0:
+            raise BudgetExhausted(f"Request budget exhausted, cannot send {name}", name)
+
+        if priority > self.reserved_priority and self._budget <= self._reserve:
+            raise BudgetExhausted(
+                f"Only {self._budget} requests left, reserved for higher priority requests than {name}", name
+            )
+
+    def get_budget(self):
+        """
+        Get the number of requests remaining in the budget.
+        :return: The remaining budget, or None if unknown.
+        """
+        return self._budget
+
+    def set_budget(self, budget, reserve=0):
+        """
+        Replace the remaining budget, e.g. after the daily quota resets.
+        :param budget: The number of requests remaining today, or None if unknown.
+        :param reserve: The part of the budget kept back for high priority requests.
+        """
+        with self._condition:
+            self._budget = budget
+            self._reserve = reserve
+            self._condition.notify_all()
+
+    def refill(self):
+        """
+        Add the tokens earned since the last refill to the bucket.
+        """
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
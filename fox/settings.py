@@ -0,0 +1,91 @@
+# Global imports
+import os
+import threading
+from types import MappingProxyType
+from dotenv import load_dotenv
+
+class Settings:
+    """
+    The configuration from .env and the environment, read once per process.
+    Settings are read-only, and unset or empty values fall back to the default given by the caller.
+    """
+
+    __slots__ = ("_values",)
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, values=None):
+        """
+        :param values: The settings by name. Defaults to a snapshot of the environment.
+        """
+        object.__setattr__(self, "_values", MappingProxyType(dict(os.environ if values is None else values)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are read-only")
+
+    def __repr__(self):
+        return f"Settings({len(self._values)} values)"
+
+    @staticmethod
+    def load():
+        """
+        Get the process's settings, reading .env into the environment on first use.
+        :return: The shared Settings instance.
+        """
+        if Settings._instance is None:
+            with Settings._lock:
+                if Settings._instance is None:
+                    load_dotenv()
+                    Settings._instance = Settings()
+
+        return Settings._instance
+
+    @staticmethod
+    def reload():
+        """
+        Read the environment again, for long-running processes and benchmarks that change it.
+        :return: The new shared Settings instance.
+        """
+        with Settings._lock:
+            Settings._instance = None
+        return Settings.load()
+
+    def get(self, name, default=None):
+        """
+        Get a setting as a string.
+        :param name: The setting name, e.g. "FOX_DATA_DIR".
+        :param default: The value if the setting is unset or empty.
+        :return: The setting, or the default.
+        """
+        return self._values.get(name) or default
+
+    def get_bool(self, name, default=False):
+        """
+        Get a setting as a boolean. "true", "1" and "yes" are true.
+        :param name: The setting name.
+        :param default: The value if the setting is unset or empty.
+        :return: The setting as a boolean.
+        """
+        value = self._values.get(name)
+        return value.lower() in ("true", "1", "yes") if value else default
+
+    def get_float(self, name, default=None):
+        """
+        Get a setting as a float.
+        :param name: The setting name.
+        :param default: The value if the setting is unset or empty.
+        :return: The setting as a float, or the default.
+        """
+        value = self._values.get(name)
+        return float(value) if value else default
+
+    def get_int(self, name, default=None):
+        """
+        Get a setting as an integer.
+        :param name: The setting name.
+        :param default: The value if the setting is unset or empty.
+        :return: The setting as an integer, or the default.
+        """
+        value = self._values.get(name)
+        return int(value) if value else default
@@ -0,0 +1,212 @@
+# Global imports
+import json
+import os
+import re
+import sqlite3
+import threading
+
+# Local imports
+from data import Data
+from debug import Debug
+from samples import Samples
+from settings import Settings
+
+class Store:
+
+    # Saved files the store knows how to ingest
+    history_pattern = re.compile(r"^device_history_query_(.+)_(\d{4}-\d{2}-\d{2})\.json(\.gz)?$")
+    dayhour_pattern = re.compile(r"^dayhour_(?:(.+)_)?(\d{4}-\d{2}-\d{2})\.json$")
+
+    # The primary key doubles as the (source, serial, variable, timestamp) index,
+    # and WITHOUT ROWID stores rows in that order so range scans read contiguous pages.
+    schema = """
+        CREATE TABLE IF NOT EXISTS samples (
+            source TEXT NOT NULL,
+            serial TEXT NOT NULL,
+            variable TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (source, serial, variable, timestamp)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS units (
+            source TEXT NOT NULL,
+            serial TEXT NOT NULL,
+            variable TEXT NOT NULL,
+            unit TEXT,
+            PRIMARY KEY (source, serial, variable)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=None):
+        """
+        Open the store, creating the database if needed.
+        :param path: The database file. Defaults to FOX_STORE_PATH or store.sqlite3 in the data directory.
+        """
+        self.path = path or Settings.load().get("FOX_STORE_PATH") or os.path.join(Data.get_data_dir(), "store.sqlite3")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.schema)
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self._connection.close()
+
+    def ingest_dir(self, fox_dir=None, myenergi_dir=None):
+        """
+        Ingest every history and dayhour file not already in the store.
+        :param fox_dir: The FoxESS data directory. Defaults to FOX_DATA_DIR.
+        :param myenergi_dir: The myenergi data directory. Defaults to MYENERGI_DATA_DIR.
+        :return: The number of samples inserted.
+        """
+        inserted = 0
+        for data_dir in (fox_dir or Data.get_data_dir(), myenergi_dir or Data.get_myenergi_data_dir()):
+            if not os.path.isdir(data_dir):
+                continue
+            for file_name in sorted(os.listdir(data_dir)):
+                inserted += self.ingest_file(os.path.join(data_dir, file_name))
+
+        Debug.info("Ingested %s samples into %s", inserted, self.path)
+        return inserted
+
+    def ingest_file(self, file_path):
+        """
+        Ingest a saved history or dayhour file, skipping files already ingested unchanged.
+        A monthly archive of compacted history adds each period's mean at the period's start,
+        for the days whose raw files were not ingested.
+        :param file_path: The path of the file.
+        :return: The number of samples inserted.
+        """
+        # Imported here as retention imports the store
+        from retention import Retention
+
+        file_name = os.path.basename(file_path)
+        archive = Retention.month_pattern.match(file_name)
+        if self.history_pattern.match(file_name) or archive:
+            source = "fox"
+        elif self.dayhour_pattern.match(file_name):
+            source = "myenergi"
+        else:
+            return 0
+
+        mtime = os.path.getmtime(file_path)
+        with self._lock:
+            row = self._connection.execute("SELECT mtime FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row and row[0] == mtime:
+            return 0
+
+        if archive:
+            samples = self.read_archive(file_path, archive.group(1))
+        elif source == "fox":
+            samples = Samples.from_history(Data.read_file(file_path))
+        else:
+            with open(file_path, "r", encoding="utf-8") as f:
+                samples = Samples.from_dayhour(json.load(f))
+
+        inserted = self.insert(source, samples, file_path=file_path, mtime=mtime)
+        Debug.info("Ingested %s samples from %s", inserted, file_path)
+        return inserted
+
+    def read_archive(self, file_path, serial_number):
+        """
+        Read the samples of a monthly archive, skipping days already ingested from their raw files,
+        so the hourly means don't replace the raw samples at the same times.
+        :param file_path: The path of the archive.
+        :param serial_number: The serial number of the device.
+        :return: A generator of (serial, variable, unit, timestamp, value) tuples.
+        """
+        from retention import Retention
+
+        with self._lock:
+            ingested = {
+                os.path.basename(row[0])
+                for row in self._connection.execute("SELECT path FROM files")
+            }
+        for date in sorted(Retention.read_month(file_path)):
+            stem = f"device_history_query_{serial_number}_{date}.json"
+            if stem in ingested or stem + ".gz" in ingested:
+                continue
+            yield from Samples.from_history(Retention.read_day(serial_number, date, file_path))
+
+    def insert(self, source, samples, file_path=None, mtime=None):
+        """
+        Insert samples in a single transaction, replacing any at the same timestamp.
+        :param source: The data source, "fox" or "myenergi".
+        :param samples: An iterable of (serial, variable, unit, timestamp, value) tuples.
+        :param file_path: The file the samples came from, recorded as ingested.
+        :param mtime: The modification time of the file.
+        :return: The number of samples inserted.
+        """
+        rows = []
+        units = {}
+        for serial, variable, unit, timestamp, value in samples:
+            rows.append((source, serial, variable, timestamp, value))
+            units[(source, serial, variable)] = unit
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO samples (source, serial, variable, timestamp, value) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO units (source, serial, variable, unit) VALUES (?, ?, ?, ?)",
+                [key + (unit,) for key, unit in units.items()],
+            )
+            if file_path:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime) VALUES (?, ?)", (file_path, mtime)
+                )
+
+        return len(rows)
+
+    def query(self, serial, variable, start, end, source="fox"):
+        """
+        Get the samples of one variable for one device over a time range.
+        :param serial: The serial number of the device.
+        :param variable: The variable name, e.g. "SoC" or "imp".
+        :param start: The start of the range as a Unix timestamp, inclusive.
+        :param end: The end of the range as a Unix timestamp, exclusive.
+        :param source: The data source, "fox" or "myenergi".
+        :return: A list of (timestamp, value) tuples in time order.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT timestamp, value FROM samples"
+                " WHERE source = ? AND serial = ? AND variable = ? AND timestamp >= ? AND timestamp < ?"
+                " ORDER BY timestamp",
+                (source, serial, variable, int(start), int(end)),
+            ).fetchall()
+
+    def query_variables(self, serial, variables, start, end, source="fox"):
+        """
+        Get the samples of several variables for one device over a time range.
+        :param serial: The serial number of the device.
+        :param variables: The variable names.
+        :param start: The start of the range as a Unix timestamp, inclusive.
+        :param end: The end of the range as a Unix timestamp, exclusive.
+        :param source: The data source, "fox" or "myenergi".
+        :return: A dictionary of variable name to a list of (timestamp, value) tuples.
+        """
+        return {variable: self.query(serial, variable, start, end, source) for variable in variables}
+
+    def get_variables(self, serial, source="fox"):
+        """
+        Get the variables stored for a device, with their units.
+        :param serial: The serial number of the device.
+        :param source: The data source, "fox" or "myenergi".
+        :return: A dictionary of variable name to unit.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT variable, unit FROM units WHERE source = ? AND serial = ? ORDER BY variable",
+                (source, serial),
+            ).fetchall()
+        return dict(rows)
@@ -0,0 +1,304 @@
+# Global imports
+import json
+import os
+import numpy as np
+
+# Local imports
+from data import Data
+from debug import Debug
+from device import Device
+from rollup import Rollup
+from settings import Settings
+
+class Tariff:
+    """
+    Import and export rates per half hour, and a daily standing charge, changing over time.
+
+    A tariff is defined as a list of periods, each starting on its "from" day:
+
+        {"name": "Economy 7", "periods": [{
+            "from": "2024-01-01",
+            "standing": 0.53,
+            "import": [{"rate": 0.30}, {"start": "00:30", "end": "07:30", "rate": 0.12}],
+            "export": 0.15
+        }]}
+
+    Rates are per kWh and standing charges per day, in any currency. A band without start and
+    end covers the whole day, and "days" limits it to some weekdays, e.g. ["sat", "sun"].
+    Later bands override earlier ones. The first period also applies before its start.
+    """
+
+    weekdays = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+    # Rates are looked up per half hour of the device's wall-clock day
+    slot_seconds = 1800
+    slots_per_day = 48
+
+    def __init__(self, name, periods):
+        """
+        :param name: The tariff name.
+        :param periods: The periods of the tariff as dictionaries, see the class docstring.
+        """
+        if not periods:
+            Debug.error("Tariff %s has no periods.", name)
+
+        self.name = name
+        self.periods = sorted(periods, key=lambda period: period.get("from") or "")
+        self.starts = np.array(
+            [period.get("from") or "1970-01-01" for period in self.periods], dtype="datetime64[D]"
+        )
+        self.standing = np.array([float(period.get("standing") or 0) for period in self.periods])
+        self.import_rates = np.stack([self.get_table(period.get("import"), "import") for period in self.periods])
+        self.export_rates = np.stack([self.get_table(period.get("export"), "export") for period in self.periods])
+
+    def __repr__(self):
+        return f"Tariff({self.name!r}, periods={len(self.periods)})"
+
+    @staticmethod
+    def load(path=None):
+        """
+        Load tariff definitions from a JSON file holding a list of tariffs.
+        :param path: The file. Defaults to FOX_TARIFFS, or tariffs.json in the data directory.
+        :return: A dictionary of tariff name to Tariff, in file order.
+        """
+        path = path or Settings.load().get("FOX_TARIFFS") or os.path.join(Data.get_data_dir(), "tariffs.json")
+        if not os.path.exists(path):
+            Debug.error("No tariff definitions found at %s.", path)
+
+        with open(path, "r", encoding="utf-8") as f:
+            definitions = json.load(f)
+        return {
+            definition["name"]: Tariff(definition["name"], definition.get("periods"))
+            for definition in definitions
+        }
+
+    @staticmethod
+    def parse_slot(text):
+        """
+        Get the half hour a time of day starts.
+        :param text: The time as "HH:MM", on the hour or half hour. "24:00" is the end of the day.
+        :return: The half hour index, from 0 to 48.
+        """
+        hours, minutes = (int(part) for part in text.split(":"))
+        if minutes not in (0, 30) or not 0 <= hours * 60 + minutes <= 1440:
+            Debug.error("Invalid tariff time: %s. Use a time on the hour or half hour.", text)
+        return hours * 2 + minutes // 30
+
+    def get_table(self, bands, kind):
+        """
+        Build the rates of one period for each weekday and half hour.
+        :param bands: The bands, as a list of dictionaries, a single flat rate or None.
+        :param kind: "import" or "export". Export defaults to a rate of zero.
+        :return: A numpy array of shape (7, 48), with Monday first.
+        """
+        if bands is None and kind == "export":
+            bands = 0
+        if isinstance(bands, (int, float)):
+            bands = [{"rate": bands}]
+
+        table = np.full((7, self.slots_per_day), np.nan)
+        for band in bands or []:
+            days = [
+                day if isinstance(day, int) else self.weekdays.index(day.lower()[:3])
+                for day in band.get("days") or range(7)
+            ]
+            start = self.parse_slot(band.get("start") or "00:00")
+            end = self.parse_slot(band.get("end") or "24:00")
+            # A band ending at or before its start runs past midnight
+            slots = np.arange(start, end) if start < end else np.r_[start:self.slots_per_day, 0:end]
+            table[np.ix_(days, slots)] = float(band["rate"])
+
+        if np.isnan(table).any():
+            Debug.error("The %s rates of tariff %s don't cover every half hour.", kind, self.name)
+        return table
+
+    def get_rates(self, slots):
+        """
+        Look up the rates for half hours, in one array operation.
+        :param slots: A datetime64 array of half hour start times, in the device's wall-clock time.
+        :return: A tuple of (import rates, export rates) numpy arrays.
+        """
+        days = slots.astype("datetime64[D]")
+        period = np.maximum(np.searchsorted(self.starts, days, side="right") - 1, 0)
+        # Day 0 of the epoch was a Thursday, so shift to make Monday 0
+        weekday = (days.astype("int64") + 3) % 7
+        slot = (slots - days).astype("timedelta64[s]").astype("int64") // self.slot_seconds
+        return self.import_rates[period, weekday, slot], self.export_rates[period, weekday, slot]
+
+    def get_standing(self, days):
+        """
+        Look up the standing charges for days.
+        :param days: A datetime64[D] array, with a day repeated for each meter charged.
+        :return: A numpy array of standing charges.
+        """
+        return self.standing[np.maximum(np.searchsorted(self.starts, days, side="right") - 1, 0)]
+
+class Costs:
+
+    # History variables (power in kW) and the energy they become per half hour
+    power_variables = {
+        "gridConsumptionPower": "import",
+        "feedinPower": "export",
+        "loadsPower": "load",
+        "pvPower": "pv",
+    }
+
+    columns = (
+        "import_kwh",
+        "export_kwh",
+        "import_cost",
+        "export_credit",
+        "standing",
+        "cost",
+        "no_solar_cost",
+        "pv_only_cost",
+        "savings",
+        "battery_savings",
+    )
+
+    @staticmethod
+    def load_energy(serial_numbers, start, end):
+        """
+        Load saved history into half-hourly energy, summed across devices.
+        Each half hour's energy is its mean power times half an hour, so irregular sampling is fine.
+        Compacted days are spread over the half hours each of their aggregates covers.
+        What the grid would have seen without a battery (PV only) is worked out per device first,
+        so one device's export doesn't offset another's import.
+        :param serial_numbers: The serial numbers of the devices.
+        :param start: The first day to load.
+        :param end: The last day to load.
+        :return: A tuple of (slots, energy, days). Slots is a sorted datetime64 array of half hours,
+            energy maps "import", "export", "load", "pv", "pv_only_import" and "pv_only_export" to
+            arrays of kWh per slot, and days is a datetime64[D] array with one entry per device per
+            day with data, for standing charges.
+        """
+        device_slots = []
+        device_energy = {name: [] for name in ("import", "export", "load", "pv", "pv_only_import", "pv_only_export")}
+        device_days = []
+        for serial_number in serial_numbers:
+            history = Rollup.load_history(
+                [serial_number], start, end, list(Costs.power_variables), spacing=Tariff.slot_seconds
+            )
+            slots = {
+                variable: times - times.astype("int64") % Tariff.slot_seconds
+                for variable, (times, _) in history.items()
+            }
+            unique = np.unique(np.concatenate(list(slots.values())))
+            if not len(unique):
+                continue
+
+            energy = {}
+            for variable, name in Costs.power_variables.items():
+                index = np.searchsorted(unique, slots[variable])
+                totals = np.bincount(index, weights=history[variable][1], minlength=len(unique))
+                counts = np.bincount(index, minlength=len(unique))
+                mean = np.divide(totals, counts, out=np.zeros(len(unique)), where=counts > 0)
+                energy[name] = mean * Tariff.slot_seconds / 3600
+            energy["pv_only_import"] = np.maximum(energy["load"] - energy["pv"], 0)
+            energy["pv_only_export"] = np.maximum(energy["pv"] - energy["load"], 0)
+
+            device_slots.append(unique)
+            for name, values in energy.items():
+                device_energy[name].append(values)
+            device_days.append(np.unique(unique.astype("datetime64[D]")))
+
+        if not device_slots:
+            return (
+                np.array([], dtype="datetime64[s]"),
+                {name: np.array([]) for name in device_energy},
+                np.array([], dtype="datetime64[D]"),
+            )
+
+        all_slots = np.concatenate(device_slots)
+        slots, index = np.unique(all_slots, return_inverse=True)
+        energy = {
+            name: np.bincount(index, weights=np.concatenate(values), minlength=len(slots))
+            for name, values in device_energy.items()
+        }
+        return slots, energy, np.concatenate(device_days)
+
+    @staticmethod
+    def price(tariff, slots, energy, days, period="day"):
+        """
+        Price half-hourly energy against a tariff, totalled per period.
+        No solar assumes all the load came from the grid, and PV only assumes no battery.
+        Savings are what the tariff would have cost with no solar less what it cost, and
+        battery savings what it would have cost with PV only less what it cost.
+        :param tariff: The Tariff.
+        :param slots: A datetime64 array of half hours, from load_energy().
+        :param energy: The energy per half hour, from load_energy().
+        :param days: The days charged, from load_energy().
+        :param period: "day", "week" or "month".
+        :return: A dictionary of numpy arrays, one entry per period, keyed by "period" and Costs.columns.
+        """
+        import_rates, export_rates = tariff.get_rates(slots)
+        standing = tariff.get_standing(days)
+
+        slot_periods = Rollup.get_periods(slots, period)
+        day_periods = Rollup.get_periods(days, period)
+        periods = np.unique(np.concatenate([slot_periods, day_periods]))
+        slot_index = np.searchsorted(periods, slot_periods)
+
+        def total(values):
+            return np.bincount(slot_index, weights=values, minlength=len(periods))
+
+        summary = {"period": periods}
+        summary["import_kwh"] = total(energy["import"])
+        summary["export_kwh"] = total(energy["export"])
+        summary["import_cost"] = total(energy["import"] * import_rates)
+        summary["export_credit"] = total(energy["export"] * export_rates)
+        summary["standing"] = np.bincount(
+            np.searchsorted(periods, day_periods), weights=standing, minlength=len(periods)
+        )
+        summary["cost"] = summary["import_cost"] - summary["export_credit"] + summary["standing"]
+        summary["no_solar_cost"] = total(energy["load"] * import_rates) + summary["standing"]
+        summary["pv_only_cost"] = (
+            total(energy["pv_only_import"] * import_rates - energy["pv_only_export"] * export_rates)
+            + summary["standing"]
+        )
+        summary["savings"] = summary["no_solar_cost"] - summary["cost"]
+        summary["battery_savings"] = summary["pv_only_cost"] - summary["cost"]
+        return summary
+
+    @staticmethod
+    def summarise(tariff, start, end, period="day", serial_numbers=None):
+        """
+        Price saved history against one tariff.
+        :param tariff: The Tariff, or the name of one in the tariff definitions.
+        :param start: The first day to include.
+        :param end: The last day to include.
+        :param period: "day", "week" or "month".
+        :param serial_numbers: The serial numbers to include. Defaults to every device.
+        :return: A dictionary of numpy arrays, as returned by price().
+        """
+        if isinstance(tariff, str):
+            tariffs = Tariff.load()
+            if tariff not in tariffs:
+                Debug.error("Unknown tariff: %s. Known tariffs are: %s", tariff, ", ".join(tariffs))
+            tariff = tariffs[tariff]
+
+        slots, energy, days = Costs.load_energy(serial_numbers or Device.serials(), start, end)
+        return Costs.price(tariff, slots, energy, days, period)
+
+    @staticmethod
+    def compare(start, end, period="month", tariffs=None, serial_numbers=None):
+        """
+        Price the same saved history against several tariffs, to see what each would have cost.
+        The history is loaded once and each tariff is priced in a few array operations.
+        :param start: The first day to include.
+        :param end: The last day to include.
+        :param period: "day", "week" or "month".
+        :param tariffs: The Tariffs to compare. Defaults to every tariff in the tariff definitions.
+        :param serial_numbers: The serial numbers to include. Defaults to every device.
+        :return: A dictionary of numpy arrays, one entry per period, keyed by "period" and each
+            tariff's name, holding its cost.
+        """
+        tariffs = tariffs or list(Tariff.load().values())
+        slots, energy, days = Costs.load_energy(serial_numbers or Device.serials(), start, end)
+
+        comparison = {}
+        for tariff in tariffs:
+            summary = Costs.price(tariff, slots, energy, days, period)
+            comparison.setdefault("period", summary["period"])
+            comparison[tariff.name] = summary["cost"]
+        return comparison
@@ -0,0 +1,59 @@
+# Global imports
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Local imports
+from debug import Debug
+from settings import Settings
+
+class Workers:
+    @staticmethod
+    def get_max_workers(max_workers=None):
+        """
+        Get the size of the worker pool.
+        :param max_workers: An explicit pool size, overriding FOX_WORKERS.
+        :return: The number of workers as an integer.
+        """
+        if max_workers:
+            return int(max_workers)
+
+        return Settings.load().get_int("FOX_WORKERS", 8)
+
+    @staticmethod
+    def use_async():
+        """
+        Check if batches should run on an event loop instead of threads, set by FOX_ASYNC.
+        :return: True to use AsyncData, False to use threads.
+        """
+        return Settings.load().get_bool("FOX_ASYNC")
+
+    @staticmethod
+    def map(func, items, max_workers=None):
+        """
+        Call a function for each item on a bounded thread pool.
+        A failure for one item is recorded and does not stop the others.
+        :param func: The function to call with each item.
+        :param items: The items to process.
+        :param max_workers: The maximum number of concurrent calls.
+        :return: A tuple of (results, errors) dictionaries keyed by item. Errors are the exceptions raised,
+            so callers can use FoxError.is_retryable() to pick the items worth running again.
+        """
+        results = {}
+        errors = {}
+        items = list(items)
+        if not items:
+            return results, errors
+
+        max_workers = min(Workers.get_max_workers(max_workers), len(items))
+        Debug.info("Processing %s items with %s workers", len(items), max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(func, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    results[item] = future.result()
+                except (Exception, SystemExit) as e:
+                    # Debug.error() exits, which only ends the worker thread here
+                    errors[item] = e
+                    Debug.warning("Failed to process %s: %s", item, str(e) or type(e).__name__)
+
+        return results, errors
@@ -0,0 +1,207 @@
+# Global imports
+import json
+import os
+import requests
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from requests.auth import HTTPDigestAuth
+
+class Client:
+
+    # The director assigns each hub to a server, returned in the x_myenergi-asn header
+    director = "https://director.myenergi.net"
+
+    # The server used before one has been assigned
+    default_server = "s18.myenergi.net"
+
+    headers = {
+        "accept": "application/json",
+        "content-type": "application/json",
+    }
+
+    def __init__(self, serial_number=None, key=None, data_dir=None):
+        """
+        Initialize the client. Settings default to the environment variables.
+        :param serial_number: The hub serial number, MYENERGI_SERIAL_NUMBER.
+        :param key: The API key, MYENERGI_API_KEY.
+        :param data_dir: The directory to save data to, MYENERGI_DATA_DIR.
+        """
+        load_dotenv()
+        self.key = key or os.getenv("MYENERGI_API_KEY")
+        if not self.key:
+            raise ValueError("MYENERGI_API_KEY is not set in the environment variables.")
+
+        self.serial_number = serial_number or os.getenv("MYENERGI_SERIAL_NUMBER")
+        if not self.serial_number:
+            raise ValueError("MYENERGI_SERIAL_NUMBER is not set in the environment variables.")
+
+        self.data_dir = data_dir or os.getenv("MYENERGI_DATA_DIR") or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "data"
+        )
+        self.director = os.getenv("MYENERGI_DIRECTOR") or self.director
+        self.max_workers = int(os.getenv("MYENERGI_WORKERS") or 4)
+
+        # One session for every request, so connections and digest nonces are reused
+        self._session = requests.Session()
+        self._session.auth = HTTPDigestAuth(self.serial_number, self.key)
+        self._session.headers.update(self.headers)
+        self._server = os.getenv("MYENERGI_SERVER") or None
+        self._server_lock = threading.Lock()
+
+    def backfill(self, start, end=None, devices=None, max_workers=None):
+        """
+        Fetch the dayhour data missing from a date range, concurrently.
+        Days already saved are skipped, so an interrupted backfill resumes when run again.
+        :param start: The first day as a date or "YYYY-MM-DD" string.
+        :param end: The last day. Defaults to yesterday.
+        :param devices: The devices to fetch, e.g. ["Z12345678", "E87654321"]. Defaults to get_devices().
+        :param max_workers: The maximum number of concurrent requests.
+        :return: A tuple of (results, errors) dictionaries keyed by (device, date).
+        """
+        if isinstance(start, str):
+            start = datetime.strptime(start, "%Y-%m-%d")
+        if isinstance(end, str):
+            end = datetime.strptime(end, "%Y-%m-%d")
+        end = end or datetime.now() - timedelta(days=1)
+
+        dates = [(start + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range((end - start).days + 1)]
+        missing = [
+            (device, date)
+            for device in devices or self.get_devices()
+            for date in dates
+            if not os.path.exists(self.get_file_path(device, date))
+        ]
+
+        results = {}
+        errors = {}
+        if not missing:
+            return results, errors
+
+        with ThreadPoolExecutor(max_workers=min(max_workers or self.max_workers, len(missing))) as executor:
+            futures = {executor.submit(self.dayhour, device, date): (device, date) for device, date in missing}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except (OSError, ValueError) as e:
+                    errors[futures[future]] = str(e)
+
+        return results, errors
+
+    def dayhour(self, device, date):
+        """
+        Get a day of hourly data for a device, saving it to the data directory.
+        A day that is already saved is read from disk instead.
+        :param device: The device, e.g. "Z12345678" for a zappi, "E..." for an eddi or "H..." for a harvi.
+        :param date: The day as a date or "YYYY-MM-DD" string.
+        :return: The response as a dictionary.
+        """
+        if not isinstance(date, str):
+            date = date.strftime("%Y-%m-%d")
+
+        file_path = self.get_file_path(device, date)
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+        response = self.request(f"cgi-jdayhour-{device}-{date}")
+        data = response.json()
+        self.save(file_path, response.content)
+        return data
+
+    def get_devices(self):
+        """
+        Get the devices to fetch data for, from MYENERGI_DEVICES.
+        :return: A list of devices, defaulting to the zappi with the hub serial number.
+        """
+        devices = os.getenv("MYENERGI_DEVICES")
+        if devices:
+            return [device.strip() for device in devices.split(",") if device.strip()]
+
+        return [f"Z{self.serial_number}"]
+
+    def get_file_path(self, device, date):
+        """
+        Get the path a day of data is saved to.
+        The default zappi keeps the original dayhour_<date>.json name.
+        :param device: The device, e.g. "Z12345678".
+        :param date: The day as a "YYYY-MM-DD" string.
+        :return: The file path as a string.
+        """
+        if device == f"Z{self.serial_number}":
+            return os.path.join(self.data_dir, f"dayhour_{date}.json")
+
+        return os.path.join(self.data_dir, f"dayhour_{device}_{date}.json")
+
+    def get_server(self):
+        """
+        Get the server the hub is assigned to, asking the director once and caching the answer on disk.
+        :return: The server host name, or URL if it includes a scheme.
+        """
+        with self._server_lock:
+            if self._server:
+                return self._server
+
+            cache_path = os.path.join(self.data_dir, "asn.json")
+            if os.path.exists(cache_path):
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    self._server = json.load(f).get("asn")
+                if self._server:
+                    return self._server
+
+            try:
+                response = self._session.get(f"{self.director}/cgi-jstatus-*", timeout=30)
+                self._server = response.headers.get("x_myenergi-asn") or self.default_server
+            except requests.exceptions.RequestException:
+                return self.default_server
+
+            self.save(cache_path, json.dumps({"asn": self._server}).encode("utf-8"))
+            return self._server
+
+    def request(self, path):
+        """
+        Send a GET request to the hub's server.
+        If it fails, the cached server is forgotten and the director is asked again once.
+        :param path: The path, e.g. "cgi-jdayhour-Z12345678-2024-01-01".
+        :return: The response.
+        """
+        for attempt in range(2):
+            server = self.get_server()
+            base_url = server if "://" in server else f"https://{server}"
+            try:
+                response = self._session.get(f"{base_url}/{path}", timeout=30)
+                if response.status_code == 200:
+                    return response
+                error = ValueError(f"Failed to retrieve data: {response.status_code} {response.text}")
+            except requests.exceptions.RequestException as e:
+                error = e
+
+            if attempt == 0:
+                self.reset_server()
+
+        raise error
+
+    def reset_server(self):
+        """
+        Forget the cached server assignment.
+        """
+        with self._server_lock:
+            self._server = None
+            cache_path = os.path.join(self.data_dir, "asn.json")
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+
+    def save(self, file_path, content):
+        """
+        Write a file atomically, through a temporary file renamed into place.
+        :param file_path: The file to write.
+        :param content: The bytes to write.
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=".", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
@@ -1,50 +1,38 @@
 # Global imports
-import os
-import requests
 import sys
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
-from requests.auth import HTTPDigestAuth
 
-load_dotenv()
-key = os.getenv("MYENERGI_API_KEY")
-if not key:
-    print("MYENERGI_API_KEY is not set in the environment variables.")
-    exit(1)
-
-serial_number = os.getenv("MYENERGI_SERIAL_NUMBER")
-if not serial_number:
-    print("MYENERGI_SERIAL_NUMBER is not set in the environment variables.")
-    exit(1)
-
-# Get the previous day in YYYY-MM-DD format
-yesterday = datetime.now() - timedelta(days=1)
-date = yesterday.strftime("%Y-%m-%d")
-
-# api_url = "https://s18.myenergi.net/cgi-jstatus-Z"
-api_url = f"https://s18.myenergi.net/cgi-jdayhour-Z{serial_number}-{date}"
-
-headers = {
-    "accept": "application/json",
-    "content-type": "application/json",
-}
-
-auth = HTTPDigestAuth(serial_number, key)
-
-file_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
-if not os.path.exists(file_dir):
-    os.makedirs(file_dir)
-
-file_name = os.path.join(file_dir, f"dayhour_{date}.json")
-
-response = requests.get(api_url, headers=headers, auth=auth)
-if response.status_code == 200:
-    data = response.json()
-    # Write the data to a file
-    with open(file_name, "w") as file:
-        file.write(response.text)
-    print(f"Data written to {file_name}")
-else:
-    print(f"Failed to retrieve data: {response.status_code}")
-    print(response.text)
-    sys.exit(1)
+# Local imports
+from client import Client
+
+if __name__ == '__main__':
+    try:
+        client = Client()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    # Backfill a date range, e.g. index.py backfill 2024-01-01 2024-01-31
+    if len(sys.argv) > 2 and sys.argv[1] == "backfill":
+        end = sys.argv[3] if len(sys.argv) > 3 else None
+        results, errors = client.backfill(sys.argv[2], end)
+        print(f"Backfilled {len(results)} days, {len(errors)} failed")
+        for (device, date), error in errors.items():
+            print(f"Failed to retrieve {device} {date}: {error}")
+        sys.exit(1 if errors else 0)
+
+    # Get the previous day in YYYY-MM-DD format
+    yesterday = datetime.now() - timedelta(days=1)
+    date = yesterday.strftime("%Y-%m-%d")
+
+    failed = False
+    for device in client.get_devices():
+        try:
+            client.dayhour(device, date)
+            print(f"Data written to {client.get_file_path(device, date)}")
+        except (OSError, ValueError) as e:
+            print(f"Failed to retrieve data: {e}")
+            failed = True
+
+    if failed:
+        sys.exit(1)